@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+"""
+File to benchmark the login / callback / verify hot paths of the extension
+against a local AWS Cognito stand-in (:class:`FakeCognito`).
+Results are written as JSON, so regressions show up in review:
+    python -m benchmarks.bench_auth --output bench_output.json
+Scenarios:
+    * config_lookup_live        Config property lookups through app.config.
+    * config_lookup_settings    Lookups on the frozen CognitoSettings.
+    * verify_cold_cache         verify() with the JWKS cache cleared each time.
+    * verify_warm_cache         verify() with the JWKS cached.
+    * verify_backends           Signature and claims verification per
+                                available crypto backend, and with the
+                                pure-python RSA of python-jose for reference.
+    * token_required_cached     @token_required call with a cached token.
+    * callback_concurrent       @callback_handler logins from many threads.
+"""
+
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+from statistics import mean
+from statistics import median
+
+from flask import Flask
+
+from flask_cognito_auth import CognitoAuthManager
+from flask_cognito_auth import callback_handler
+from flask_cognito_auth import token_required
+from flask_cognito_auth.config import Config
+from flask_cognito_auth.config import CognitoSettings
+from flask_cognito_auth.decorators import verify
+from flask_cognito_auth.crypto import CRYPTO_BACKENDS
+from flask_cognito_auth.crypto import DEFAULT_CRYPTO_BACKEND
+from flask_cognito_auth.crypto import JoseBackend
+from flask_cognito_auth.validation import ValidationProfile
+from jose import jwt
+
+from .fake_cognito import FakeCognito
+
+COGNITO_CONFIG = {
+    'COGNITO_REGION': "us-east-1",
+    'COGNITO_USER_POOL_ID': "us-east-1_benchmark",
+    'COGNITO_CLIENT_ID': "benchmarkclientid",
+    'COGNITO_CLIENT_SECRET': "benchmarkclientsecret",
+    'COGNITO_DOMAIN': "https://benchmark.auth.us-east-1.amazoncognito.com",
+    'COGNITO_REDIRECT_URI': "http://localhost:5000/cognito/callback",
+    'COGNITO_SIGNOUT_URI': "http://localhost:5000/login",
+}
+
+
+class BenchmarkContext(object):
+    """
+    Flask app wired to the AWS Cognito stand-in, shared by the scenarios.
+    """
+
+    def __init__(self, cognito, app, manager):
+        self.cognito = cognito
+        self.app = app
+        self.manager = manager
+        self.token = cognito.issue_tokens()["access_token"]
+
+
+def create_context(cognito):
+    """
+    Method to create the Flask app of the benchmarks, with the AWS Cognito
+    endpoints pointed at the stand-in.
+    :param cognito (FakeCognito):   Started AWS Cognito stand-in.
+    :return context (BenchmarkContext)
+    """
+    app = Flask(__name__)
+    app.secret_key = "benchmark secret key"
+    app.config.update(COGNITO_CONFIG)
+    manager = CognitoAuthManager(app)
+    manager.settings = manager.settings.replace(
+        public_key_uri=cognito.public_key_uri,
+        jwt_code_exchange_uri=cognito.jwt_code_exchange_uri)
+
+    @app.route('/cognito/callback')
+    @callback_handler
+    def callback():
+        return ""
+
+    @app.route('/api')
+    @token_required
+    def api():
+        return ""
+
+    return BenchmarkContext(cognito, app, manager)
+
+
+def measure(name, fn, iterations, warmup=0, **extra):
+    """
+    Method to time `fn` over `iterations` calls.
+    :return result (dict):  Timing statistics of the scenario.
+    """
+    for _ in range(warmup):
+        fn()
+    timings = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    result = summarize(name, timings, elapsed)
+    result.update(extra)
+    return result
+
+
+def summarize(name, timings, elapsed):
+    timings = sorted(timings)
+    return {"name": name,
+            "iterations": len(timings),
+            "ops_per_sec": round(len(timings) / elapsed, 2) if elapsed else None,
+            "mean_ms": round(mean(timings) * 1000, 4),
+            "p50_ms": round(median(timings) * 1000, 4),
+            "p95_ms": round(timings[int(len(timings) * 0.95) - 1] * 1000, 4)
+            if len(timings) >= 20 else round(timings[-1] * 1000, 4)}
+
+
+def config_lookup_live(context, iterations):
+    config = Config()
+
+    def lookup():
+        return (config.client_id, config.redirect_uri, config.client_secret,
+                config.jwt_code_exchange_uri, config.login_uri)
+
+    with context.app.test_request_context():
+        return measure("config_lookup_live", lookup, iterations, warmup=10)
+
+
+def config_lookup_settings(context, iterations):
+    config = Config()
+
+    def lookup():
+        settings = config.settings
+        return (settings.client_id, settings.redirect_uri, settings.client_secret,
+                settings.jwt_code_exchange_uri, settings.login_uri)
+
+    with context.app.test_request_context():
+        return measure("config_lookup_settings", lookup, iterations, warmup=10)
+
+
+def verify_cold_cache(context, iterations):
+    key_cache = context.manager.key_cache
+
+    def cold_verify():
+        key_cache.clear()
+        verify(context.token)
+
+    fetches = context.cognito.counters["jwks"]
+    with context.app.test_request_context():
+        result = measure("verify_cold_cache", cold_verify, iterations, warmup=2)
+    result["jwks_fetches"] = context.cognito.counters["jwks"] - fetches
+    return result
+
+
+def verify_warm_cache(context, iterations):
+    fetches = context.cognito.counters["jwks"]
+    with context.app.test_request_context():
+        verify(context.token)
+        result = measure("verify_warm_cache", lambda: verify(context.token),
+                         iterations, warmup=10)
+    result["jwks_fetches"] = context.cognito.counters["jwks"] - fetches
+    return result
+
+
+class PurePythonJoseBackend(JoseBackend):
+    """
+    python-jose with its pure-python RSA backend, the speed of python-jose
+    when `cryptography` is not installed.
+    """
+
+    name = "jose-python-rsa"
+
+    def construct_key(self, key):
+        from jose.backends.rsa_backend import RSAKey
+        return RSAKey(key, key.get("alg", "RS256"))
+
+
+def verify_backends(context, iterations):
+    settings = context.manager.settings
+    header = jwt.get_unverified_header(context.token)
+    public_jwk = context.cognito.jwks["keys"][0]
+    backends = {}
+    backend_classes = dict(CRYPTO_BACKENDS)
+    backend_classes[PurePythonJoseBackend.name] = PurePythonJoseBackend
+    for name, backend_class in backend_classes.items():
+        backend = backend_class()
+        profile = ValidationProfile(settings.issuer, settings.client_id,
+                                    crypto_backend=backend)
+        key = backend.construct_key(public_jwk)
+        result = measure(name, lambda: profile.decode(context.token, header, key),
+                         iterations, warmup=10)
+        del result["name"]
+        backends[name] = result
+    result = dict(backends[DEFAULT_CRYPTO_BACKEND], name="verify_backends",
+                  default_backend=DEFAULT_CRYPTO_BACKEND, backends=backends)
+    return result
+
+
+def token_required_cached(context, iterations):
+    client = context.app.test_client()
+    headers = {"Authorization": f"Bearer {context.token}"}
+
+    def call():
+        response = client.get('/api', headers=headers)
+        assert response.status_code == 200, response.status_code
+
+    return measure("token_required_cached", call, iterations, warmup=10)
+
+
+def callback_concurrent(context, iterations, threads=8):
+    per_thread = max(iterations // threads, 1)
+    timings = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(index):
+        client = context.app.test_client()
+        local = []
+        for iteration in range(per_thread):
+            started = time.perf_counter()
+            response = client.get(f'/cognito/callback?code=user-{index}-{iteration}')
+            local.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+        with lock:
+            timings.extend(local)
+
+    tokens = context.cognito.counters["token"]
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    result = summarize("callback_concurrent", timings, elapsed)
+    result.update(threads=threads, errors=len(errors),
+                  token_requests=context.cognito.counters["token"] - tokens)
+    return result
+
+
+SCENARIOS = {
+    "config_lookup_live": config_lookup_live,
+    "config_lookup_settings": config_lookup_settings,
+    "verify_cold_cache": verify_cold_cache,
+    "verify_warm_cache": verify_warm_cache,
+    "verify_backends": verify_backends,
+    "token_required_cached": token_required_cached,
+    "callback_concurrent": callback_concurrent,
+}
+
+# Scenarios doing network or RSA work run fewer iterations
+ITERATION_SCALE = {
+    "config_lookup_live": 100,
+    "config_lookup_settings": 100,
+    "token_required_cached": 10,
+}
+
+
+def run(iterations=200, scenarios=None, key_bits=2048):
+    """
+    Method to run the benchmark scenarios.
+    :param iterations (int):    Base iteration count of the scenarios.
+    :param scenarios (list):    Names of the scenarios to run, default all.
+    :param key_bits (int):      Size of the stand-in RSA signing key.
+    :return report (dict):      JSON serializable benchmark report.
+    """
+    issuer = CognitoSettings.from_config(COGNITO_CONFIG).issuer
+    with FakeCognito(issuer=issuer,
+                     client_id=COGNITO_CONFIG['COGNITO_CLIENT_ID'],
+                     key_bits=key_bits) as cognito:
+        context = create_context(cognito)
+        results = []
+        for name in scenarios or SCENARIOS:
+            count = iterations * ITERATION_SCALE.get(name, 1)
+            results.append(SCENARIOS[name](context, count))
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "key_bits": key_bits,
+            "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--key-bits", type=int, default=2048)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Scenario to run, can be repeated. Default all.")
+    parser.add_argument("--output", help="File to write the JSON report to.")
+    args = parser.parse_args(argv)
+
+    report = run(iterations=args.iterations, scenarios=args.scenario,
+                 key_bits=args.key_bits)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+File to run a local stand-in of the AWS Cognito endpoints used by the
+extension, for benchmarks. It generates its own RSA signing key and serves:
+    * `/.well-known/jwks.json`  The public key set.
+    * `/oauth2/token`           Authorization code and refresh token grants,
+                                answered with freshly signed tokens.
+"""
+
+import json
+import time
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import rsa
+from jose import jwk
+from jose import jwt
+
+
+class FakeCognito(object):
+    """
+    Local AWS Cognito stand-in on a background thread.
+    """
+
+    def __init__(self, issuer, client_id, kid="fake-cognito-key", key_bits=2048,
+                 token_lifetime=3600, jwks_max_age=3600):
+        """
+        Create the stand-in, generating its RSA signing key.
+        :param issuer (str):        Issuer of the tokens, the user pool URL.
+        :param client_id (str):     App client id the tokens are issued to.
+        :param kid (str):           Key id of the signing key.
+        :param key_bits (int):      Size of the RSA signing key.
+        :param token_lifetime (int): Seconds the issued tokens are valid.
+        :param jwks_max_age (int):  Cache-Control max-age of the key set.
+        """
+        self.issuer = issuer
+        self.client_id = client_id
+        self.kid = kid
+        self.token_lifetime = token_lifetime
+        self.jwks_max_age = jwks_max_age
+        _, private_key = rsa.newkeys(key_bits)
+        self.private_pem = private_key.save_pkcs1().decode()
+        public_jwk = jwk.construct(self.private_pem, "RS256").public_key().to_dict()
+        public_jwk.update(kid=kid, use="sig")
+        self.jwks = {"keys": [public_jwk]}
+        self.counters = {"jwks": 0, "token": 0}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def public_key_uri(self):
+        return f"{self.url}/.well-known/jwks.json"
+
+    @property
+    def jwt_code_exchange_uri(self):
+        return f"{self.url}/oauth2/token"
+
+    def start(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="fake-cognito", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def sign(self, claims):
+        return jwt.encode(claims, self.private_pem, algorithm="RS256",
+                          headers={"kid": self.kid})
+
+    def issue_tokens(self, username="benchmark-user"):
+        """
+        Method to issue a signed access and id token pair.
+        :param username (str):  Username of the tokens.
+        :return tokens (dict):  Token endpoint response.
+        """
+        now = int(time.time())
+        exp = now + self.token_lifetime
+        access_token = self.sign({"sub": username, "iss": self.issuer,
+                                  "client_id": self.client_id,
+                                  "token_use": "access",
+                                  "scope": "openid email",
+                                  "username": username,
+                                  "iat": now, "exp": exp,
+                                  "jti": f"{username}-{now}-{time.monotonic_ns()}"})
+        id_token = self.sign({"sub": username, "iss": self.issuer,
+                              "aud": self.client_id,
+                              "token_use": "id",
+                              "cognito:username": username,
+                              "cognito:groups": ["benchmark"],
+                              "email": f"{username}@example.com",
+                              "iat": now, "exp": exp})
+        return {"access_token": access_token,
+                "id_token": id_token,
+                "refresh_token": f"refresh-{username}",
+                "expires_in": self.token_lifetime,
+                "token_type": "Bearer"}
+
+    def _handler(self):
+        cognito = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, avoid Nagle delays
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.endswith("/.well-known/jwks.json"):
+                    cognito.count("jwks")
+                    self._send(200, cognito.jwks,
+                               {"Cache-Control": f"max-age={cognito.jwks_max_age}"})
+                else:
+                    self._send(404, {"error": "not_found"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                form = parse_qs(self.rfile.read(length).decode())
+                if self.path != "/oauth2/token":
+                    self._send(404, {"error": "not_found"})
+                    return
+                cognito.count("token")
+                grant_type = form.get("grant_type", [None])[0]
+                if grant_type not in ("authorization_code", "refresh_token"):
+                    self._send(400, {"error": "unsupported_grant_type"})
+                    return
+                code = form.get("code", ["benchmark-user"])[0]
+                self._send(200, cognito.issue_tokens(username=code))
+
+            def _send(self, status, payload, headers=None):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
@@ -23,6 +23,9 @@ app.config["COGNITO_STATE"] = "mysupersecrethash"   # Optional
 # Specify this url in Callback URLs section of Appllication client settings of User Pool within AWS Cognito Sevice. Post login application will redirect to this URL
 app.config['COGNITO_REDIRECT_URI'] = "http://localhost:5000/cognito/callback"
 
+# Specify this url in Sign out URLs section of Appllication client settings of User Pool within AWS Cognito Sevice. Post logout application will redirect to this URL
+app.config['COGNITO_SIGNOUT_URI'] = "http://localhost:5000/login"
+
 
 cognito = CognitoAuthManager(app)
 
@@ -2,3 +2,32 @@ from .cognito_auth_manager import CognitoAuthManager
 from .decorators import login_handler
 from .decorators import logout_handler
 from .decorators import callback_handler
+from .decorators import token_required
+from .decorators import refresh_handler
+from .decorators import get_session_info
+from .decorators import verify_many
+from .decorators import groups_required
+from .decorators import revoke_tokens
+from .user import CognitoUser
+from .user import current_cognito_user
+from .token_store import TokenStore
+from .token_store import MemoryTokenStore
+from .token_store import RedisTokenStore
+from .async_decorators import async_login_handler
+from .async_decorators import async_logout_handler
+from .async_decorators import async_callback_handler
+from .async_decorators import async_revoke_tokens
+from .async_decorators import async_verify
+from .async_decorators import async_verify_tokens
+from .metrics import MetricsSink
+from .metrics import StatsdMetrics
+from .metrics import PrometheusMetrics
+from .events import AuthEvent
+from .events import EventSink
+from .events import LoggingEventSink
+from .revocation import Blocklist
+from .revocation import MemoryBlocklist
+from .revocation import RedisBlocklist
+from .login_state import StateStore
+from .login_state import MemoryStateStore
+from .login_state import RedisStateStore
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+"""
+File handle the asyncio decorators for AWS Cognito login / logout features,
+for Flask `async def` views and ASGI deployments.
+These are the counterparts of the decorators in `decorators.py`, with the
+code exchange and the JWKS fetch done by a non-blocking HTTP client so the
+event loop is not blocked while AWS Cognito responds.
+Requires the optional `httpx` dependency (`pip install flask-cognito-auth[async]`).
+"""
+
+import time
+import logging
+import requests
+from functools import wraps
+from flask import redirect
+from flask import request
+from jose import JWTError
+from .config import Config
+from .tokens import TokenSet
+from .validation import TOKEN_USE_ACCESS
+from .validation import TOKEN_USE_ID
+from .http_client import ASYNC_HTTP_ERRORS
+from .decorators import update_session
+from .decorators import get_session_info
+from .decorators import decode_token
+from .decorators import parse_token_header
+from .decorators import code_exchange_parameters
+from .decorators import complete_login
+from .decorators import auth_error_response
+from .decorators import login_redirect_uri
+from .decorators import consume_login_state
+from .decorators import check_nonce
+from .decorators import emit_event
+from .decorators import exchange_failure_reason
+from .decorators import KEY_FETCH_ERRORS
+from .events import LOGIN_REDIRECT
+from .events import CODE_EXCHANGED
+from .events import VERIFY_FAILED
+from .events import LOGOUT
+
+
+logger = logging.getLogger(__name__)
+config = Config()
+
+
+def async_login_handler(fn):
+    """
+    asyncio counterpart of :func:`login_handler`.
+    A decorator to redirect users to AWS Cognito login if they aren't already.
+    Use this decorator on the `async def` login endpoint.
+    """
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        aws_cognito_login = login_redirect_uri(config.settings)
+
+        # https://docs.aws.amazon.com/cognito/latest/developerguide/amazon-cognito-user-pools-using-tokens-with-identity-providers.html
+        res = redirect(aws_cognito_login)
+        emit_event(LOGIN_REDIRECT)
+        logger.debug("Got Cognito Login, redirecting to AWS Cognito for Auth")
+        return res
+    return wrapper
+
+
+def async_callback_handler(fn):
+    """
+    asyncio counterpart of :func:`callback_handler`.
+    A decorator to handle redirects from AWS Cognito login and signup. It
+    exchanges the code for tokens without blocking the event loop, verifies
+    them and pushes the basic informations in Flask session.
+    Use this decorator on the `async def` redirect endpoint.
+    """
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        auth_success = False
+        tokens = None
+        logger.debug(
+            "Authenticating AWS Cognito application / client, with code exchange.")
+
+        settings = config.settings
+        csrf_token = settings.state
+        csrf_state = None
+
+        if csrf_token:
+            csrf_state = request.args.get('state')
+
+        login = consume_login_state(settings)
+        if login is None:
+            emit_event(CODE_EXCHANGED, reason="state")
+            return auth_error_response(settings)
+
+        code = request.args.get('code')
+        request_parameters = code_exchange_parameters(settings, code,
+                                                      login.get('code_verifier'))
+        started = time.perf_counter()
+        try:
+            with config.metrics.timer("code_exchange.latency", {"grant_type": "authorization_code"}):
+                response = await config.async_http_client.post(
+                    settings.jwt_code_exchange_uri,
+                    data=request_parameters,
+                    auth=(settings.client_id, settings.client_secret))
+        except ASYNC_HTTP_ERRORS as e:
+            logger.warning(f"Code exchange with AWS Cognito failed: {e}")
+            response = None
+        emit_event(CODE_EXCHANGED, latency=time.perf_counter() - started,
+                   reason=exchange_failure_reason(response))
+
+        if response is not None and response.status_code == requests.codes.ok:
+            logger.debug("Code exchange is successfull, validating CSRF state.")
+
+            if csrf_state == csrf_token:
+
+                try:
+                    tokens = TokenSet.from_response(response.json())
+                except ValueError as e:
+                    logger.warning(f"Invalid AWS Cognito token response: {e}")
+
+            if tokens is not None:
+                try:
+                    await async_verify_tokens(tokens)
+                except JWTError as e:
+                    # Recorded as a verify_failed event by the verification
+                    logger.warning(f"AWS Cognito tokens are rejected: {e}")
+                    tokens = None
+                except ASYNC_HTTP_ERRORS + KEY_FETCH_ERRORS as e:
+                    logger.warning(f"Unable to get AWS Cognito JWKS: {e}")
+                    emit_event(VERIFY_FAILED, reason="jwks_unavailable")
+                    tokens = None
+            if tokens is not None:
+                if check_nonce(tokens, login):
+                    auth_success = True
+                    complete_login(tokens)
+                else:
+                    emit_event(VERIFY_FAILED, sub=tokens.id_claims.get('sub'), reason="nonce")
+        if not auth_success:
+            return auth_error_response(settings)
+        return await fn(*args, **kwargs)
+    return wrapper
+
+
+def async_logout_handler(fn):
+    """
+    asyncio counterpart of :func:`logout_handler`.
+    A decorator to logout from AWS Cognito and return to signout uri.
+    Use this decorator on the `async def` cognito logout endpoint.
+    """
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        info = get_session_info()
+        emit_event(LOGOUT, sub=info['id'])
+        await async_revoke_tokens({'origin_jti': info.get('origin_jti')},
+                                  expires_at=info['expires'],
+                                  refresh_token=info['refresh_token'])
+        update_session(username=None,
+                       id=None,
+                       groups=None,
+                       email=None,
+                       expires=None,
+                       refresh_token=None)
+        logger.debug(
+            "AWS Cognito Login, redirecting to AWS Cognito for logout and terminating sessions")
+
+        aws_cognito_logout = config.settings.logout_uri
+
+        # https://docs.aws.amazon.com/cognito/latest/developerguide/amazon-cognito-user-pools-using-tokens-with-identity-providers.html
+        res = redirect(aws_cognito_logout)
+        return res
+    return wrapper
+
+
+async def async_revoke_tokens(claims: dict, expires_at: float = None,
+                              refresh_token: str = None):
+    """
+    asyncio counterpart of :func:`revoke_tokens`, the refresh token is
+    revoked at AWS Cognito without blocking the event loop.
+    :param claims (dict):       Claims of a token, e.g. `g.cognito_claims`.
+    :param expires_at (float):  Epoch seconds to keep the ids, the "exp"
+                                claim if None.
+    :param refresh_token (str): Refresh token of the authentication.
+    """
+    if config.blocklist.revoke(claims, expires_at):
+        logger.debug("AWS Cognito tokens are revoked.")
+
+    settings = config.settings
+    if refresh_token and settings.revoke_on_logout:
+        try:
+            with config.metrics.timer("revoke.latency"):
+                response = await config.async_http_client.post(
+                    settings.revoke_uri,
+                    data={'token': refresh_token, 'client_id': settings.client_id},
+                    auth=(settings.client_id, settings.client_secret))
+            response.raise_for_status()
+        except ASYNC_HTTP_ERRORS as e:
+            logger.warning(f"Revocation of the AWS Cognito refresh token failed: {e}")
+
+
+async def async_verify(token: str, access_token: str = None, token_use: str = None):
+    """
+    asyncio counterpart of :func:`verify`. A JWKS fetch, if needed, does not
+    block the event loop and is shared by concurrent callers.
+    :param token (str):         A signed JWS to be verified.
+    :param access_token (str):  An access token string to validate the
+                                "at_hash" claim.
+    :param token_use (str):     Expected "token_use" claim, any if None.
+    :return id_token (dict):    The dict representation of the claims set.
+    """
+    header, tenant = parse_token_header(token)
+    key = await tenant.async_key_cache.get_key(
+        tenant.settings.public_key_uri, header.get('kid'))
+    return decode_token(token, header, key, access_token, token_use,
+                        tenant.validation)
+
+
+async def async_verify_tokens(tokens: TokenSet):
+    """
+    asyncio counterpart of :func:`verify_tokens`.
+    :param tokens (TokenSet):   Tokens from the AWS Cognito token endpoint.
+    :return tokens (TokenSet):  The same token set with `access_claims` and
+                                `id_claims` set.
+    """
+    tokens.access_claims = await async_verify(tokens.access_token,
+                                              token_use=TOKEN_USE_ACCESS)
+    tokens.id_claims = await async_verify(tokens.id_token, tokens.access_token,
+                                          token_use=TOKEN_USE_ID)
+    return tokens
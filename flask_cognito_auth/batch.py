@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""
+File to verify batches of AWS Cognito tokens, see :func:`verify_many`.
+The functions here do not use the Flask application context, so the
+signature checks can run on the threads or processes of an executor.
+"""
+
+DEFAULT_VERIFY_CHUNK_SIZE = 64
+
+
+class VerificationResult(object):
+    """
+    Outcome of the verification of one token of a batch: the claims set if
+    the token is valid, the error otherwise.
+    """
+
+    __slots__ = ("token", "claims", "error")
+
+    def __init__(self, token: str, claims: dict = None, error: Exception = None):
+        """
+        Create the verification result.
+        :param token (str):         The verified token.
+        :param claims (dict):       The claims set of a valid token.
+        :param error (Exception):   The error of an invalid token, a
+                                    JWTError or the error of the JWKS fetch.
+        """
+        self.token = token
+        self.claims = claims
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        # Never put the tokens in logs
+        return f"VerificationResult(ok={self.ok!r}, error={self.error!r})"
+
+
+def chunks(items: list, size: int):
+    """
+    Method to split a list in chunks of at most `size` items.
+    """
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def verify_chunk(validation, key, items: list, token_use: str = None):
+    """
+    Method to verify tokens signed with the same key.
+    :param validation (ValidationProfile): Validation profile of the app.
+    :param key:                 Public key of the tokens, or its JWK dict
+                                when run in another process.
+    :param items (list):        List of (token, unverified header) tuples.
+    :param token_use (str):     Expected "token_use" claim, any if None.
+    :return results (list):     A :class:`VerificationResult` per token.
+    A failure is the result of its token, it never fails the chunk.
+    """
+    if isinstance(key, dict):
+        try:
+            key = validation.crypto_backend.construct_key(key)
+        except Exception as e:
+            return [VerificationResult(token, error=e) for token, _ in items]
+    results = []
+    for token, header in items:
+        try:
+            claims = validation.decode(token, header, key, token_use=token_use)
+        except Exception as e:
+            results.append(VerificationResult(token, error=e))
+        else:
+            results.append(VerificationResult(token, claims=claims))
+    return results
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""
+File to fail fast while AWS Cognito is degraded. After `threshold`
+consecutive failed calls the circuit opens and calls are refused for
+`cooldown` seconds, so worker threads do not pile up on timeouts. After the
+cooldown one trial call is let through: its success closes the circuit, its
+failure opens it for another cooldown.
+"""
+
+import time
+import logging
+import threading
+from .exceptions import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_COOLDOWN = 30
+
+
+class CircuitBreaker(object):
+    """
+    Thread safe circuit breaker of an AWS Cognito HTTP client.
+    """
+
+    def __init__(self, threshold=DEFAULT_BREAKER_THRESHOLD,
+                 cooldown=DEFAULT_BREAKER_COOLDOWN):
+        """
+        Create the circuit breaker.
+        :param threshold (int):     Consecutive failures opening the circuit,
+                                    0 to never open it.
+        :param cooldown (float):    Seconds to refuse calls once open.
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def before_call(self):
+        """
+        Method to check that a call may be made.
+        :raises CircuitOpenError: If the circuit is open.
+        """
+        if self._opened_at is None:
+            return
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if not self._trial and time.monotonic() - self._opened_at >= self.cooldown:
+                # Half open: this call is the trial, the others still fail fast
+                self._trial = True
+                return
+        raise CircuitOpenError("AWS Cognito circuit breaker is open.")
+
+    def record_success(self):
+        if self._failures == 0 and self._opened_at is None:
+            return
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("AWS Cognito is reachable again, closing the circuit breaker.")
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        if not self.threshold:
+            return
+        with self._lock:
+            self._failures += 1
+            if self._trial or (self._opened_at is None and self._failures >= self.threshold):
+                logger.warning(f"AWS Cognito failed {self._failures} times, "
+                               f"failing fast for {self.cooldown} seconds.")
+                self._opened_at = time.monotonic()
+                self._trial = False
@@ -4,6 +4,43 @@
 File to initalize the AWS Cognito authentor manager.
 """
 
+import logging
+from flask import g
+from flask import request
+from flask import has_request_context
+from jose import jwt
+from jose import JWTError
+from .crypto import get_crypto_backend
+from .http_client import CognitoHttpClient
+from .http_client import AsyncCognitoHttpClient
+from .jwks import JwksCache
+from .jwks import AsyncJwksCache
+from .jwks import JwksRefresher
+from .jwks import DEFAULT_JWKS_REFRESH_AHEAD
+from .jwks import DEFAULT_JWKS_RETRY_INTERVAL
+from .token_cache import VerifiedTokenCache
+from .tenants import CognitoTenant
+from .tenants import TenantRegistry
+from .tenants import DEFAULT_TENANT
+from .singleflight import SingleFlight
+from .metrics import Metrics
+from .events import AuthEvents
+from .events import DEFAULT_EVENTS_BATCH_SIZE
+from .events import DEFAULT_EVENTS_FLUSH_INTERVAL
+from .revocation import MemoryBlocklist
+from .revocation import DEFAULT_BLOCKLIST_SIZE
+from .login_state import MemoryStateStore
+from .login_state import DEFAULT_STATE_STORE_SIZE
+from .decorators import refresh_before_request
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_RESULT_TTL = 30
+# Attributes a CognitoTenant holds for its user pool / app client
+TENANT_ATTRIBUTES = ("settings", "crypto_backend", "validation", "http_client",
+                     "key_cache", "async_http_client", "async_key_cache",
+                     "token_cache")
+
 
 class CognitoAuthManager(object):
     """
@@ -15,23 +52,194 @@ class CognitoAuthManager(object):
     Lazy initalization is supported for configuring the application.
     """
 
-    def __init__(self, app=None):
+    def __init__(self, app=None, token_store=None, metrics=None, blocklist=None,
+                 state_store=None, events=None):
         """
         Create the CognitoAuthManager instance. You can either pass a flask
         application in directly to register the extension with the flask app,
         or call init_app (lazy initalization) after creating the object
         (in a factory pattern).
         :param app: A flask application
+        :param token_store: Optional :class:`TokenStore` to keep the session
+                            informations on the server, the session cookie
+                            then only carries an opaque session id.
+        :param metrics: Optional :class:`MetricsSink` or list of sinks to
+                        record auth latencies and counters, disabled if None.
+        :param blocklist: Optional :class:`Blocklist` of revoked tokens, e.g.
+                          a :class:`RedisBlocklist` shared by all processes.
+                          An in memory blocklist is used if None.
+        :param state_store: Optional :class:`StateStore` of the pending
+                            logins with COGNITO_LOGIN_STATE, e.g. a
+                            :class:`RedisStateStore` shared by all processes.
+                            An in memory store is used if None.
+        :param events: Optional :class:`EventSink` or list of sinks to record
+                       the authentication events, disabled if None.
         """
+        self.name = DEFAULT_TENANT
+        self.settings = None
+        self.validation = None
+        self.token_store = token_store
+        self.metrics = Metrics(metrics)
+        self.events = AuthEvents(events)
+        self.phase_timing = None
+        self.server_timing = False
+        self.blocklist = blocklist
+        self.state_store = state_store
+        self.crypto_backend = get_crypto_backend()
+        self.http_client = CognitoHttpClient()
+        self.key_cache = JwksCache(http_client=self.http_client,
+                                   metrics=self.metrics,
+                                   crypto_backend=self.crypto_backend)
+        self.async_http_client = AsyncCognitoHttpClient()
+        self.async_key_cache = AsyncJwksCache(self.key_cache,
+                                              self.async_http_client)
+        self.token_cache = VerifiedTokenCache()
+        self.tenants = TenantRegistry()
+        self.key_refresher = None
+        self.refresh_flight = SingleFlight(result_ttl=DEFAULT_REFRESH_RESULT_TTL)
+        # Concurrent callbacks with the same code exchange it once
+        self.exchange_flight = SingleFlight()
         if app is not None:
             self.init(app)
-        self.jwt_key = None
+
+    @property
+    def jwt_key(self):
+        """
+        The cached AWS Cognito JSON Web Key Set, None if not yet fetched.
+        """
+        return self.key_cache.keys
+
+    @jwt_key.setter
+    def jwt_key(self, keys):
+        if keys is None:
+            self.key_cache.clear()
+        else:
+            self.key_cache.set(keys)
+
+    @property
+    def keys_loaded(self):
+        """
+        True if the AWS Cognito JWKS is loaded, for readiness probes.
+        """
+        return self.key_cache.keys is not None
+
+    def warm_up(self):
+        """
+        Method to fetch and parse the AWS Cognito JWKS now, so the first
+        request does not pay for it. A failure is logged and the key set is
+        fetched on first use instead.
+        :return loaded (bool): True if the key set is loaded.
+        """
+        for tenant in self.tenants:
+            try:
+                tenant.key_cache.refresh(tenant.settings.public_key_uri)
+            except Exception as e:
+                logger.warning(f"AWS Cognito JWKS warm-up of {tenant.name} failed: {e}")
+        return self.keys_loaded
+
+    def current_tenant(self):
+        """
+        Method to get the tenant of the current request, resolved once per
+        request by host or path prefix and kept in `flask.g.cognito_tenant`.
+        :return tenant:         The :class:`CognitoTenant`, or the manager
+                                itself for the default tenant.
+        """
+        if len(self.tenants) < 2 or not has_request_context():
+            return self
+        tenant = g.get('cognito_tenant')
+        if tenant is None:
+            tenant = self.tenants.for_request(request) or self
+            g.cognito_tenant = tenant
+        return tenant
+
+    def tenant_for_token(self, token: str):
+        """
+        Method to get the tenant verifying a token. A request resolved to a
+        tenant by host or path prefix only accepts the tokens of that
+        tenant; other requests resolve the tenant by the unverified "iss"
+        claim of the token, the default tenant if unknown.
+        :param token (str):     A signed JWS.
+        :return tenant:         The :class:`CognitoTenant` or the manager.
+        """
+        tenant = self.current_tenant()
+        if tenant is not self:
+            return tenant
+        if len(self.tenants) < 2:
+            return self
+        try:
+            issuer = jwt.get_unverified_claims(token).get('iss')
+        except JWTError:
+            return self
+        return self.tenants.for_issuer(issuer) or self
 
     def init(self, app):
         """
-        Register this extension with the flask app.
+        Register this extension with the flask app. The AWS Cognito settings
+        are validated and resolved once here.
         :param app: A flask application
+        :raises RuntimeError: If a required setting is missing.
         """
+        # The app config is the default tenant, served by the manager itself
+        tenant = CognitoTenant(DEFAULT_TENANT, app.config, metrics=self.metrics)
+        self.http_client.close()
+        self.async_http_client.close()
+        for other in self.tenants:
+            if other is not self:
+                other.close()
+        for name in TENANT_ATTRIBUTES:
+            setattr(self, name, getattr(tenant, name))
+        self.tenants = TenantRegistry()
+        self.tenants.register(self, resolvable=False)
+        for name, overrides in (app.config.get("COGNITO_TENANTS") or {}).items():
+            self.tenants.register(CognitoTenant.from_app_config(
+                name, app.config, overrides, metrics=self.metrics))
+        if self.blocklist is None:
+            self.blocklist = MemoryBlocklist(
+                maxsize=app.config.get("COGNITO_BLOCKLIST_SIZE",
+                                       DEFAULT_BLOCKLIST_SIZE),
+                fail_closed=app.config.get("COGNITO_BLOCKLIST_FAIL_CLOSED", False))
+        if self.state_store is None:
+            self.state_store = MemoryStateStore(
+                maxsize=app.config.get("COGNITO_STATE_STORE_SIZE",
+                                       DEFAULT_STATE_STORE_SIZE))
+        self.events.close()
+        self.events = AuthEvents(
+            self.events.sinks,
+            batch_size=app.config.get("COGNITO_EVENTS_BATCH_SIZE",
+                                      DEFAULT_EVENTS_BATCH_SIZE),
+            flush_interval=app.config.get("COGNITO_EVENTS_FLUSH_INTERVAL",
+                                          DEFAULT_EVENTS_FLUSH_INTERVAL))
+        # Per-phase timings of the requests: a bool, a rate or a callable
+        self.phase_timing = app.config.get("COGNITO_PHASE_TIMING")
+        self.server_timing = bool(app.config.get("COGNITO_SERVER_TIMING"))
+        # Concurrent requests of a session refresh its tokens once
+        self.refresh_flight = SingleFlight(
+            result_ttl=app.config.get("COGNITO_REFRESH_RESULT_TTL",
+                                      DEFAULT_REFRESH_RESULT_TTL))
+        # Registered once, init may run again on the same app
+        if (app.config.get("COGNITO_REFRESH_ON_REQUEST")
+                and refresh_before_request not in app.before_request_funcs.get(None, ())):
+            app.before_request(refresh_before_request)
+
+        # Opt-in JWKS warm-up: "blocking" or "background"
+        warmup = app.config.get("COGNITO_JWKS_WARMUP")
+        background_refresh = app.config.get("COGNITO_JWKS_BACKGROUND_REFRESH", False)
+        if self.key_refresher is not None:
+            self.key_refresher.stop()
+            self.key_refresher = None
+        if warmup == "blocking":
+            self.warm_up()
+        if warmup == "background" or background_refresh:
+            self.key_refresher = JwksRefresher(
+                self.key_cache,
+                self.settings.public_key_uri,
+                refresh_ahead=app.config.get("COGNITO_JWKS_REFRESH_AHEAD",
+                                             DEFAULT_JWKS_REFRESH_AHEAD),
+                retry_interval=app.config.get("COGNITO_JWKS_RETRY_INTERVAL",
+                                              DEFAULT_JWKS_RETRY_INTERVAL),
+                once=not background_refresh)
+            self.key_refresher.start()
+
         # Save this so we can use it later in the extension
         if not hasattr(app, 'extensions'):   # pragma: no cover
             app.extensions = {}
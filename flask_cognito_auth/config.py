@@ -7,10 +7,13 @@ File to handle the configurations.
 import os
 import logging
 from flask import current_app
-import requests
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_REFRESH_LEEWAY = 300
+DEFAULT_TOKEN_STORE_TTL = 30 * 24 * 3600
+DEFAULT_LOGIN_STATE_TTL = 600
+
 
 class Config(object):
     """
@@ -19,6 +22,20 @@ class Config(object):
     (alias: `app.config`).
     """
 
+    def __init__(self, app_config=None):
+        """
+        Create the config wrapper.
+        :param app_config (dict): Flask application config to read, defaults
+                                  to the config of `current_app`.
+        """
+        self._app_config = app_config
+
+    @property
+    def app_config(self):
+        if self._app_config is not None:
+            return self._app_config
+        return current_app.config
+
     @property
     def get_auth_manager(self):
         auth_manager = current_app.extensions.get("cognito-flask-auth")
@@ -30,12 +47,13 @@ class Config(object):
         return auth_manager
 
     def get_config_value(self, key, error_message, is_key_required, is_value_required):
-        if key not in current_app.config and is_key_required:
+        app_config = self.app_config
+        if key not in app_config and is_key_required:
             raise RuntimeError(error_message)
 
         value = None
-        if key in current_app.config:
-            value = current_app.config[key]
+        if key in app_config:
+            value = app_config[key]
 
         if is_value_required and not value:
             raise RuntimeError(error_message)
@@ -122,6 +140,46 @@ class Config(object):
                                         is_value_required=False)
         return methods if methods else ["OPTIONS"]
 
+    @property
+    def refresh_leeway(self):
+        leeway = self.get_config_value(key="COGNITO_REFRESH_LEEWAY",
+                                       error_message=None,
+                                       is_key_required=False,
+                                       is_value_required=False)
+        return DEFAULT_REFRESH_LEEWAY if leeway is None else int(leeway)
+
+    @property
+    def token_store_ttl(self):
+        ttl = self.get_config_value(key="COGNITO_TOKEN_STORE_TTL",
+                                    error_message=None,
+                                    is_key_required=False,
+                                    is_value_required=False)
+        return DEFAULT_TOKEN_STORE_TTL if ttl is None else int(ttl)
+
+    @property
+    def revoke_on_logout(self):
+        revoke = self.get_config_value(key="COGNITO_REVOKE_ON_LOGOUT",
+                                       error_message=None,
+                                       is_key_required=False,
+                                       is_value_required=False)
+        return bool(revoke)
+
+    @property
+    def login_state(self):
+        login_state = self.get_config_value(key="COGNITO_LOGIN_STATE",
+                                            error_message=None,
+                                            is_key_required=False,
+                                            is_value_required=False)
+        return bool(login_state)
+
+    @property
+    def login_state_ttl(self):
+        ttl = self.get_config_value(key="COGNITO_LOGIN_STATE_TTL",
+                                    error_message=None,
+                                    is_key_required=False,
+                                    is_value_required=False)
+        return DEFAULT_LOGIN_STATE_TTL if ttl is None else int(ttl)
+
     @property
     def issuer(self):
         return f"https://cognito-idp.{self.region}.amazonaws.com/{self.user_pool_id}"
@@ -134,19 +192,85 @@ class Config(object):
     def jwt_code_exchange_uri(self):
         return f"{self.domain}/oauth2/token"
 
+    @property
+    def revoke_uri(self):
+        return f"{self.domain}/oauth2/revoke"
+
+    @property
+    def tenant(self):
+        # user pool / app client of the current request
+        return self.get_auth_manager.current_tenant()
+
+    @property
+    def settings(self):
+        return self.tenant.settings
+
     @property
     def jwt_cognito_key(self):
-        auth_manager = self.get_auth_manager
-        # load and cache cognito JSON Web Key (JWK)
-        jwt_key = None
-        if not auth_manager.jwt_key:
-            jwt_key = requests.get(self.public_key_uri).json()["keys"]
-        else:
-            jwt_key = auth_manager.jwt_key
-        return jwt_key
+        # load and cache cognito JSON Web Key Set (JWKS)
+        tenant = self.tenant
+        return tenant.key_cache.get_keys(tenant.settings.public_key_uri)
+
+    def get_jwt_cognito_key(self, kid, tenant=None):
+        """
+        Method to get the cached cognito public key for a key id.
+        :param kid (str):           Key id from the JWT header.
+        :param tenant:              Tenant of the token, the tenant of the
+                                    current request if None.
+        :return key:                The matching public key or None if not found.
+        """
+        tenant = tenant or self.tenant
+        return tenant.key_cache.get_key(tenant.settings.public_key_uri, kid)
+
+    @property
+    def http_client(self):
+        return self.tenant.http_client
+
+    @property
+    def async_http_client(self):
+        return self.tenant.async_http_client
+
+    @property
+    def blocklist(self):
+        return self.get_auth_manager.blocklist
+
+    @property
+    def refresh_flight(self):
+        return self.get_auth_manager.refresh_flight
+
+    @property
+    def exchange_flight(self):
+        return self.get_auth_manager.exchange_flight
+
+    @property
+    def state_store(self):
+        return self.get_auth_manager.state_store
+
+    @property
+    def token_store(self):
+        return self.get_auth_manager.token_store
+
+    @property
+    def validation(self):
+        return self.tenant.validation
+
+    @property
+    def metrics(self):
+        return self.get_auth_manager.metrics
+
+    @property
+    def events(self):
+        return self.get_auth_manager.events
+
+    @property
+    def token_cache(self):
+        return self.tenant.token_cache
 
     @property
     def state(self):
+        # A random state per login replaces the static one
+        if self.login_state:
+            return None
         csrf_state = self.get_config_value(key="COGNITO_STATE",
                                            error_message=None,
                                            is_key_required=False,
@@ -167,3 +291,74 @@ class Config(object):
     def logout_uri(self):
         return (f"{self.domain}/logout?response_type=code"
                 f"&client_id={self.client_id}&logout_uri={self.signout_uri}")
+
+
+class CognitoSettings(object):
+    """
+    Immutable AWS Cognito settings resolved and validated once when the
+    extension is registered with the flask app, with the endpoint URIs
+    precomputed. The decorators read this object on the request path.
+    """
+
+    __slots__ = ("client_id", "client_secret", "user_pool_id", "region",
+                 "domain", "redirect_uri", "redirect_error_uri",
+                 "signout_uri", "exempt_methods", "state",
+                 "refresh_leeway", "token_store_ttl", "revoke_on_logout",
+                 "login_state", "login_state_ttl",
+                 "issuer", "public_key_uri", "jwt_code_exchange_uri",
+                 "revoke_uri", "login_uri", "logout_uri")
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CognitoSettings is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("CognitoSettings is immutable")
+
+    def replace(self, **values):
+        """
+        Method to create a copy of the settings with some values replaced.
+        :param values: Settings to replace, e.g. `public_key_uri=...`.
+        :return settings (CognitoSettings): The new settings.
+        """
+        current = {name: getattr(self, name) for name in self.__slots__}
+        current.update(values)
+        return CognitoSettings(**current)
+
+    def __repr__(self):
+        return (f"CognitoSettings(client_id={self.client_id!r}, "
+                f"issuer={self.issuer!r}, domain={self.domain!r})")
+
+    @classmethod
+    def from_config(cls, app_config):
+        """
+        Method to resolve and validate the settings from the flask
+        application config.
+        :param app_config (dict): Flask application config (alias: `app.config`).
+        :raises RuntimeError:     If a required setting is missing.
+        """
+        config = Config(app_config)
+        return cls(client_id=config.client_id,
+                   client_secret=config.client_secret,
+                   user_pool_id=config.user_pool_id,
+                   region=config.region,
+                   domain=config.domain,
+                   redirect_uri=config.redirect_uri,
+                   redirect_error_uri=config.redirect_error_uri,
+                   signout_uri=config.signout_uri,
+                   exempt_methods=frozenset(config.exempt_methods),
+                   state=config.state,
+                   refresh_leeway=config.refresh_leeway,
+                   token_store_ttl=config.token_store_ttl,
+                   revoke_on_logout=config.revoke_on_logout,
+                   login_state=config.login_state,
+                   login_state_ttl=config.login_state_ttl,
+                   issuer=config.issuer,
+                   public_key_uri=config.public_key_uri,
+                   jwt_code_exchange_uri=config.jwt_code_exchange_uri,
+                   revoke_uri=config.revoke_uri,
+                   login_uri=config.login_uri,
+                   logout_uri=config.logout_uri)
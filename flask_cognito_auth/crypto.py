@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""
+File to verify the JWS signature of the AWS Cognito tokens with a pluggable
+crypto backend.
+    * jose            python-jose, always available.
+    * cryptography    RSA verification done directly by the OpenSSL bindings
+                      of the `cryptography` package, an optional dependency
+                      (`pip install flask-cognito-auth[cryptography]`),
+                      without the JWS layer of python-jose.
+Without `cryptography`, python-jose verifies with pure-python RSA, several
+times slower. The fastest available backend is picked at import; set
+`COGNITO_CRYPTO_BACKEND` to choose one. The claims are validated by the
+:class:`ValidationProfile`, the same way for every backend.
+"""
+
+import json
+import base64
+import binascii
+from jose import jwk
+from jose import jws
+from jose import JWTError
+from jose.exceptions import JWSError
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives.asymmetric import rsa
+except ImportError:   # pragma: no cover
+    rsa = None
+
+DEFAULT_KEY_ALGORITHM = "RS256"
+SIGNATURE_ERROR = "Signature verification failed."
+
+
+def base64url_decode(segment: str):
+    """
+    Method to decode an unpadded base64url segment of a JWS.
+    :param segment (str):   Base64url encoded segment.
+    :return data (bytes):   Decoded segment.
+    """
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+def parse_claims(payload: bytes):
+    """
+    Method to read the claims set of a verified JWS payload.
+    :param payload (bytes): Payload of the token.
+    :return claims (dict):  The claims set.
+    :raises JWTError:       If the payload is not a JSON object.
+    """
+    try:
+        claims = json.loads(payload)
+    except ValueError as e:
+        raise JWTError(f"Invalid payload string: {e}")
+    if not isinstance(claims, dict):
+        raise JWTError("Invalid payload string: must be a json object")
+    return claims
+
+
+class CryptoBackend(object):
+    """
+    Interface of the signature verification backends.
+    """
+
+    name = None
+
+    def __reduce__(self):
+        # Backends are stateless, a worker process creates its own
+        return (self.__class__, ())
+
+    def construct_key(self, key: dict):
+        """
+        Method to construct a public key once, when the JWKS is loaded.
+        :param key (dict):  A JWK dict of the key set.
+        :return key:        Backend specific public key.
+        """
+        raise NotImplementedError
+
+    def verify(self, token: str, key, algorithms: list):
+        """
+        Method to verify the signature of a token.
+        :param token (str):         A signed JWS.
+        :param key:                 Public key from :meth:`construct_key`.
+        :param algorithms (list):   Accepted signing algorithms.
+        :return claims (dict):      The claims set, not yet validated.
+        :raises JWTError:           If the signature is not valid.
+        """
+        raise NotImplementedError
+
+
+class JoseBackend(CryptoBackend):
+    """
+    Backend on python-jose, which itself uses its pure-python RSA backend
+    unless `cryptography` is installed.
+    """
+
+    name = "jose"
+
+    def construct_key(self, key):
+        return jwk.construct(key, key.get("alg", DEFAULT_KEY_ALGORITHM))
+
+    def verify(self, token, key, algorithms):
+        try:
+            payload = jws.verify(token, key, algorithms)
+        except JWSError as e:
+            raise JWTError(e)
+        return parse_claims(payload)
+
+
+class CryptographyBackend(CryptoBackend):
+    """
+    Backend verifying the RSA PKCS#1 v1.5 signatures with `cryptography`.
+    """
+
+    name = "cryptography"
+
+    def __init__(self):
+        if rsa is None:
+            raise RuntimeError("cryptography must be installed to use the cryptography backend.")
+        # Padding and hash instances are stateless, built once
+        self.padding = padding.PKCS1v15()
+        self.hashes = {"RS256": hashes.SHA256(),
+                       "RS384": hashes.SHA384(),
+                       "RS512": hashes.SHA512()}
+
+    def construct_key(self, key):
+        if key.get("kty") != "RSA":
+            raise ValueError(f"Unsupported key type: {key.get('kty')}")
+        numbers = rsa.RSAPublicNumbers(
+            int.from_bytes(base64url_decode(key["e"]), "big"),
+            int.from_bytes(base64url_decode(key["n"]), "big"))
+        return numbers.public_key()
+
+    def verify(self, token, key, algorithms):
+        try:
+            signing_input, _, signature_segment = token.rpartition(".")
+            header_segment, payload_segment = signing_input.split(".")
+            header = json.loads(base64url_decode(header_segment))
+            payload = base64url_decode(payload_segment)
+            signature = base64url_decode(signature_segment)
+            signing_input = signing_input.encode("ascii")
+        except (ValueError, TypeError, AttributeError, binascii.Error) as e:
+            raise JWTError(f"Invalid token: {e}")
+
+        algorithm = header.get("alg") if isinstance(header, dict) else None
+        if algorithm not in algorithms or algorithm not in self.hashes:
+            raise JWTError("The specified alg value is not allowed")
+        try:
+            key.verify(signature, signing_input, self.padding, self.hashes[algorithm])
+        except InvalidSignature:
+            raise JWTError(SIGNATURE_ERROR)
+        return parse_claims(payload)
+
+
+def available_crypto_backends():
+    """
+    Method to list the crypto backends usable in this environment.
+    :return backends (dict): Dict of backend name to backend class, the
+                             fastest first.
+    """
+    backends = {}
+    if rsa is not None:
+        backends[CryptographyBackend.name] = CryptographyBackend
+    backends[JoseBackend.name] = JoseBackend
+    return backends
+
+
+CRYPTO_BACKENDS = available_crypto_backends()
+DEFAULT_CRYPTO_BACKEND = next(iter(CRYPTO_BACKENDS))
+
+
+def get_crypto_backend(name: str = None):
+    """
+    Method to create a crypto backend.
+    :param name (str):  Name of the backend, the fastest available if None.
+    :return backend (CryptoBackend): The backend.
+    :raises RuntimeError: If the backend is not available.
+    """
+    name = name or DEFAULT_CRYPTO_BACKEND
+    if name not in CRYPTO_BACKENDS:
+        raise RuntimeError(
+            f"COGNITO_CRYPTO_BACKEND must be one of {', '.join(CRYPTO_BACKENDS)}.")
+    return CRYPTO_BACKENDS[name]()
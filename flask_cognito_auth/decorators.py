@@ -4,17 +4,44 @@
 File handle the decorators for AWS Cognito login / logout features.
 On successfull login, add "groups" in session object if user is
 part of AWS Cognito group. This helps application for authorization.
+APIs are protected with the bearer token decorator.
 """
 
+import time
 import logging
 import json
 import requests
 from requests.auth import HTTPBasicAuth
 from functools import wraps
+from concurrent.futures import ProcessPoolExecutor
 from flask import redirect
 from flask import request
+from flask import g
 from jose import jwt
+from jose import JWTError
 from .config import Config
+from .exceptions import KeyNotFoundError
+from .exceptions import TokenRevokedError
+from .exceptions import RefreshRejectedError
+from .metrics import failure_reason
+from .events import LOGIN_REDIRECT
+from .events import CODE_EXCHANGED
+from .events import TOKEN_VERIFIED
+from .events import VERIFY_FAILED
+from .events import LOGOUT
+from .tokens import TokenSet
+from .batch import VerificationResult
+from .batch import DEFAULT_VERIFY_CHUNK_SIZE
+from .batch import chunks
+from .batch import verify_chunk
+from .validation import TOKEN_USE_ACCESS
+from .validation import TOKEN_USE_ID
+from .token_cache import token_hash
+from .token_store import new_session_id
+from .tenants import DEFAULT_TENANT
+from .timing import get_phase_timer
+from .login_state import new_login_state
+from .login_state import code_challenge
 from flask import session
 from flask import url_for
 
@@ -22,6 +49,14 @@ from flask import url_for
 logger = logging.getLogger(__name__)
 config = Config()
 
+SESSION_ID_KEY = 'cognito_sid'
+SESSION_INFO_KEYS = ('username', 'id', 'groups', 'email', 'expires',
+                     'refresh_token', 'origin_jti')
+SESSION_TENANT_KEY = 'cognito_tenant'
+# Errors of a key set fetch without stale keys: the JWKS endpoint is down
+# or its circuit breaker open, or the key set is missing or malformed
+KEY_FETCH_ERRORS = (requests.RequestException, OSError, ValueError)
+
 
 def login_handler(fn):
     """
@@ -33,15 +68,80 @@ def login_handler(fn):
     """
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        aws_cognito_login = config.login_uri
+        aws_cognito_login = login_redirect_uri(config.settings)
 
         # https://docs.aws.amazon.com/cognito/latest/developerguide/amazon-cognito-user-pools-using-tokens-with-identity-providers.html
         res = redirect(aws_cognito_login)
-        logger.info("Got Cognito Login, redirecting to AWS Cognito for Auth")
+        emit_event(LOGIN_REDIRECT)
+        logger.debug("Got Cognito Login, redirecting to AWS Cognito for Auth")
         return res
     return wrapper
 
 
+def emit_event(type: str, sub: str = None, latency: float = None, reason: str = None):
+    """
+    Method to record an authentication event of the current request, if
+    an event sink is set on the manager.
+    :param type (str):      Event type, e.g. `login_redirect`.
+    :param sub (str):       AWS Cognito user id, the "sub" claim.
+    :param latency (float): Seconds taken by the step.
+    :param reason (str):    Reason of a failure.
+    """
+    events = config.events
+    if events.enabled:
+        events.emit(type, config.tenant.name, sub, latency, reason)
+
+
+def login_redirect_uri(settings):
+    """
+    Method to build the AWS Cognito login URI. With COGNITO_LOGIN_STATE set,
+    a random state, a PKCE code challenge and a nonce are added and kept in
+    the state store until the callback.
+    :param settings (CognitoSettings):  Resolved AWS Cognito settings.
+    :return uri (str):                  The AWS Cognito authorize URI.
+    """
+    if not settings.login_state:
+        return settings.login_uri
+    state, login = new_login_state()
+    config.state_store.put(state, login, settings.login_state_ttl)
+    return (f"{settings.login_uri}&state={state}"
+            f"&code_challenge={code_challenge(login['code_verifier'])}"
+            f"&code_challenge_method=S256&nonce={login['nonce']}")
+
+
+def consume_login_state(settings):
+    """
+    Method to consume the login state of the callback request, so each
+    login redirect is accepted once.
+    :param settings (CognitoSettings):  Resolved AWS Cognito settings.
+    :return login (dict):   The code verifier and nonce of the login, empty
+                            if COGNITO_LOGIN_STATE is not set, None if the
+                            state is missing, used or expired.
+    """
+    if not settings.login_state:
+        return {}
+    state = request.args.get('state')
+    login = config.state_store.consume(state) if state else None
+    if login is None:
+        logger.warning("Unknown or expired login state in the AWS Cognito callback.")
+    return login
+
+
+def check_nonce(tokens: TokenSet, login: dict):
+    """
+    Method to check the id token "nonce" claim against the nonce of the
+    login redirect.
+    :param tokens (TokenSet):   Verified tokens of the callback.
+    :param login (dict):        Login state from :func:`consume_login_state`.
+    :return valid (bool)
+    """
+    nonce = login.get('nonce')
+    if nonce and tokens.id_claims.get('nonce') != nonce:
+        logger.warning("The id token nonce does not match the login.")
+        return False
+    return True
+
+
 def callback_handler(fn):
     """
     A decorator to handle redirects from AWS Cognito login and signup. It
@@ -54,73 +154,174 @@ def callback_handler(fn):
         * email
         * expires
         * refresh_token
+    The verified claims are available to the view function in
+    `flask.g.cognito_id_claims` (id token) and `flask.g.cognito_claims`
+    (access token, with scope and client_id), and the tokens in
+    `flask.g.cognito_tokens`.
     Use this decorator on the redirect endpoint on your application.
+    With COGNITO_PHASE_TIMING, the time spent per phase is available in
+    `flask.g.cognito_timings`, see `timing.py`.
     """
     @wraps(fn)
     def wrapper(*args, **kwargs):
         auth_success = False
-        logger.info("Login is successfull from AWS Cognito.")
-        logger.info(
+        tokens = None
+        logger.debug(
             "Authenticating AWS Cognito application / client, with code exchange.")
 
-        csrf_token = config.state
-        csrf_state = None
+        timer = get_phase_timer()
+        with timer.phase("config"):
+            settings = config.settings
+            csrf_token = settings.state
+            csrf_state = None
+
+            if csrf_token:
+                csrf_state = request.args.get('state')
 
-        if csrf_token:
-            csrf_state = request.args.get('state')
+            # A forged or replayed callback is rejected before the code exchange
+            login = consume_login_state(settings)
+        if login is None:
+            emit_event(CODE_EXCHANGED, reason="state")
+            return auth_error_response(settings)
 
         code = request.args.get('code')
-        request_parameters = {'grant_type': 'authorization_code',
-                              'client_id': config.client_id,
-                              'code': code,
-                              "redirect_uri": config.redirect_uri}
-        response = requests.post(config.jwt_code_exchange_uri,
-                                 data=request_parameters,
-                                 auth=HTTPBasicAuth(config.client_id,
-                                                    config.client_secret))
+        request_parameters = code_exchange_parameters(settings, code,
+                                                      login.get('code_verifier'))
+        started = time.perf_counter()
+        try:
+            with timer.phase("token_post"):
+                response = config.exchange_flight.run(
+                    (settings.client_id, token_hash(code or "")),
+                    lambda: exchange_code(settings, request_parameters))
+        except requests.RequestException as e:
+            logger.warning(f"Code exchange with AWS Cognito failed: {e}")
+            response = None
+        emit_event(CODE_EXCHANGED, latency=time.perf_counter() - started,
+                   reason=exchange_failure_reason(response))
 
         # the response:
         # http://docs.aws.amazon.com/cognito/latest/developerguide/amazon-cognito-user-pools-using-tokens-with-identity-providers.html
-        if response.status_code == requests.codes.ok:
-            logger.info("Code exchange is successfull.")
-            logger.info("Validating CSRF state exchange of AWS Cognito")
+        if response is not None and response.status_code == requests.codes.ok:
+            logger.debug("Code exchange is successfull, validating CSRF state.")
 
             if csrf_state == csrf_token:
-                auth_success = True
-
-                if csrf_token:
-                    logger.info(
-                        "CSRF state validation successfull. Login is successfull for AWS Cognito")
-
-                logger.info("Decode the access token from response.")
-                verify(response.json()["access_token"])
-                id_token = verify(
-                    response.json()["id_token"], response.json()["access_token"])
-
-                username = id_token["cognito:username"]
-                groups = None
-                if "cognito:groups" in id_token:
-                    groups = id_token['cognito:groups']
-
-                update_session(username=username,
-                               id=id_token["sub"],
-                               groups=groups,
-                               email=id_token["email"],
-                               expires=id_token["exp"],
-                               refresh_token=response.json()["refresh_token"])
+                try:
+                    with timer.phase("json_parse"):
+                        tokens = TokenSet.from_response(response.json())
+                except ValueError as e:
+                    logger.warning(f"Invalid AWS Cognito token response: {e}")
+
+            if tokens is not None:
+                try:
+                    verify_tokens(tokens)
+                except JWTError as e:
+                    # Recorded as a verify_failed event by the verification
+                    logger.warning(f"AWS Cognito tokens are rejected: {e}")
+                    tokens = None
+                except KEY_FETCH_ERRORS as e:
+                    logger.warning(f"Unable to get AWS Cognito JWKS: {e}")
+                    emit_event(VERIFY_FAILED, reason="jwks_unavailable")
+                    tokens = None
+            if tokens is not None:
+                if check_nonce(tokens, login):
+                    auth_success = True
+                    with timer.phase("session_write"):
+                        complete_login(tokens)
+                else:
+                    emit_event(VERIFY_FAILED, sub=tokens.id_claims.get('sub'), reason="nonce")
         if not auth_success:
-            error_uri = config.redirect_error_uri
-            if error_uri:
-                resp = redirect(url_for(error_uri))
-                return resp
-            else:
-                msg = f"Somthing went wrong during authentication"
-                return json.dumps({'Error': msg}), 500
+            return auth_error_response(settings)
         return fn(*args, **kwargs)
     return wrapper
 
 
-def update_session(username: str, id, groups, email: str, expires, refresh_token):
+def exchange_failure_reason(response):
+    """
+    Method to classify a failed code exchange for the code_exchanged event.
+    :param response:        HTTP response of the token endpoint, None if
+                            AWS Cognito was not reachable.
+    :return reason (str):   unreachable, http_<status> or None on success.
+    """
+    if response is None:
+        return "unreachable"
+    if response.status_code != requests.codes.ok:
+        return f"http_{response.status_code}"
+    return None
+
+
+def code_exchange_parameters(settings, code: str, code_verifier: str = None):
+    """
+    Method to build the form parameters of the authorization code exchange.
+    :param settings (CognitoSettings):  Resolved AWS Cognito settings.
+    :param code (str):                  Authorization code from the callback.
+    :param code_verifier (str):         PKCE code verifier of the login.
+    :return parameters (dict):          Form parameters for the token endpoint.
+    """
+    parameters = {'grant_type': 'authorization_code',
+                  'client_id': settings.client_id,
+                  'code': code,
+                  "redirect_uri": settings.redirect_uri}
+    if code_verifier:
+        parameters['code_verifier'] = code_verifier
+    return parameters
+
+
+def exchange_code(settings, request_parameters: dict):
+    """
+    Method to exchange an authorization code for tokens at AWS Cognito.
+    :param settings (CognitoSettings):  Resolved AWS Cognito settings.
+    :param request_parameters (dict):   Parameters of :func:`code_exchange_parameters`.
+    :return response:                   HTTP response of the token endpoint.
+    """
+    with config.metrics.timer("code_exchange.latency", {"grant_type": "authorization_code"}):
+        return config.http_client.post(settings.jwt_code_exchange_uri,
+                                       data=request_parameters,
+                                       auth=HTTPBasicAuth(settings.client_id,
+                                                          settings.client_secret))
+
+
+def complete_login(tokens: TokenSet):
+    """
+    Method to push the informations of verified tokens in Flask session and
+    expose the claims to the view function in `flask.g`.
+    :param tokens (TokenSet):   Verified tokens of the logged in user.
+    """
+    id_token = tokens.id_claims
+
+    username = id_token["cognito:username"]
+    groups = None
+    if "cognito:groups" in id_token:
+        groups = id_token['cognito:groups']
+
+    update_session(username=username,
+                   id=id_token["sub"],
+                   groups=groups,
+                   email=id_token["email"],
+                   expires=id_token["exp"],
+                   refresh_token=tokens.refresh_token,
+                   origin_jti=id_token.get("origin_jti"))
+    g.cognito_tokens = tokens
+    g.cognito_claims = tokens.access_claims
+    g.cognito_id_claims = tokens.id_claims
+
+
+def auth_error_response(settings):
+    """
+    Method to build the response of a failed login, a redirect to
+    ERROR_REDIRECT_URI if set.
+    :param settings (CognitoSettings):  Resolved AWS Cognito settings.
+    """
+    error_uri = settings.redirect_error_uri
+    if error_uri:
+        resp = redirect(url_for(error_uri))
+        return resp
+    else:
+        msg = f"Somthing went wrong during authentication"
+        return json.dumps({'Error': msg}), 500
+
+
+def update_session(username: str, id, groups, email: str, expires, refresh_token,
+                   origin_jti: str = None):
     """
     Method to update the Flase Session object with the informations after
     successfull login.
@@ -131,36 +332,386 @@ def update_session(username: str, id, groups, email: str, expires, refresh_token
     :param email (str):         AWS Cognito email if of authenticated user.
     :param expires (str):       AWS Cognito session timeout.
     :param refresh_token (str): JWT refresh token received in respose.
+    :param origin_jti (str):    "origin_jti" claim of the tokens, to revoke
+                                them on logout.
+    With a token store set on the manager, the informations are kept in the
+    store and the session only holds an opaque session id. Clearing the
+    informations revokes the stored session.
+    The informations are tied to the tenant of the request, so a login of
+    one user pool is not a login of the other tenants on the same host.
     """
-    session['username'] = username
-    session['id'] = id
-    session['groups'] = groups
-    session['email'] = email
-    session['expires'] = expires
-    session['refresh_token'] = refresh_token
+    # The user of the request changes, drop what was built from the session
+    g.pop('cognito_user', None)
+    g.pop('cognito_groups', None)
+    token_store = config.token_store
+    if token_store is None:
+        session['username'] = username
+        session['id'] = id
+        session['groups'] = groups
+        session['email'] = email
+        session['expires'] = expires
+        session['refresh_token'] = refresh_token
+        session['origin_jti'] = origin_jti
+        if username is None:
+            session.pop(SESSION_TENANT_KEY, None)
+        else:
+            session[SESSION_TENANT_KEY] = config.tenant.name
+        return
+
+    sid = session.pop(SESSION_ID_KEY, None)
+    if sid:
+        token_store.delete(sid)
+    if username is None:
+        return
+
+    # A new session id on every login prevents session fixation
+    sid = new_session_id()
+    token_store.set(sid,
+                    {'username': username,
+                     'id': id,
+                     'groups': groups,
+                     'email': email,
+                     'expires': expires,
+                     'refresh_token': refresh_token,
+                     'origin_jti': origin_jti,
+                     SESSION_TENANT_KEY: config.tenant.name},
+                    config.settings.token_store_ttl)
+    session[SESSION_ID_KEY] = sid
 
 
-def verify(token: str, access_token: str = None):
+def get_session_info():
+    """
+    Method to get the informations of the logged in user pushed by
+    :func:`update_session`, from the Flask session or from the token store.
+    :return info (dict):    Dict with username, id, groups, email, expires,
+                            refresh_token and origin_jti, values are None
+                            if the user is not logged in or logged in to
+                            another tenant.
+    """
+    token_store = config.token_store
+    if token_store is None:
+        info = session
+    else:
+        sid = session.get(SESSION_ID_KEY)
+        info = token_store.get(sid) if sid else None
+        if info is None:
+            return dict.fromkeys(SESSION_INFO_KEYS)
+
+    # Sessions written before the tenants were stored belong to the default
+    if info.get(SESSION_TENANT_KEY, DEFAULT_TENANT) != config.tenant.name:
+        return dict.fromkeys(SESSION_INFO_KEYS)
+    return {key: info.get(key) for key in SESSION_INFO_KEYS}
+
+
+def verify(token: str, access_token: str = None, token_use: str = None):
     """
     Verifies a JWT string's signature and validates reserved claims.
     Get the key id from the header, locate it in the cognito keys and verify
-    the key
+    the key. The claims are validated with the validation profile of the
+    application: pinned algorithm, issuer, app client id and "token_use".
     :param token (str):         A signed JWS to be verified.
     :param access_token (str):  An access token string. If the "at_hash" claim
                                 is included in the
+    :param token_use (str):     Expected "token_use" claim, `access` or `id`,
+                                any if None.
     :return id_token (dict):    The dict representation of the claims set,
                                 assuming the signature is valid and all
                                 requested data validation passes.
     """
-    header = jwt.get_unverified_header(token)
-    key = [k for k in config.jwt_cognito_key if k["kid"] == header['kid']][0]
-    id_token = jwt.decode(token,
-                          key,
-                          audience=config.client_id,
-                          access_token=access_token)
+    timer = get_phase_timer()
+    with timer.phase("header_parse"):
+        header, tenant = parse_token_header(token)
+    with timer.phase("key_lookup"):
+        key = config.get_jwt_cognito_key(header.get('kid'), tenant)
+    with timer.phase("signature"):
+        return decode_token(token, header, key, access_token, token_use,
+                            tenant.validation)
+
+
+def parse_token_header(token: str):
+    """
+    Method to parse the header of a token and resolve its tenant. A rejected
+    header is recorded as a `verify_failed` event, like the failures of
+    :func:`decode_token`.
+    :param token (str):         A signed JWS to be verified.
+    :return header (dict):      The unverified header of the token.
+    :return tenant:             The tenant verifying the token.
+    """
+    try:
+        header = jwt.get_unverified_header(token)
+        tenant = config.get_auth_manager.tenant_for_token(token)
+        tenant.validation.check_header(header)
+    except JWTError as e:
+        emit_event(VERIFY_FAILED, reason=failure_reason(e))
+        raise
+    return header, tenant
+
+
+def decode_token(token: str, header: dict, key, access_token: str = None,
+                 token_use: str = None, validation=None):
+    """
+    Verifies a JWT string's signature with the located public key and
+    validates reserved claims.
+    :param token (str):         A signed JWS to be verified.
+    :param header (dict):       The unverified header of the token.
+    :param key:                 Public key for the "kid" of the header, None
+                                if not found.
+    :param access_token (str):  An access token string to validate the
+                                "at_hash" claim.
+    :param token_use (str):     Expected "token_use" claim, any if None.
+    :param validation (ValidationProfile): Profile of the tenant of the
+                                token, the request tenant profile if None.
+    :return id_token (dict):    The dict representation of the claims set.
+    """
+    metrics = config.metrics
+    events = config.events
+    if not metrics.enabled and not events.enabled:
+        return _decode_token(token, header, key, access_token, token_use, validation)
+
+    started = time.perf_counter()
+    try:
+        id_token = _decode_token(token, header, key, access_token, token_use, validation)
+    except JWTError as e:
+        reason = failure_reason(e)
+        if metrics.enabled:
+            metrics.increment("verify.failure", tags={"reason": reason})
+        emit_event(VERIFY_FAILED, latency=time.perf_counter() - started, reason=reason)
+        raise
+    latency = time.perf_counter() - started
+    if metrics.enabled:
+        metrics.timing("verify.duration", latency)
+    emit_event(TOKEN_VERIFIED, sub=id_token.get('sub'), latency=latency)
     return id_token
 
 
+def _decode_token(token, header, key, access_token, token_use, validation):
+    if key is None:
+        raise KeyNotFoundError(
+            f"Public key not found in AWS Cognito JWKS for kid: {header.get('kid')}")
+    validation = validation or config.validation
+    claims = validation.decode(token, header, key, access_token, token_use)
+    if config.blocklist.is_revoked(claims):
+        raise TokenRevokedError("Token has been revoked.")
+    return claims
+
+
+def verify_tokens(tokens: TokenSet):
+    """
+    Verifies the access and id token of a token set in one pass. The id
+    token "at_hash" claim is checked against the access token.
+    :param tokens (TokenSet):   Tokens from the AWS Cognito token endpoint.
+    :return tokens (TokenSet):  The same token set with `access_claims` and
+                                `id_claims` set.
+    """
+    tokens.access_claims = verify(tokens.access_token, token_use=TOKEN_USE_ACCESS)
+    tokens.id_claims = verify(tokens.id_token, tokens.access_token,
+                              token_use=TOKEN_USE_ID)
+    return tokens
+
+
+def verify_many(tokens, token_use: str = None, executor=None,
+                chunk_size: int = DEFAULT_VERIFY_CHUNK_SIZE):
+    """
+    Verifies a batch of tokens, e.g. the tokens of queued jobs. Each header
+    is parsed once, identical tokens are verified once and tokens are
+    grouped by tenant and "kid" so each key is looked up once. The signature checks
+    run inline, or in chunks on a `concurrent.futures` executor to use idle
+    cores. An invalid token does not fail the batch.
+    :param tokens (list):       Signed JWS strings to be verified.
+    :param token_use (str):     Expected "token_use" claim, any if None.
+    :param executor:            Optional `ThreadPoolExecutor` or
+                                `ProcessPoolExecutor` running the checks.
+    :param chunk_size (int):    Tokens per executor task.
+    :return results (list):     A :class:`VerificationResult` per token, in
+                                the order of `tokens`.
+    """
+    started = time.perf_counter()
+    auth_manager = config.get_auth_manager
+    results = {}
+    groups = {}
+    for token in tokens:
+        if token in results:
+            continue
+        try:
+            header = jwt.get_unverified_header(token)
+            tenant = auth_manager.tenant_for_token(token)
+            tenant.validation.check_header(header)
+        except JWTError as e:
+            results[token] = VerificationResult(token, error=e)
+            continue
+        # Placeholder, keeps duplicates out of the groups
+        results[token] = None
+        groups.setdefault((tenant, header.get('kid')), []).append((token, header))
+
+    in_process = isinstance(executor, ProcessPoolExecutor)
+    futures = []
+    for (tenant, kid), items in groups.items():
+        validation = tenant.validation
+        try:
+            key = config.get_jwt_cognito_key(kid, tenant)
+        except Exception as e:
+            # JWKS fetch failed without stale keys, e.g. endpoint down
+            logger.warning(f"Unable to get AWS Cognito JWKS for kid {kid}: {e}")
+            results.update((token, VerificationResult(token, error=e))
+                           for token, _ in items)
+            continue
+        if key is None:
+            error = KeyNotFoundError(
+                f"Public key not found in AWS Cognito JWKS for kid: {kid}")
+            results.update((token, VerificationResult(token, error=error))
+                           for token, _ in items)
+            continue
+        if executor is None:
+            results.update((result.token, result)
+                           for result in verify_chunk(validation, key, items, token_use))
+            continue
+        if in_process:
+            # Constructed keys do not pickle, the workers build them again
+            key = next(jwk for jwk in tenant.key_cache.keys if jwk.get('kid') == kid)
+        futures.extend((chunk, executor.submit(verify_chunk, validation, key, chunk, token_use))
+                       for chunk in chunks(items, chunk_size))
+    for chunk, future in futures:
+        try:
+            chunk_results = future.result()
+        except Exception as e:
+            # e.g. a worker process died, only its chunk fails
+            chunk_results = [VerificationResult(token, error=e) for token, _ in chunk]
+        results.update((result.token, result) for result in chunk_results)
+    blocklist = auth_manager.blocklist
+    for result in results.values():
+        if result.ok and blocklist.is_revoked(result.claims):
+            result.claims = None
+            result.error = TokenRevokedError("Token has been revoked.")
+
+    metrics = config.metrics
+    if metrics.enabled:
+        for result in results.values():
+            if not result.ok:
+                metrics.increment("verify.failure", tags={"reason": failure_reason(result.error)})
+        metrics.timing("verify_many.duration", time.perf_counter() - started)
+    if config.events.enabled:
+        for result in results.values():
+            if result.ok:
+                emit_event(TOKEN_VERIFIED, sub=result.claims.get('sub'))
+            else:
+                emit_event(VERIFY_FAILED, reason=failure_reason(result.error))
+    return [results[token] for token in tokens]
+
+
+def refresh_handler(fn):
+    """
+    A decorator to refresh the AWS Cognito tokens of the logged in user
+    when the session is about to expire, using the refresh_token stored in
+    Flask session. This avoids the redirect through the AWS Cognito hosted
+    UI at token expiry.
+    The refresh is done when the session expires within
+    COGNITO_REFRESH_LEEWAY seconds. If AWS Cognito rejects the refresh
+    token, or the session expired, the session informations are cleared.
+    Set COGNITO_REFRESH_ON_REQUEST to do this before every request instead.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        refresh_session()
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def refresh_before_request():
+    """
+    `before_request` hook refreshing the session tokens near expiry.
+    """
+    refresh_session()
+
+
+def refresh_session(force: bool = False):
+    """
+    Method to refresh the AWS Cognito tokens of the session if it expires
+    within COGNITO_REFRESH_LEEWAY seconds. Concurrent refreshes of the same
+    session are collapsed into one call to AWS Cognito.
+    :param force (bool):    Refresh even if the session is not near expiry.
+    :return refreshed (bool): True if the session is valid or was refreshed,
+                              False if there is no session or the refresh
+                              failed.
+    The session is cleared when AWS Cognito rejects the refresh token, or
+    when it expired and could not be refreshed. On transient failures, e.g.
+    a timeout or an open circuit breaker, a session still valid is kept and
+    the refresh is retried on a later request.
+    """
+    info = get_session_info()
+    refresh_token = info['refresh_token']
+    expires = info['expires']
+    if not refresh_token or not expires:
+        return False
+
+    settings = config.settings
+    if not force and expires - time.time() > settings.refresh_leeway:
+        return True
+
+    try:
+        tokens = config.refresh_flight.run(
+            token_hash(refresh_token),
+            lambda: exchange_refresh_token(settings, refresh_token))
+    except (requests.RequestException, ValueError, JWTError) as e:
+        config.metrics.increment("refresh", tags={"result": "failure"})
+        rejected = isinstance(e, (RefreshRejectedError, TokenRevokedError))
+        if not rejected and expires > time.time():
+            # AWS Cognito is degraded, keep the session and retry later
+            logger.warning(f"Refresh of AWS Cognito tokens failed, will retry: {e}")
+            return True
+        logger.warning(f"Refresh of AWS Cognito tokens failed: {e}")
+        update_session(username=None,
+                       id=None,
+                       groups=None,
+                       email=None,
+                       expires=None,
+                       refresh_token=None)
+        return False
+
+    logger.debug("AWS Cognito tokens are refreshed.")
+    config.metrics.increment("refresh", tags={"result": "success"})
+    complete_login(tokens)
+    return True
+
+
+def exchange_refresh_token(settings, refresh_token: str):
+    """
+    Method to get new tokens from AWS Cognito with the refresh_token grant.
+    AWS Cognito does not rotate the refresh token, so the one used is kept
+    in the returned token set.
+    :param settings (CognitoSettings):  Resolved AWS Cognito settings.
+    :param refresh_token (str):         Refresh token of the session.
+    :return tokens (TokenSet):          The verified tokens.
+    """
+    request_parameters = {'grant_type': 'refresh_token',
+                          'client_id': settings.client_id,
+                          'refresh_token': refresh_token}
+    with config.metrics.timer("code_exchange.latency", {"grant_type": "refresh_token"}):
+        response = config.http_client.post(settings.jwt_code_exchange_uri,
+                                           data=request_parameters,
+                                           auth=HTTPBasicAuth(settings.client_id,
+                                                              settings.client_secret))
+    if response.status_code == requests.codes.bad_request and refresh_error(response) == 'invalid_grant':
+        raise RefreshRejectedError("AWS Cognito rejected the refresh token.", response=response)
+    response.raise_for_status()
+    tokens = TokenSet.from_response(response.json())
+    if not tokens.refresh_token:
+        tokens.refresh_token = refresh_token
+    return verify_tokens(tokens)
+
+
+def refresh_error(response):
+    """
+    Method to get the OAuth2 error code of a failed token request.
+    :param response:        HTTP response of the token endpoint.
+    :return error (str):    e.g. `invalid_grant`, None if not given.
+    """
+    try:
+        payload = response.json()
+    except ValueError:
+        return None
+    return payload.get('error') if isinstance(payload, dict) else None
+
+
 def logout_handler(fn):
     """
     A decorator to logout from AWS Cognito and return to signout uri.
@@ -178,18 +729,174 @@ def logout_handler(fn):
     """
     @wraps(fn)
     def wrapper(*args, **kwargs):
+        info = get_session_info()
+        emit_event(LOGOUT, sub=info['id'])
+        revoke_tokens({'origin_jti': info.get('origin_jti')},
+                      expires_at=info['expires'],
+                      refresh_token=info['refresh_token'])
         update_session(username=None,
                        id=None,
                        groups=None,
                        email=None,
                        expires=None,
                        refresh_token=None)
-        logger.info(
+        logger.debug(
             "AWS Cognito Login, redirecting to AWS Cognito for logout and terminating sessions")
 
-        aws_cognito_logout = config.logout_uri
+        aws_cognito_logout = config.settings.logout_uri
 
         # https://docs.aws.amazon.com/cognito/latest/developerguide/amazon-cognito-user-pools-using-tokens-with-identity-providers.html
         res = redirect(aws_cognito_logout)
         return res
     return wrapper
+
+
+def revoke_tokens(claims: dict, expires_at: float = None, refresh_token: str = None):
+    """
+    Method to revoke tokens before they expire: their "jti" and
+    "origin_jti" are added to the blocklist, so the other tokens of the
+    same authentication are rejected too, cached ones included. With
+    COGNITO_REVOKE_ON_LOGOUT set, the refresh token is also revoked at AWS
+    Cognito so no new tokens are issued from it.
+    :param claims (dict):       Claims of a token, e.g. `g.cognito_claims`.
+    :param expires_at (float):  Epoch seconds to keep the ids, the "exp"
+                                claim if None.
+    :param refresh_token (str): Refresh token of the authentication.
+    """
+    if config.blocklist.revoke(claims, expires_at):
+        logger.debug("AWS Cognito tokens are revoked.")
+
+    settings = config.settings
+    if refresh_token and settings.revoke_on_logout:
+        try:
+            with config.metrics.timer("revoke.latency"):
+                response = config.http_client.post(
+                    settings.revoke_uri,
+                    data={'token': refresh_token, 'client_id': settings.client_id},
+                    auth=HTTPBasicAuth(settings.client_id, settings.client_secret))
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logger.warning(f"Revocation of the AWS Cognito refresh token failed: {e}")
+
+
+def token_required(fn):
+    """
+    A decorator to protect API endpoints with an AWS Cognito bearer token.
+    The token is read from the `Authorization: Bearer <token>` header and
+    verified with :func:`verify`. Claims of recently verified tokens are
+    cached until the token expires, so repeated calls with the same token
+    skip the signature verification.
+    The verified claims are available in `flask.g.cognito_claims`.
+    Requests with a method in EXEMPT_METHODS are passed through.
+    Responds with 401 if the token is missing or invalid, and with 503 if
+    the AWS Cognito keys cannot be fetched.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if request.method in config.settings.exempt_methods:
+            return fn(*args, **kwargs)
+
+        token = get_bearer_token()
+        if not token:
+            msg = "Missing bearer token in Authorization header"
+            return json.dumps({'Error': msg}), 401
+
+        token_cache = config.token_cache
+        claims = token_cache.get(token)
+        metrics = config.metrics
+        if metrics.enabled:
+            metrics.increment("token_cache",
+                              tags={"result": "miss" if claims is None else "hit"})
+        if claims is not None and config.blocklist.is_revoked(claims):
+            msg = "Invalid bearer token"
+            return json.dumps({'Error': msg}), 401
+        if claims is None:
+            try:
+                claims = verify(token,
+                                token_use=config.validation.bearer_token_use)
+            except JWTError as e:
+                logger.debug(f"Bearer token verification failed: {e}")
+                msg = "Invalid bearer token"
+                return json.dumps({'Error': msg}), 401
+            except KEY_FETCH_ERRORS as e:
+                logger.warning(f"Unable to get AWS Cognito JWKS: {e}")
+                msg = "Unable to verify bearer token, try again later"
+                return json.dumps({'Error': msg}), 503
+            token_cache.put(token, claims)
+
+        g.cognito_claims = claims
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def get_bearer_token():
+    """
+    Method to read the bearer token from the Authorization header.
+    :return token (str):    The token or None if the header is missing or
+                            is not a bearer token.
+    """
+    auth_header = request.headers.get("Authorization", "")
+    parts = auth_header.split(None, 1)
+    if len(parts) != 2 or parts[0].lower() != "bearer":
+        return None
+    return parts[1].strip()
+
+
+def groups_required(any_of=None, all_of=None):
+    """
+    A decorator to authorize the logged in user, or the caller of a bearer
+    token API, by AWS Cognito group. The required groups are compiled once
+    when the view is decorated. Use it below :func:`token_required` on
+    bearer token APIs.
+    Requests with a method in EXEMPT_METHODS are passed through.
+    Responds with 401 if the user is not authenticated and with 403 if the
+    groups do not match.
+    :param any_of (list):   The user must be in at least one of the groups.
+    :param all_of (list):   The user must be in all the groups.
+    :raises RuntimeError:   If no group is required.
+    """
+    any_of = frozenset([any_of] if isinstance(any_of, str) else any_of or ())
+    all_of = frozenset([all_of] if isinstance(all_of, str) else all_of or ())
+    if not any_of and not all_of:
+        raise RuntimeError("groups_required needs any_of or all_of groups.")
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if request.method in config.settings.exempt_methods:
+                return fn(*args, **kwargs)
+
+            groups = get_cognito_groups()
+            if groups is None:
+                msg = "Authentication required"
+                return json.dumps({'Error': msg}), 401
+            if not all_of <= groups or (any_of and any_of.isdisjoint(groups)):
+                msg = "User is not in the required AWS Cognito groups"
+                return json.dumps({'Error': msg}), 403
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_cognito_groups():
+    """
+    Method to get the AWS Cognito groups of the current request, from the
+    bearer token claims set by :func:`token_required`, else from the
+    session of the logged in user. The set is built once per request and
+    kept in `flask.g.cognito_groups`.
+    :return groups (frozenset): The groups or None if the request is not
+                                authenticated.
+    """
+    if 'cognito_groups' in g:
+        return g.cognito_groups
+
+    claims = g.get('cognito_claims')
+    if claims is not None:
+        groups = frozenset(claims.get('cognito:groups') or ())
+    else:
+        info = get_session_info()
+        groups = None
+        if info.get('username') is not None:
+            groups = frozenset(info.get('groups') or ())
+    g.cognito_groups = groups
+    return groups
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+File to record structured authentication events for audit. Events:
+    * login_redirect    A user is redirected to the AWS Cognito login.
+    * code_exchanged    An authorization code exchange, with its latency,
+                        and a reason if it failed.
+    * token_verified    A token is verified, with the user sub and latency.
+    * verify_failed     A token is rejected, with the reason.
+    * logout            A user logs out.
+Events are buffered and handed to the sinks in batches, from the request
+thread when a batch is full or from a background thread every
+`flush_interval` seconds. Without a sink, :class:`AuthEvents` is disabled
+and the instrumented code does not build the events at all.
+"""
+
+import json
+import time
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+LOGIN_REDIRECT = "login_redirect"
+CODE_EXCHANGED = "code_exchanged"
+TOKEN_VERIFIED = "token_verified"
+VERIFY_FAILED = "verify_failed"
+LOGOUT = "logout"
+
+DEFAULT_EVENTS_BATCH_SIZE = 100
+DEFAULT_EVENTS_FLUSH_INTERVAL = 5
+
+
+class AuthEvent(object):
+    """
+    Authentication event. Tokens are never part of an event.
+    """
+
+    __slots__ = ("type", "time", "tenant", "sub", "latency", "reason")
+
+    def __init__(self, type: str, tenant: str = None, sub: str = None,
+                 latency: float = None, reason: str = None):
+        """
+        Create the event.
+        :param type (str):      Event type, e.g. `token_verified`.
+        :param tenant (str):    Name of the tenant of the request.
+        :param sub (str):       AWS Cognito user id, the "sub" claim.
+        :param latency (float): Seconds taken by the step.
+        :param reason (str):    Reason of a failure.
+        """
+        self.type = type
+        self.time = time.time()
+        self.tenant = tenant
+        self.sub = sub
+        self.latency = latency
+        self.reason = reason
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__
+                if getattr(self, name) is not None}
+
+    def __repr__(self):
+        return f"AuthEvent({self.to_dict()!r})"
+
+
+class EventSink(object):
+    """
+    Interface of the authentication event sinks.
+    """
+
+    def emit(self, events: list):
+        """
+        Method to record a batch of events.
+        :param events (list): List of :class:`AuthEvent`.
+        """
+        raise NotImplementedError
+
+
+class LoggingEventSink(EventSink):
+    """
+    Sink writing one JSON log record per event, e.g. for a log shipper.
+    """
+
+    def __init__(self, logger_name="flask_cognito_auth.audit", level=logging.INFO):
+        """
+        Create the logging sink.
+        :param logger_name (str):   Name of the audit logger.
+        :param level (int):         Level of the records.
+        """
+        self.logger = logging.getLogger(logger_name)
+        self.level = level
+
+    def emit(self, events):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        for event in events:
+            self.logger.log(self.level, json.dumps(event.to_dict()))
+
+
+class AuthEvents(object):
+    """
+    Event surface of the :class:`CognitoAuthManager`, batching the events
+    to the configured sinks. `enabled` is False without sinks; instrumented
+    code checks it before building events, so disabled events cost nothing.
+    """
+
+    def __init__(self, sinks=None, batch_size=DEFAULT_EVENTS_BATCH_SIZE,
+                 flush_interval=DEFAULT_EVENTS_FLUSH_INTERVAL):
+        """
+        Create the event surface.
+        :param sinks:                   An :class:`EventSink` or a list of them.
+        :param batch_size (int):        Events buffered before a flush.
+        :param flush_interval (float):  Seconds between background flushes,
+                                        0 to only flush full batches.
+        """
+        if sinks is None:
+            sinks = []
+        elif isinstance(sinks, EventSink):
+            sinks = [sinks]
+        self.sinks = list(sinks)
+        self.enabled = bool(self.sinks)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._thread = None
+        self._stop = threading.Event()
+        self._flush_at_exit = False
+
+    def emit(self, type: str, tenant: str = None, sub: str = None,
+             latency: float = None, reason: str = None):
+        """
+        Method to buffer an event, see :class:`AuthEvent`.
+        """
+        event = AuthEvent(type, tenant, sub, latency, reason)
+        with self._lock:
+            self._buffer.append(event)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+        elif self.flush_interval and (self._thread is None or not self._thread.is_alive()):
+            # Started on first use, in the worker process after a fork
+            self._start()
+
+    def flush(self):
+        """
+        Method to hand the buffered events to the sinks.
+        """
+        with self._lock:
+            events, self._buffer = self._buffer, []
+        if not events:
+            return
+        for sink in self.sinks:
+            try:
+                sink.emit(events)
+            except Exception as exception:
+                logger.warning(f"Unable to record {len(events)} auth events: {exception}")
+
+    def close(self):
+        """
+        Method to stop the background flush and flush the buffered events.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            if self._flush_at_exit:
+                # A closed instance must not pile up in the exit handlers
+                atexit.unregister(self.flush)
+                self._flush_at_exit = False
+        self.flush()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if not self._flush_at_exit:
+                atexit.register(self.flush)
+                self._flush_at_exit = True
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name="cognito-auth-events",
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+
+NULL_EVENTS = AuthEvents()
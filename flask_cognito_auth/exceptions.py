@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+"""
+File to hold the exceptions raised by the extension.
+"""
+
+import requests
+from jose import JWTError
+
+
+class KeyNotFoundError(JWTError):
+    """
+    The "kid" of a token is not in the AWS Cognito JSON Web Key Set.
+    """
+    pass
+
+
+class TokenRevokedError(JWTError):
+    """
+    The token, or the authentication it belongs to, has been revoked.
+    """
+    pass
+
+
+class CircuitOpenError(requests.RequestException):
+    """
+    AWS Cognito failed repeatedly and calls are refused until the circuit
+    breaker cooldown is over.
+    """
+    pass
+
+
+class RefreshRejectedError(requests.HTTPError):
+    """
+    AWS Cognito rejected the refresh token of a session, e.g. it expired or
+    was revoked.
+    """
+    pass
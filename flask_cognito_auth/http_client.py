@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+"""
+File to handle the HTTP calls to AWS Cognito endpoints.
+All the calls go through one pooled, keep-alive `requests.Session` owned by
+the :class:`CognitoAuthManager`, with connect / read timeouts and retries
+with backoff on server errors and throttling. A circuit breaker fails fast
+after repeated errors, see :class:`CircuitBreaker`.
+The asyncio handlers use the non-blocking `httpx` client instead, which is
+an optional dependency (`pip install flask-cognito-auth[async]`).
+"""
+
+import asyncio
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .exceptions import CircuitOpenError
+from .circuit_breaker import CircuitBreaker
+from .circuit_breaker import DEFAULT_BREAKER_THRESHOLD
+from .circuit_breaker import DEFAULT_BREAKER_COOLDOWN
+
+try:
+    import httpx
+except ImportError:   # pragma: no cover
+    httpx = None
+
+ASYNC_TRANSPORT_ERRORS = (httpx.HTTPError,) if httpx is not None else ()
+ASYNC_HTTP_ERRORS = ASYNC_TRANSPORT_ERRORS + (CircuitOpenError,)
+
+DEFAULT_HTTP_POOL_SIZE = 10
+DEFAULT_HTTP_CONNECT_TIMEOUT = 3.05
+DEFAULT_HTTP_READ_TIMEOUT = 10
+DEFAULT_HTTP_RETRIES = 3
+DEFAULT_HTTP_BACKOFF_FACTOR = 0.3
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+THROTTLING_STATUS_CODES = (429,)
+
+
+def breaker_from_config(config):
+    """
+    Method to create the circuit breaker of an HTTP client from the flask
+    application config.
+    :param config (dict): Flask application config (alias: `app.config`).
+    """
+    return CircuitBreaker(threshold=config.get("COGNITO_HTTP_BREAKER_THRESHOLD",
+                                               DEFAULT_BREAKER_THRESHOLD),
+                          cooldown=config.get("COGNITO_HTTP_BREAKER_COOLDOWN",
+                                              DEFAULT_BREAKER_COOLDOWN))
+
+
+def record_response(breaker, response):
+    """
+    Method to record the outcome of a call on a circuit breaker. Server
+    errors and throttling left after the retries count as failures.
+    """
+    if response.status_code in RETRY_STATUS_CODES:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
+class CognitoRetry(Retry):
+    """
+    Retry policy for AWS Cognito calls. Server errors are only retried for
+    idempotent methods, as the authorization code of a token exchange is
+    single use. Throttled requests were not processed by AWS Cognito and are
+    retried for every method.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code in THROTTLING_STATUS_CODES:
+            return bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class CognitoHttpClient(object):
+    """
+    Pooled HTTP client for AWS Cognito endpoints.
+    """
+
+    def __init__(self, pool_size=DEFAULT_HTTP_POOL_SIZE,
+                 connect_timeout=DEFAULT_HTTP_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_HTTP_READ_TIMEOUT,
+                 retries=DEFAULT_HTTP_RETRIES,
+                 backoff_factor=DEFAULT_HTTP_BACKOFF_FACTOR,
+                 breaker=None):
+        """
+        Create the HTTP client.
+        :param pool_size (int):         Keep-alive connections per host.
+        :param connect_timeout (float): Seconds to wait for a connection.
+        :param read_timeout (float):    Seconds to wait for a response.
+        :param retries (int):           Retries on connection errors, server
+                                        errors and throttling.
+        :param backoff_factor (float):  Backoff factor between retries.
+        :param breaker (CircuitBreaker): Circuit breaker of the calls.
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = breaker or CircuitBreaker()
+        retry = CognitoRetry(total=retries,
+                             backoff_factor=backoff_factor,
+                             status_forcelist=RETRY_STATUS_CODES,
+                             raise_on_status=False)
+        # One pool for the user pool (JWKS) host and one for the domain
+        adapter = HTTPAdapter(pool_connections=2,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Method to create the HTTP client from the flask application config.
+        :param config (dict): Flask application config (alias: `app.config`).
+        """
+        return cls(pool_size=config.get("COGNITO_HTTP_POOL_SIZE",
+                                        DEFAULT_HTTP_POOL_SIZE),
+                   connect_timeout=config.get("COGNITO_HTTP_CONNECT_TIMEOUT",
+                                              DEFAULT_HTTP_CONNECT_TIMEOUT),
+                   read_timeout=config.get("COGNITO_HTTP_READ_TIMEOUT",
+                                           DEFAULT_HTTP_READ_TIMEOUT),
+                   retries=config.get("COGNITO_HTTP_RETRIES",
+                                      DEFAULT_HTTP_RETRIES),
+                   backoff_factor=config.get("COGNITO_HTTP_BACKOFF_FACTOR",
+                                             DEFAULT_HTTP_BACKOFF_FACTOR),
+                   breaker=breaker_from_config(config))
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self._call(self.session.get, url, kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self._call(self.session.post, url, kwargs)
+
+    def _call(self, method, url, kwargs):
+        self.breaker.before_call()
+        try:
+            response = method(url, **kwargs)
+        except requests.RequestException:
+            self.breaker.record_failure()
+            raise
+        record_response(self.breaker, response)
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncCognitoHttpClient(object):
+    """
+    Non-blocking HTTP client for AWS Cognito endpoints, used by the asyncio
+    handlers. An `httpx.AsyncClient` is bound to the event loop it is used
+    in, and Flask runs each `async def` view of a WSGI app in a new event
+    loop. So the pooled client lives on an event loop of its own, run by a
+    daemon thread started on first use, and the calls of the request event
+    loops are handed to it. Connections are reused by all requests, under
+    WSGI as under ASGI.
+    """
+
+    def __init__(self, pool_size=DEFAULT_HTTP_POOL_SIZE,
+                 connect_timeout=DEFAULT_HTTP_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_HTTP_READ_TIMEOUT,
+                 retries=DEFAULT_HTTP_RETRIES,
+                 transport=None,
+                 breaker=None):
+        """
+        Create the asyncio HTTP client.
+        :param pool_size (int):         Keep-alive connections.
+        :param connect_timeout (float): Seconds to wait for a connection.
+        :param read_timeout (float):    Seconds to wait for a response.
+        :param retries (int):           Retries on connection errors.
+        :param transport:               Optional `httpx` transport, used by
+                                        tests to stand in for AWS Cognito.
+        :param breaker (CircuitBreaker): Circuit breaker of the calls.
+        """
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.transport = transport
+        self.breaker = breaker or CircuitBreaker()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._client = None
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Method to create the asyncio HTTP client from the flask application
+        config.
+        :param config (dict): Flask application config (alias: `app.config`).
+        """
+        return cls(pool_size=config.get("COGNITO_HTTP_POOL_SIZE",
+                                        DEFAULT_HTTP_POOL_SIZE),
+                   connect_timeout=config.get("COGNITO_HTTP_CONNECT_TIMEOUT",
+                                              DEFAULT_HTTP_CONNECT_TIMEOUT),
+                   read_timeout=config.get("COGNITO_HTTP_READ_TIMEOUT",
+                                           DEFAULT_HTTP_READ_TIMEOUT),
+                   retries=config.get("COGNITO_HTTP_RETRIES",
+                                      DEFAULT_HTTP_RETRIES),
+                   breaker=breaker_from_config(config))
+
+    @property
+    def loop(self):
+        """
+        The event loop running the calls, started on first use.
+        """
+        if httpx is None:
+            raise RuntimeError("httpx must be installed to use the asyncio handlers, "
+                               "install flask-cognito-auth[async].")
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            return self._loop
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                # Started again in the worker process after a fork, the
+                # client of the parent loop is not usable there
+                self._client = None
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever,
+                                                name="cognito-async-http",
+                                                daemon=True)
+                self._thread.start()
+            return self._loop
+
+    @property
+    def client(self):
+        """
+        The `httpx.AsyncClient`, only used on :attr:`loop`.
+        """
+        if self._client is None:
+            transport = self.transport or httpx.AsyncHTTPTransport(
+                retries=self.retries)
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.read_timeout,
+                                      connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.pool_size,
+                                    max_keepalive_connections=self.pool_size),
+                transport=transport)
+        return self._client
+
+    def submit(self, coroutine):
+        """
+        Method to run a coroutine on the client event loop.
+        :param coroutine:   Coroutine using the client.
+        :return future:     `concurrent.futures.Future` of its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def run(self, coroutine):
+        """
+        Method to await a coroutine on the client event loop from any event
+        loop.
+        :param coroutine:   Coroutine using the client.
+        :return:            Its result.
+        """
+        loop = self.loop
+        if asyncio.get_running_loop() is loop:
+            return await coroutine
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, loop))
+
+    async def get(self, url, **kwargs):
+        return await self._call("get", url, kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self._call("post", url, kwargs)
+
+    async def _call(self, method, url, kwargs):
+        self.breaker.before_call()
+        try:
+            response = await self.run(self._request(method, url, kwargs))
+        except ASYNC_TRANSPORT_ERRORS:
+            self.breaker.record_failure()
+            raise
+        record_response(self.breaker, response)
+        return response
+
+    async def _request(self, method, url, kwargs):
+        return await getattr(self.client, method)(url, **kwargs)
+
+    async def aclose(self):
+        """
+        Method to close the client and stop its event loop.
+        """
+        loop, thread, client = self._detach()
+        if thread is None:
+            return
+        if client is not None:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(client.aclose(), loop))
+        await asyncio.get_running_loop().run_in_executor(None, self._stop_loop, loop, thread)
+
+    def close(self):
+        """
+        Method to close the client and stop its event loop, from
+        synchronous code.
+        """
+        loop, thread, client = self._detach()
+        if thread is None:
+            return
+        if client is not None:
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop).result()
+        self._stop_loop(loop, thread)
+
+    def _detach(self):
+        with self._lock:
+            loop, thread, client = self._loop, self._thread, self._client
+            self._loop = self._thread = self._client = None
+        if thread is None or not thread.is_alive():
+            return None, None, None
+        return loop, thread, client
+
+    @staticmethod
+    def _stop_loop(loop, thread):
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
@@ -0,0 +1,631 @@
+#!/usr/bin/env python3
+
+"""
+File to cache the AWS Cognito JSON Web Key Set (JWKS).
+The key set is fetched from the user pool's `.well-known/jwks.json` endpoint
+and kept on the :class:`CognitoAuthManager` until it expires, so the login
+and verification paths do not make a JWKS call in steady state.
+Each fetch also builds an index of the constructed public keys by `kid`, so
+a verification only pays for the signature check.
+Optionally the key set is shared between the worker processes of a node
+through a file, so warm-up and key rotation cost one fetch per node.
+For tests, CI and air-gapped deployments the key set can instead be loaded
+without network from a local file, an inline dict or a callable.
+"""
+
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from .singleflight import SingleFlight
+from .http_client import CognitoHttpClient
+from .http_client import AsyncCognitoHttpClient
+from .metrics import NULL_METRICS
+from .crypto import get_crypto_backend
+
+try:
+    import fcntl
+except ImportError:   # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+DEFAULT_JWKS_TTL = 3600
+DEFAULT_JWKS_MIN_REFRESH_INTERVAL = 30
+DEFAULT_JWKS_REFRESH_AHEAD = 60
+DEFAULT_JWKS_RETRY_INTERVAL = 30
+DEFAULT_JWKS_RELOAD_INTERVAL = 1
+
+
+def parse_max_age(cache_control):
+    """
+    Method to read the `max-age` directive of a Cache-Control header.
+    :param cache_control (str): Value of the Cache-Control header.
+    :return max_age (int):      Seconds from the directive or None if absent.
+    """
+    if not cache_control:
+        return None
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return 0
+    match = MAX_AGE_RE.search(cache_control)
+    if not match:
+        return None
+    return int(match.group(1))
+
+
+def build_key_index(keys, crypto_backend=None):
+    """
+    Method to construct the public keys of a key set once, indexed by `kid`.
+    Keys which can not be constructed are skipped with a warning.
+    :param keys (list):   List of JWK dicts.
+    :param crypto_backend (CryptoBackend): Backend constructing the keys,
+                          the default backend if None.
+    :return index (dict): Dict of `kid` to the public key of the backend.
+    """
+    crypto_backend = crypto_backend or get_crypto_backend()
+    index = {}
+    for key in keys or []:
+        if not isinstance(key, dict) or "kid" not in key:
+            continue
+        try:
+            index[key["kid"]] = crypto_backend.construct_key(key)
+        except Exception as exception:
+            logger.warning(
+                f"Skipping AWS Cognito JWK {key['kid']}: {exception}")
+    return index
+
+
+def parse_jwks_response(response):
+    """
+    Method to read the key set and its max-age from a JWKS response.
+    :param response:        HTTP response of the JWKS endpoint.
+    :return (keys, max_age): List of JWK dicts and max-age or None.
+    :raises ValueError:     If the response is not a key set.
+    """
+    response.raise_for_status()
+    max_age = parse_max_age(response.headers.get("Cache-Control"))
+    return jwks_keys(response.json()), max_age
+
+
+def jwks_keys(jwks):
+    """
+    Method to read the keys of a JWKS document.
+    :param jwks:            JWKS dict with a "keys" list, or the list.
+    :return keys (list):    List of JWK dicts.
+    :raises ValueError:     If the document is not a key set.
+    """
+    if isinstance(jwks, dict):
+        jwks = jwks.get("keys")
+    if not isinstance(jwks, list):
+        raise ValueError("JWKS must be a dict with a keys list or a list of JWKs.")
+    return jwks
+
+
+class LocalJwksSource(object):
+    """
+    Key set loaded without network access, from:
+        * a JSON file path, reloaded when its mtime changes; the mtime is
+          checked at most every `reload_interval` seconds,
+        * an inline JWKS dict,
+        * a callable returning a JWKS dict, called again when the key set
+          expires or on an unknown `kid`.
+    """
+
+    def __init__(self, jwks, reload_interval=DEFAULT_JWKS_RELOAD_INTERVAL):
+        """
+        Create the local key set source.
+        :param jwks:                    File path, JWKS dict or callable.
+        :param reload_interval (int):   Seconds between two mtime checks of
+                                        a file.
+        """
+        self.jwks = jwks
+        self.reload_interval = reload_interval
+        self._mtime = None
+        self._keys = None
+
+    @classmethod
+    def from_config(cls, app_config):
+        """
+        Method to create the source of the COGNITO_JWKS setting.
+        :param app_config (dict):   Flask application config.
+        :return source (LocalJwksSource): The source, None if not set.
+        """
+        jwks = app_config.get("COGNITO_JWKS")
+        if jwks is None:
+            return None
+        return cls(jwks, reload_interval=app_config.get(
+            "COGNITO_JWKS_RELOAD_INTERVAL", DEFAULT_JWKS_RELOAD_INTERVAL))
+
+    def load(self):
+        """
+        Method to load the key set. The same list is returned while a file
+        is unchanged, so the cache keeps its constructed keys.
+        :return (keys, max_age): List of JWK dicts and seconds to keep them,
+                                 None for the cache ttl.
+        """
+        jwks = self.jwks
+        if isinstance(jwks, (str, os.PathLike)):
+            mtime = os.stat(jwks).st_mtime_ns
+            if mtime != self._mtime:
+                with open(jwks) as file:
+                    self._keys = jwks_keys(json.load(file))
+                self._mtime = mtime
+            return self._keys, self.reload_interval
+        if callable(jwks):
+            jwks = jwks()
+        keys = jwks_keys(jwks)
+        if keys != self._keys:
+            self._keys = keys
+        return self._keys, None
+
+
+class FileJwksBackend(object):
+    """
+    Key set shared by the processes of a node through a JSON file. The file
+    is replaced atomically and refreshes are serialized with an advisory
+    lock file, so one process fetches while the others wait and read its
+    result. The file holds the signing keys trusted by the app: it is
+    written with mode 0600 and only read if it is owned by the user of the
+    process and not writable by others. Put it in a private directory, on a
+    tmpfs such as `/dev/shm/<app>/` to keep it in memory.
+    """
+
+    def __init__(self, path):
+        """
+        Create the file backend.
+        :param path (str):  Path of the shared key set file.
+        """
+        self.path = path
+        self.lock_path = f"{path}.lock"
+
+    def read(self):
+        """
+        Method to read the shared key set.
+        :return entry (tuple):  (keys, fetched_at, expires_at) with wall
+                                clock times, or None if there is none or it
+                                cannot be trusted.
+        """
+        try:
+            fd = os.open(self.path, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+        except OSError:
+            return None
+        try:
+            with os.fdopen(fd, "r") as file:
+                if not self._trusted(os.fstat(file.fileno())):
+                    logger.warning(f"Ignoring shared AWS Cognito JWKS {self.path}, it is "
+                                   f"not owned by this user or writable by others.")
+                    return None
+                data = json.load(file)
+            return jwks_keys(data["keys"]), float(data["fetched_at"]), float(data["expires_at"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    @staticmethod
+    def _trusted(stat):
+        if hasattr(os, "getuid") and stat.st_uid != os.getuid():
+            return False
+        return not stat.st_mode & 0o022
+
+    def write(self, keys, fetched_at, expires_at):
+        """
+        Method to atomically replace the shared key set.
+        :param keys (list):         List of JWK dicts.
+        :param fetched_at (float):  Wall clock time of the fetch.
+        :param expires_at (float):  Wall clock time the key set expires.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        # mkstemp creates the file with mode 0600, renamed over the shared one
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".jwks-")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump({"keys": keys,
+                           "fetched_at": fetched_at,
+                           "expires_at": expires_at}, file)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+
+    @contextmanager
+    def lock(self):
+        """
+        Context manager holding the cross-process refresh lock.
+        """
+        if fcntl is None:   # pragma: no cover
+            yield
+            return
+        fd = os.open(self.lock_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        with os.fdopen(fd, "a") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+class JwksCache(object):
+    """
+    Thread safe, TTL bounded cache of the AWS Cognito JSON Web Key Set.
+    * Keys are kept for the Cache-Control `max-age` of the JWKS response,
+      or for `ttl` seconds when the endpoint does not send one.
+    * A lookup for an unknown `kid` refreshes the key set at most once, and
+      not more often than every `min_refresh_interval` seconds, so a key
+      rotation is picked up without a refetch storm.
+    * If the endpoint is down, the stale key set keeps being served and
+      the fetch is retried every `min_refresh_interval` seconds.
+    * With a shared backend, a refresh first looks for a key set fetched by
+      another process and only fetches under the cross-process lock.
+    """
+
+    def __init__(self, ttl=DEFAULT_JWKS_TTL,
+                 min_refresh_interval=DEFAULT_JWKS_MIN_REFRESH_INTERVAL,
+                 http_client=None, shared_backend=None, metrics=NULL_METRICS,
+                 crypto_backend=None, local_source=None):
+        """
+        Create the JWKS cache.
+        :param ttl (int):                  Seconds to keep the key set when
+                                           the response has no max-age.
+        :param min_refresh_interval (int): Minimum seconds between two
+                                           refreshes forced by a `kid` miss.
+        :param http_client:                :class:`CognitoHttpClient` used
+                                           to fetch the key set.
+        :param shared_backend:             Optional :class:`FileJwksBackend`
+                                           sharing the key set between
+                                           processes.
+        :param metrics (Metrics):          Metrics of the key lookups and
+                                           fetches.
+        :param crypto_backend:             :class:`CryptoBackend` constructing
+                                           the public keys, the default
+                                           backend if None.
+        :param local_source:               Optional :class:`LocalJwksSource`
+                                           loading the key set instead of
+                                           the JWKS endpoint.
+        """
+        self.http_client = http_client or CognitoHttpClient()
+        self.crypto_backend = crypto_backend or get_crypto_backend()
+        self.metrics = metrics
+        self.shared_backend = shared_backend
+        self.local_source = local_source
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._keys = None
+        self._index = {}
+        self._expires_at = 0
+        self._fetched_at = 0
+        self._shared_fetched_at = 0
+
+    @property
+    def keys(self):
+        """
+        The cached key set (list of JWK dicts) without any fetch, or None.
+        """
+        return self._keys
+
+    def set(self, keys, max_age=None):
+        """
+        Method to store a key set in the cache.
+        :param keys (list):    List of JWK dicts.
+        :param max_age (int):  Seconds to keep the key set, defaults to `ttl`.
+        """
+        with self._lock:
+            self._store(keys, max_age)
+
+    def clear(self):
+        """
+        Method to drop the cached key set.
+        """
+        with self._lock:
+            self._keys = None
+            self._index = {}
+            self._expires_at = 0
+            self._fetched_at = 0
+
+    @property
+    def is_fresh(self):
+        return self._keys is not None and time.monotonic() < self._expires_at
+
+    @property
+    def expires_in(self):
+        """
+        Seconds until the cached key set expires, 0 if expired or not loaded.
+        """
+        return max(self._expires_at - time.monotonic(), 0)
+
+    def get_keys(self, uri):
+        """
+        Method to get the key set, fetching it from `uri` if expired.
+        :param uri (str):   AWS Cognito JWKS endpoint.
+        :return keys (list): List of JWK dicts.
+        """
+        if self.is_fresh:
+            return self._keys
+        return self.refresh(uri)
+
+    def get_key(self, uri, kid):
+        """
+        Method to get the constructed public key for a key id. An unknown
+        `kid` refreshes the key set once to pick up a key rotation.
+        :param uri (str):           AWS Cognito JWKS endpoint.
+        :param kid (str):           Key id from the JWT header.
+        :return key:                The matching public key or None if not found.
+        """
+        hit = self.is_fresh
+        if not hit:
+            self.refresh(uri)
+        key = self.lookup(kid)
+        if key is None:
+            hit = False
+            if self.can_force_refresh():
+                self.refresh(uri, force=True)
+                key = self.lookup(kid)
+        if self.metrics.enabled:
+            self.metrics.increment("jwks.cache", tags={"result": "hit" if hit else "miss"})
+        return key
+
+    def lookup(self, kid):
+        """
+        Method to get the constructed public key for a key id from the
+        cached key set, without any fetch.
+        :param kid (str):           Key id from the JWT header.
+        :return key:                The matching public key or None if not found.
+        """
+        return self._index.get(kid)
+
+    def refresh(self, uri, force=False):
+        """
+        Method to fetch the key set from AWS Cognito and cache it. On failure
+        the stale key set is served if there is one. Concurrent callers wait
+        on one in-flight fetch and share its result or error.
+        :param uri (str):    AWS Cognito JWKS endpoint.
+        :param force (bool): Fetch even if the cached key set is fresh.
+        :return keys (list): List of JWK dicts.
+        """
+        return self._flight.run(uri, lambda: self._refresh(uri, force))
+
+    def _refresh(self, uri, force):
+        with self._lock:
+            # Another thread may have refreshed while we waited on the lock
+            if not force and self.is_fresh:
+                return self._keys
+            if self.shared_backend is None:
+                return self._fetch_and_store(uri)
+
+            keys = self._load_shared(force)
+            if keys is not None:
+                return keys
+            with self.shared_backend.lock():
+                # Another process may have refreshed while we waited
+                keys = self._load_shared(force)
+                if keys is not None:
+                    return keys
+                return self._fetch_and_store(uri)
+
+    def fetch_failed(self, exception):
+        """
+        Method to record a failed key set fetch. The stale key set is served
+        if there is one, else the exception is raised.
+        :param exception (Exception): Error of the failed fetch.
+        :return keys (list):          The stale key set.
+        """
+        with self._lock:
+            return self._serve_stale(exception)
+
+    def can_force_refresh(self):
+        return time.monotonic() - self._fetched_at >= self.min_refresh_interval
+
+    def _serve_stale(self, exception):
+        if self._keys is None:
+            raise exception
+        logger.warning(
+            f"Unable to refresh AWS Cognito JWKS, serving stale keys: {exception}")
+        now = time.monotonic()
+        self._fetched_at = now
+        # Not every verification retries the fetch during an outage
+        self._expires_at = max(self._expires_at, now + self.min_refresh_interval)
+        return self._keys
+
+    def _store(self, keys, max_age):
+        # An unchanged key set keeps its constructed keys
+        if keys is not self._keys:
+            self._index = build_key_index(keys, self.crypto_backend)
+        now = time.monotonic()
+        self._keys = keys
+        self._fetched_at = now
+        self._expires_at = now + (self.ttl if max_age is None else max_age)
+
+    def _fetch_and_store(self, uri):
+        try:
+            keys, max_age = self._fetch(uri)
+        except Exception as exception:
+            return self._serve_stale(exception)
+        self._store(keys, max_age)
+        if self.shared_backend is not None:
+            fetched_at = time.time()
+            max_age = self.ttl if max_age is None else max_age
+            try:
+                self.shared_backend.write(keys, fetched_at, fetched_at + max_age)
+                self._shared_fetched_at = fetched_at
+            except Exception as exception:
+                logger.warning(f"Unable to share AWS Cognito JWKS: {exception}")
+        return keys
+
+    def _load_shared(self, force):
+        """
+        Load the shared key set if it is fresh. A forced refresh only takes
+        a key set fetched after the one already loaded.
+        """
+        entry = self.shared_backend.read()
+        if entry is None:
+            return None
+        keys, fetched_at, expires_at = entry
+        now = time.time()
+        if expires_at <= now:
+            return None
+        if force and fetched_at <= self._shared_fetched_at:
+            return None
+        self._store(keys, expires_at - now)
+        self._shared_fetched_at = fetched_at
+        return keys
+
+    def _fetch(self, uri):
+        if self.local_source is not None:
+            return self.local_source.load()
+        with self.metrics.timer("jwks.fetch.latency"):
+            return parse_jwks_response(self.http_client.get(uri))
+
+
+class JwksRefresher(object):
+    """
+    Background daemon thread keeping a :class:`JwksCache` loaded, so the
+    request path never pays for a JWKS fetch. The key set is fetched when
+    the thread starts and, unless `once` is set, renewed `refresh_ahead`
+    seconds before it expires.
+    Start it in each worker process after fork, threads do not survive it.
+    """
+
+    def __init__(self, key_cache, uri, refresh_ahead=DEFAULT_JWKS_REFRESH_AHEAD,
+                 retry_interval=DEFAULT_JWKS_RETRY_INTERVAL, once=False):
+        """
+        Create the refresher.
+        :param key_cache (JwksCache):   Cache to keep loaded.
+        :param uri (str):               AWS Cognito JWKS endpoint.
+        :param refresh_ahead (int):     Seconds before expiry to renew.
+        :param retry_interval (int):    Seconds to wait after a failed fetch.
+        :param once (bool):             Only load the key set and stop.
+        """
+        self.key_cache = key_cache
+        self.uri = uri
+        self.refresh_ahead = refresh_ahead
+        self.retry_interval = retry_interval
+        self.once = once
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_alive:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="cognito-jwks-refresher",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        force = False
+        while not self._stop.is_set():
+            try:
+                self.key_cache.refresh(self.uri, force=force)
+            except Exception as exception:
+                logger.warning(f"Unable to load AWS Cognito JWKS: {exception}")
+            if self.once and self.key_cache.keys is not None:
+                return
+            force = True
+            expires_in = self.key_cache.expires_in
+            if expires_in > self.refresh_ahead:
+                delay = expires_in - self.refresh_ahead
+            else:
+                # Failed fetch or a key set shorter lived than refresh_ahead
+                delay = self.retry_interval
+            self._stop.wait(delay)
+
+
+class AsyncJwksCache(object):
+    """
+    asyncio front of a :class:`JwksCache` for the asyncio handlers. The key
+    set is shared with the wrapped cache and fetched with the non-blocking
+    HTTP client. Concurrent refreshes are collapsed into a single in-flight
+    fetch on the event loop of the HTTP client, whose result or error is
+    shared by all callers, whatever event loop they run in.
+    """
+
+    def __init__(self, key_cache, http_client=None):
+        """
+        Create the asyncio JWKS cache.
+        :param key_cache (JwksCache):               Cache holding the key set.
+        :param http_client (AsyncCognitoHttpClient): Client used to fetch
+                                                     the key set.
+        """
+        self.key_cache = key_cache
+        self.http_client = http_client or AsyncCognitoHttpClient()
+        self._lock = threading.Lock()
+        self._inflight = None
+
+    async def get_key(self, uri, kid):
+        """
+        Method to get the constructed public key for a key id. An unknown
+        `kid` refreshes the key set once to pick up a key rotation.
+        :param uri (str):           AWS Cognito JWKS endpoint.
+        :param kid (str):           Key id from the JWT header.
+        :return key:                The matching public key or None if not found.
+        """
+        hit = self.key_cache.is_fresh
+        if not hit:
+            await self.refresh(uri)
+        key = self.key_cache.lookup(kid)
+        if key is None:
+            hit = False
+            if self.key_cache.can_force_refresh():
+                await self.refresh(uri, force=True)
+                key = self.key_cache.lookup(kid)
+        metrics = self.key_cache.metrics
+        if metrics.enabled:
+            metrics.increment("jwks.cache", tags={"result": "hit" if hit else "miss"})
+        return key
+
+    async def refresh(self, uri, force=False):
+        """
+        Method to fetch the key set from AWS Cognito and cache it, joining
+        the in-flight fetch if there is one.
+        :param uri (str):    AWS Cognito JWKS endpoint.
+        :param force (bool): Fetch even if the cached key set is fresh.
+        :return keys (list): List of JWK dicts.
+        """
+        with self._lock:
+            future = self._inflight
+            started = future is None
+            if started:
+                future = self._inflight = self.http_client.submit(self._refresh(uri, force))
+        if started:
+            future.add_done_callback(self._done)
+        # A cancelled caller must not cancel the fetch of the others
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    def _done(self, future):
+        with self._lock:
+            if self._inflight is future:
+                self._inflight = None
+
+    async def _refresh(self, uri, force):
+        if not force and self.key_cache.is_fresh:
+            return self.key_cache.keys
+        if self.key_cache.local_source is not None:
+            # No network, a local load does not block the event loop long
+            return self.key_cache.refresh(uri, force)
+        try:
+            with self.key_cache.metrics.timer("jwks.fetch.latency"):
+                keys, max_age = parse_jwks_response(await self.http_client.get(uri))
+        except Exception as exception:
+            return self.key_cache.fetch_failed(exception)
+        self.key_cache.set(keys, max_age)
+        return keys
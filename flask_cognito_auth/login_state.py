@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""
+File to keep the per-login OAuth2 state on the server. With
+COGNITO_LOGIN_STATE set, every login redirect gets a random `state`, a PKCE
+code verifier and an OpenID Connect `nonce`. They are kept in a state store
+until the callback consumes them, once: a replayed or forged callback finds
+nothing and is rejected before the code exchange.
+"""
+
+import json
+import time
+import base64
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+
+DEFAULT_STATE_STORE_SIZE = 10000
+DEFAULT_REDIS_STATE_PREFIX = "flask-cognito-auth:state:"
+
+
+def new_login_state():
+    """
+    Method to generate the state of a login.
+    :return state (str):    URL safe `state` parameter.
+    :return data (dict):    The PKCE code verifier and the nonce to keep
+                            until the callback.
+    """
+    return (secrets.token_urlsafe(32),
+            {"code_verifier": secrets.token_urlsafe(64),
+             "nonce": secrets.token_urlsafe(32)})
+
+
+def code_challenge(code_verifier: str):
+    """
+    Method to compute the PKCE S256 code challenge of a code verifier.
+    :param code_verifier (str): The PKCE code verifier.
+    :return challenge (str):    base64url encoded SHA-256 of the verifier.
+    """
+    digest = hashlib.sha256(code_verifier.encode("ascii")).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
+
+
+class StateStore(object):
+    """
+    Interface of the login state stores.
+    """
+
+    def put(self, state: str, data: dict, ttl: int):
+        """
+        Method to keep the data of a login until its callback.
+        :param state (str): The `state` parameter of the login.
+        :param data (dict): JSON serializable code verifier and nonce.
+        :param ttl (int):   Seconds the login may take.
+        """
+        raise NotImplementedError
+
+    def consume(self, state: str):
+        """
+        Method to get and remove the data of a login, so a state is only
+        accepted once.
+        :param state (str): The `state` parameter of the callback.
+        :return data (dict): The data or None if unknown, used or expired.
+        """
+        raise NotImplementedError
+
+
+class MemoryStateStore(StateStore):
+    """
+    In process, thread safe state store bounded to `maxsize` logins. Logins
+    are kept in insertion order, so the expired ones and, when full, the
+    oldest ones are dropped from the front. Logins are not shared between
+    processes; use a :class:`RedisStateStore` with several workers.
+    """
+
+    def __init__(self, maxsize=DEFAULT_STATE_STORE_SIZE):
+        """
+        Create the in memory state store.
+        :param maxsize (int): Maximum number of pending logins to keep.
+        """
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, state, data, ttl):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[state] = (data, now + ttl)
+            entries = self._entries
+            while entries:
+                _, (_, expires) = next(iter(entries.items()))
+                if expires > now and len(entries) <= self.maxsize:
+                    break
+                entries.popitem(last=False)
+
+    def consume(self, state):
+        with self._lock:
+            entry = self._entries.pop(state, None)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+
+class RedisStateStore(StateStore):
+    """
+    State store on a Redis server, shared by all processes; Redis drops the
+    abandoned logins. Works with any client exposing the redis-py
+    `set(name, value, ex=...)` and `getdel` (Redis 6.2+) methods.
+    """
+
+    def __init__(self, client, prefix=DEFAULT_REDIS_STATE_PREFIX):
+        """
+        Create the Redis state store.
+        :param client:          Redis client, e.g. `redis.Redis(...)`.
+        :param prefix (str):    Prefix of the state keys.
+        """
+        self.client = client
+        self.prefix = prefix
+
+    def put(self, state, data, ttl):
+        self.client.set(self.prefix + state, json.dumps(data), ex=int(ttl))
+
+    def consume(self, state):
+        # Atomic get and delete, concurrent callbacks cannot both succeed
+        value = self.client.getdel(self.prefix + state)
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        return json.loads(value)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+"""
+File to record metrics of the authentication flows with pluggable sinks.
+Recorded metrics:
+    * code_exchange.latency     Histogram of the `/oauth2/token` calls, tag
+                                grant_type=authorization_code/refresh_token.
+    * jwks.fetch.latency        Histogram of the JWKS fetches.
+    * revoke.latency            Histogram of the `/oauth2/revoke` calls.
+    * verify.duration           Histogram of the token verifications.
+    * verify_many.duration      Histogram of the batch verifications.
+    * jwks.cache                Counter of key lookups, tag result=hit/miss.
+    * token_cache               Counter of bearer token cache lookups,
+                                tag result=hit/miss.
+    * verify.failure            Counter of failed verifications, tag reason.
+    * refresh                   Counter of token refreshes, tag result.
+Without a sink, :class:`Metrics` is disabled and the instrumented code skips
+the timing calls altogether.
+"""
+
+import time
+import socket
+import logging
+import threading
+import requests
+from contextlib import contextmanager
+from jose.exceptions import ExpiredSignatureError
+from jose.exceptions import JWTClaimsError
+from .exceptions import KeyNotFoundError
+from .exceptions import TokenRevokedError
+
+try:
+    import prometheus_client
+except ImportError:   # pragma: no cover
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+
+def failure_reason(error):
+    """
+    Method to classify a verification error for the verify.failure counter.
+    :param error (Exception): Error raised by the verification.
+    :return reason (str):     expired, claims, unknown_kid, revoked,
+                              signature, jwks_unavailable or invalid.
+    """
+    if isinstance(error, requests.RequestException):
+        return "jwks_unavailable"
+    if isinstance(error, ExpiredSignatureError):
+        return "expired"
+    if isinstance(error, JWTClaimsError):
+        return "claims"
+    if isinstance(error, KeyNotFoundError):
+        return "unknown_kid"
+    if isinstance(error, TokenRevokedError):
+        return "revoked"
+    if "Signature verification failed" in str(error):
+        return "signature"
+    return "invalid"
+
+
+class MetricsSink(object):
+    """
+    Interface of the metrics sinks.
+    """
+
+    def timing(self, name: str, seconds: float, tags: dict = None):
+        """
+        Method to record a duration in a histogram.
+        :param name (str):      Metric name, e.g. `verify.duration`.
+        :param seconds (float): Duration in seconds.
+        :param tags (dict):     Optional tags of the observation.
+        """
+        raise NotImplementedError
+
+    def increment(self, name: str, value: int = 1, tags: dict = None):
+        """
+        Method to increment a counter.
+        :param name (str):  Metric name, e.g. `verify.failure`.
+        :param value (int): Increment.
+        :param tags (dict): Optional tags of the observation.
+        """
+        raise NotImplementedError
+
+
+class StatsdMetrics(MetricsSink):
+    """
+    Sink sending StatsD datagrams over UDP. Tags are sent in the DogStatsD
+    format unless `tags` is disabled.
+    """
+
+    def __init__(self, host="localhost", port=8125, prefix="flask_cognito_auth",
+                 tags=True):
+        """
+        Create the StatsD sink.
+        :param host (str):      StatsD server host.
+        :param port (int):      StatsD server port.
+        :param prefix (str):    Prefix of the metric names.
+        :param tags (bool):     Send tags in the DogStatsD format.
+        """
+        self.address = (host, port)
+        self.prefix = f"{prefix}." if prefix else ""
+        self.tags = tags
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def timing(self, name, seconds, tags=None):
+        self._send(f"{self.prefix}{name}:{seconds * 1000:.3f}|ms", tags)
+
+    def increment(self, name, value=1, tags=None):
+        self._send(f"{self.prefix}{name}:{value}|c", tags)
+
+    def _send(self, datagram, tags):
+        if tags and self.tags:
+            datagram += "|#" + ",".join(f"{key}:{value}" for key, value in sorted(tags.items()))
+        try:
+            self._socket.sendto(datagram.encode("utf-8"), self.address)
+        except OSError as exception:
+            logger.debug(f"Unable to send StatsD metric: {exception}")
+
+
+class PrometheusMetrics(MetricsSink):
+    """
+    Sink recording Prometheus histograms and counters with
+    `prometheus_client`, an optional dependency. Metric `verify.duration` is
+    exposed as `flask_cognito_auth_verify_duration_seconds`, counter
+    `verify.failure` as `flask_cognito_auth_verify_failure_total`.
+    """
+
+    def __init__(self, registry=None, namespace="flask_cognito_auth"):
+        """
+        Create the Prometheus sink.
+        :param registry:            Optional `prometheus_client` registry.
+        :param namespace (str):     Namespace of the metric names.
+        """
+        if prometheus_client is None:
+            raise RuntimeError("prometheus_client must be installed to use PrometheusMetrics.")
+        self.registry = registry or prometheus_client.REGISTRY
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def timing(self, name, seconds, tags=None):
+        metric = self._metric(prometheus_client.Histogram, f"{name}_seconds", tags)
+        metric.observe(seconds)
+
+    def increment(self, name, value=1, tags=None):
+        metric = self._metric(prometheus_client.Counter, name, tags)
+        metric.inc(value)
+
+    def _metric(self, kind, name, tags):
+        labels = tuple(sorted(tags)) if tags else ()
+        key = (kind, name)
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = kind(name.replace(".", "_"),
+                                  f"flask-cognito-auth {name}",
+                                  labelnames=labels,
+                                  namespace=self.namespace,
+                                  registry=self.registry)
+                    self._metrics[key] = metric
+        if labels:
+            return metric.labels(**tags)
+        return metric
+
+
+class Metrics(object):
+    """
+    Metrics surface of the :class:`CognitoAuthManager`, fanning out to the
+    configured sinks. `enabled` is False without sinks; instrumented code
+    checks it before taking timings, so disabled metrics cost nothing.
+    Errors of the sinks are logged, never raised.
+    """
+
+    def __init__(self, sinks=None):
+        """
+        Create the metrics surface.
+        :param sinks: A :class:`MetricsSink` or a list of them.
+        """
+        if sinks is None:
+            sinks = []
+        elif isinstance(sinks, MetricsSink):
+            sinks = [sinks]
+        self.sinks = list(sinks)
+        self.enabled = bool(self.sinks)
+
+    def timing(self, name: str, seconds: float, tags: dict = None):
+        for sink in self.sinks:
+            try:
+                sink.timing(name, seconds, tags)
+            except Exception as exception:
+                # A metrics failure must not fail the authentication
+                logger.warning(f"Unable to record metric {name}: {exception}")
+
+    def increment(self, name: str, value: int = 1, tags: dict = None):
+        for sink in self.sinks:
+            try:
+                sink.increment(name, value, tags)
+            except Exception as exception:
+                logger.warning(f"Unable to record metric {name}: {exception}")
+
+    @contextmanager
+    def timer(self, name: str, tags: dict = None):
+        """
+        Context manager recording the duration of its block.
+        """
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - started, tags)
+
+
+NULL_METRICS = Metrics()
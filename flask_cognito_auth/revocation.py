@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""
+File to revoke AWS Cognito tokens before they expire.
+Revoked tokens are kept in a blocklist keyed by their "jti" and
+"origin_jti" claims until they expire. AWS Cognito gives every token of an
+authentication, refreshed ones included, the same "origin_jti", so a
+logout revokes them all. Verified tokens are checked against the blocklist,
+cached ones included, with one dict lookup per claim.
+"""
+
+import time
+import heapq
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCKLIST_SIZE = 100000
+DEFAULT_REDIS_BLOCKLIST_PREFIX = "flask-cognito-auth:revoked:"
+REVOCATION_CLAIMS = ("jti", "origin_jti")
+
+
+class Blocklist(object):
+    """
+    Interface of the revoked token blocklists.
+    """
+
+    def add(self, token_id: str, expires_at: float):
+        """
+        Method to revoke a token id.
+        :param token_id (str):      "jti" or "origin_jti" of the token.
+        :param expires_at (float):  Epoch seconds after which the tokens
+                                    are expired anyway and the id dropped.
+        """
+        raise NotImplementedError
+
+    def contains(self, token_id: str):
+        """
+        Method to check if a token id is revoked.
+        :param token_id (str):  "jti" or "origin_jti" of the token.
+        :return revoked (bool)
+        """
+        raise NotImplementedError
+
+    def revoke(self, claims: dict, expires_at: float = None):
+        """
+        Method to revoke the token of a claims set and, through its
+        "origin_jti", the other tokens of the same authentication.
+        :param claims (dict):       Claims of the token.
+        :param expires_at (float):  Epoch seconds to keep the ids, the "exp"
+                                    claim if None.
+        :return revoked (bool):     False if the claims have no token id.
+        """
+        expires_at = expires_at or claims.get("exp")
+        if not expires_at:
+            return False
+        token_ids = [claims[name] for name in REVOCATION_CLAIMS if claims.get(name)]
+        for token_id in token_ids:
+            self.add(token_id, expires_at)
+        return bool(token_ids)
+
+    def is_revoked(self, claims: dict):
+        """
+        Method to check if the token of a claims set is revoked.
+        :param claims (dict):   Verified claims of the token.
+        :return revoked (bool)
+        """
+        for name in REVOCATION_CLAIMS:
+            token_id = claims.get(name)
+            if token_id and self.contains(token_id):
+                return True
+        return False
+
+
+class MemoryBlocklist(Blocklist):
+    """
+    In process, thread safe blocklist bounded to `maxsize` ids. Ids are
+    dropped when their tokens expire; when full, the ids closest to expiry
+    are dropped first, and their tokens would be accepted again. Such an
+    overflow is logged and, with `fail_closed`, the tokens issued before it
+    are rejected until the dropped ids expire. Revocations are not shared
+    between processes; use a :class:`RedisBlocklist` with several workers
+    or more revocations than `maxsize`.
+    """
+
+    def __init__(self, maxsize=DEFAULT_BLOCKLIST_SIZE, fail_closed=False):
+        """
+        Create the in memory blocklist.
+        :param maxsize (int):       Maximum number of revoked ids to keep.
+        :param fail_closed (bool):  Reject the tokens issued before an
+                                    overflow while the dropped ids are not
+                                    expired, instead of accepting them.
+        """
+        self.maxsize = maxsize
+        self.fail_closed = fail_closed
+        self._lock = threading.Lock()
+        self._entries = {}
+        # Heap of (expires_at, token_id), evicted from the smallest expiry
+        self._expiries = []
+        # (evicted_at, expires_at) of the unexpired ids dropped when full
+        self._overflow = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def overflowed(self):
+        """
+        True while ids dropped when the blocklist was full are not expired.
+        """
+        overflow = self._overflow
+        return overflow is not None and overflow[1] > time.time()
+
+    def add(self, token_id, expires_at):
+        with self._lock:
+            current = self._entries.get(token_id)
+            if expires_at <= time.time() or (current is not None and current >= expires_at):
+                return
+            self._entries[token_id] = expires_at
+            heapq.heappush(self._expiries, (expires_at, token_id))
+            self._evict()
+
+    def contains(self, token_id):
+        expires_at = self._entries.get(token_id)
+        if expires_at is None:
+            return False
+        if expires_at <= time.time():
+            with self._lock:
+                self._evict()
+            return False
+        return True
+
+    def is_revoked(self, claims):
+        if super().is_revoked(claims):
+            return True
+        if not self.fail_closed or not self.overflowed:
+            return False
+        # A token issued after the overflow cannot be one of the dropped ids
+        issued_at = claims.get("iat", claims.get("auth_time"))
+        return issued_at is None or issued_at <= self._overflow[0]
+
+    def _evict(self):
+        now = time.time()
+        expiries = self._expiries
+        while expiries and (expiries[0][0] <= now or len(self._entries) > self.maxsize):
+            expires_at, token_id = heapq.heappop(expiries)
+            # Skip the entries of ids revoked again with another expiry
+            if self._entries.get(token_id) == expires_at:
+                del self._entries[token_id]
+                if expires_at > now:
+                    self._overflowed(now, expires_at)
+
+    def _overflowed(self, now, expires_at):
+        if not self.overflowed:
+            logger.warning(f"Blocklist is full ({self.maxsize} ids), revoked tokens are "
+                           f"dropped before they expire and "
+                           f"{'rejected' if self.fail_closed else 'accepted again'}. "
+                           f"Raise COGNITO_BLOCKLIST_SIZE or use a RedisBlocklist.")
+            self._overflow = (now, expires_at)
+        else:
+            self._overflow = (now, max(expires_at, self._overflow[1]))
+
+
+class RedisBlocklist(Blocklist):
+    """
+    Blocklist on a Redis server, shared by all processes; Redis drops the
+    ids when their tokens expire. Works with any client exposing the
+    redis-py `get` and `set(name, value, ex=...)` methods.
+    """
+
+    def __init__(self, client, prefix=DEFAULT_REDIS_BLOCKLIST_PREFIX):
+        """
+        Create the Redis blocklist.
+        :param client:          Redis client, e.g. `redis.Redis(...)`.
+        :param prefix (str):    Prefix of the revoked id keys.
+        """
+        self.client = client
+        self.prefix = prefix
+
+    def add(self, token_id, expires_at):
+        ttl = int(expires_at - time.time()) + 1
+        if ttl > 0:
+            self.client.set(self.prefix + token_id, "1", ex=ttl)
+
+    def contains(self, token_id):
+        return self.client.get(self.prefix + token_id) is not None
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+File to collapse concurrent calls for the same resource into one.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+DEFAULT_RESULT_TTL = 0
+DEFAULT_RESULT_CACHE_SIZE = 1024
+
+
+class _Call(object):
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Thread safe single-flight group. Concurrent callers of :meth:`run` with
+    the same key wait on one in-flight call and share its result or error.
+    Optionally, results are kept for `result_ttl` seconds so callers which
+    arrive just after the call completed reuse it too.
+    """
+
+    def __init__(self, result_ttl=DEFAULT_RESULT_TTL,
+                 maxsize=DEFAULT_RESULT_CACHE_SIZE):
+        """
+        Create the single-flight group.
+        :param result_ttl (int): Seconds to keep results, 0 to not keep them.
+        :param maxsize (int):    Maximum number of results to keep.
+        """
+        self.result_ttl = result_ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._results = OrderedDict()
+
+    def run(self, key, fn):
+        """
+        Method to call `fn` once for all concurrent callers with `key`.
+        :param key:         Key of the resource, must be hashable.
+        :param fn:          Callable without arguments doing the call.
+        :return result:     Result of `fn`, shared by all callers.
+        """
+        with self._lock:
+            result = self._cached(key)
+            if result is not None:
+                return result
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as exception:
+            call.error = exception
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.error is None:
+                    self._remember(key, call.result)
+            call.event.set()
+        return call.result
+
+    def forget(self, key):
+        """
+        Method to drop the kept result of a key.
+        """
+        with self._lock:
+            self._results.pop(key, None)
+
+    def _cached(self, key):
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        result, expires = entry
+        if expires <= time.monotonic():
+            del self._results[key]
+            return None
+        return result
+
+    def _remember(self, key, result):
+        if not self.result_ttl or result is None:
+            return
+        self._results[key] = (result, time.monotonic() + self.result_ttl)
+        self._results.move_to_end(key)
+        while len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+File to serve several AWS Cognito user pools / app clients from one
+:class:`CognitoAuthManager`. Each tenant gets its own settings, validation
+profile, JWKS cache, verified-token cache and pooled HTTP clients. The
+tenant of a request is resolved by host, by path prefix (first path
+segment) or, for bearer tokens on shared hosts, by the token `iss`, each
+with one dict lookup.
+"""
+
+import logging
+from .config import CognitoSettings
+from .http_client import CognitoHttpClient
+from .http_client import AsyncCognitoHttpClient
+from .validation import ValidationProfile
+from .crypto import get_crypto_backend
+from .jwks import JwksCache
+from .jwks import FileJwksBackend
+from .jwks import AsyncJwksCache
+from .jwks import LocalJwksSource
+from .jwks import DEFAULT_JWKS_TTL
+from .jwks import DEFAULT_JWKS_MIN_REFRESH_INTERVAL
+from .token_cache import VerifiedTokenCache
+from .token_cache import DEFAULT_TOKEN_CACHE_SIZE
+from .metrics import NULL_METRICS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT = "default"
+TENANT_HOSTS_KEY = "COGNITO_TENANT_HOSTS"
+TENANT_PATH_PREFIX_KEY = "COGNITO_TENANT_PATH_PREFIX"
+
+
+class CognitoTenant(object):
+    """
+    AWS Cognito user pool / app client served by the manager, with its own
+    caches and clients. The :class:`CognitoAuthManager` holds the same
+    attributes for the default tenant of the app config.
+    """
+
+    __slots__ = ("name", "hosts", "path_prefix", "settings", "crypto_backend",
+                 "validation", "http_client", "key_cache", "async_http_client",
+                 "async_key_cache", "token_cache")
+
+    def __init__(self, name, app_config, metrics=NULL_METRICS):
+        """
+        Create the tenant.
+        :param name (str):          Name of the tenant.
+        :param app_config (dict):   COGNITO_* settings of the tenant.
+        :param metrics (Metrics):   Metrics of the JWKS cache.
+        :raises RuntimeError:       If a required setting is missing.
+        """
+        self.name = name
+        self.hosts = frozenset(host.lower() for host in app_config.get(TENANT_HOSTS_KEY) or ())
+        self.path_prefix = app_config.get(TENANT_PATH_PREFIX_KEY)
+        self.settings = CognitoSettings.from_config(app_config)
+        self.crypto_backend = get_crypto_backend(app_config.get("COGNITO_CRYPTO_BACKEND"))
+        self.validation = ValidationProfile.from_settings(self.settings, app_config,
+                                                          self.crypto_backend)
+        self.http_client = CognitoHttpClient.from_config(app_config)
+        # A local key set is loaded without network, nothing to share
+        local_source = LocalJwksSource.from_config(app_config)
+        # Share the key set between the worker processes of a node
+        jwks_cache_file = app_config.get("COGNITO_JWKS_CACHE_FILE")
+        if local_source is not None:
+            jwks_cache_file = None
+        self.key_cache = JwksCache(
+            ttl=app_config.get("COGNITO_JWKS_TTL", DEFAULT_JWKS_TTL),
+            min_refresh_interval=app_config.get(
+                "COGNITO_JWKS_MIN_REFRESH_INTERVAL",
+                DEFAULT_JWKS_MIN_REFRESH_INTERVAL),
+            http_client=self.http_client,
+            shared_backend=FileJwksBackend(jwks_cache_file) if jwks_cache_file else None,
+            metrics=metrics,
+            crypto_backend=self.crypto_backend,
+            local_source=local_source)
+        self.async_http_client = AsyncCognitoHttpClient.from_config(app_config)
+        self.async_key_cache = AsyncJwksCache(self.key_cache,
+                                              self.async_http_client)
+        self.token_cache = VerifiedTokenCache(
+            maxsize=app_config.get("COGNITO_TOKEN_CACHE_SIZE",
+                                   DEFAULT_TOKEN_CACHE_SIZE))
+
+    def __repr__(self):
+        return f"CognitoTenant(name={self.name!r}, issuer={self.settings.issuer!r})"
+
+    @classmethod
+    def from_app_config(cls, name, app_config, overrides, metrics=NULL_METRICS):
+        """
+        Method to create a tenant of the COGNITO_TENANTS setting. Settings
+        which are not overridden are inherited from the app config, except
+        the shared JWKS file which gets a per tenant name.
+        :param name (str):          Name of the tenant.
+        :param app_config (dict):   Flask application config.
+        :param overrides (dict):    COGNITO_* settings of the tenant.
+        :param metrics (Metrics):   Metrics of the JWKS cache.
+        :return tenant (CognitoTenant)
+        """
+        tenant_config = dict(app_config)
+        for key in (TENANT_HOSTS_KEY, TENANT_PATH_PREFIX_KEY, "COGNITO_JWKS"):
+            tenant_config.pop(key, None)
+        jwks_cache_file = tenant_config.get("COGNITO_JWKS_CACHE_FILE")
+        if jwks_cache_file:
+            tenant_config["COGNITO_JWKS_CACHE_FILE"] = f"{jwks_cache_file}.{name}"
+        tenant_config.update(overrides)
+        return cls(name, tenant_config, metrics=metrics)
+
+    def close(self):
+        self.http_client.close()
+        self.async_http_client.close()
+
+
+class TenantRegistry(object):
+    """
+    Tenants of a :class:`CognitoAuthManager`, indexed by name, host, path
+    prefix and issuer.
+    """
+
+    def __init__(self):
+        self.by_name = {}
+        self.by_host = {}
+        self.by_path_prefix = {}
+        self.by_issuer = {}
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def __iter__(self):
+        return iter(self.by_name.values())
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def register(self, tenant, resolvable=True):
+        """
+        Method to add a tenant to the registry.
+        :param tenant (CognitoTenant):  The tenant.
+        :param resolvable (bool):       Index the hosts and path prefix, False
+                                        for the default tenant.
+        :raises RuntimeError:           If a host, path prefix or issuer is
+                                        already used by another tenant.
+        """
+        indexes = [(self.by_issuer, tenant.settings.issuer)]
+        if resolvable:
+            indexes.extend((self.by_host, host) for host in tenant.hosts)
+            if tenant.path_prefix:
+                indexes.append((self.by_path_prefix, "/" + tenant.path_prefix.strip("/")))
+        for index, value in indexes:
+            other = index.get(value)
+            if other is not None and other is not tenant:
+                raise RuntimeError(
+                    f"{value} of tenant {tenant.name} is already used by tenant {other.name}.")
+        self.by_name[tenant.name] = tenant
+        for index, value in indexes:
+            index[value] = tenant
+
+    def for_request(self, request):
+        """
+        Method to resolve the tenant of a request by host, then by the first
+        segment of the path.
+        :param request:             Flask request.
+        :return tenant (CognitoTenant): The tenant or None if not resolved.
+        """
+        host = request.host.lower()
+        tenant = self.by_host.get(host)
+        if tenant is None and ":" in host:
+            tenant = self.by_host.get(host.rsplit(":", 1)[0])
+        if tenant is None and self.by_path_prefix:
+            segment = request.path.split("/", 2)[1]
+            tenant = self.by_path_prefix.get("/" + segment)
+        return tenant
+
+    def for_issuer(self, issuer):
+        """
+        Method to resolve the tenant of a token by its `iss` claim.
+        :param issuer (str):        Unverified `iss` claim of the token.
+        :return tenant (CognitoTenant): The tenant or None if not resolved.
+        """
+        return self.by_issuer.get(issuer)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+File to break the authentication of a request down into timed phases:
+    * config            Settings resolution and login state lookup.
+    * token_post        The `/oauth2/token` call.
+    * json_parse        Parsing of the token response.
+    * header_parse      Parsing of the token headers and tenant resolution.
+    * key_lookup        JWKS key lookup, fetch included.
+    * signature         Signature verification and claims validation.
+    * session_write     Session update after the login.
+With COGNITO_PHASE_TIMING set for a request, the seconds spent per phase are
+kept in `flask.g.cognito_timings` and, with COGNITO_SERVER_TIMING, sent in a
+`Server-Timing` response header for the browser devtools. Requests which are
+not timed use a no-op timer.
+"""
+
+import time
+import random
+from flask import g
+from flask import has_request_context
+from flask import after_this_request
+from flask import request
+from .config import Config
+
+config = Config()
+
+SERVER_TIMING_PREFIX = "cognito-"
+
+
+class _Phase(object):
+    __slots__ = ("phases", "name", "started")
+
+    def __init__(self, phases, name):
+        self.phases = phases
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        self.phases[self.name] = self.phases.get(self.name, 0) + elapsed
+
+
+class _NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class PhaseTimer(object):
+    """
+    Seconds spent per phase in a request. A phase entered several times,
+    e.g. the verification of the access and the id token, accumulates.
+    """
+
+    __slots__ = ("phases",)
+
+    enabled = True
+
+    def __init__(self):
+        self.phases = {}
+
+    def phase(self, name: str):
+        """
+        Method to time a block as a phase.
+        :param name (str):  Name of the phase, e.g. `token_post`.
+        :return:            Context manager timing its block.
+        """
+        return _Phase(self.phases, name)
+
+    def server_timing(self):
+        """
+        Method to format the phases as a `Server-Timing` header value, in
+        milliseconds.
+        """
+        return ", ".join(f"{SERVER_TIMING_PREFIX}{name};dur={seconds * 1000:.3f}"
+                         for name, seconds in self.phases.items())
+
+    def add_header(self, response):
+        if self.phases:
+            value = self.server_timing()
+            existing = response.headers.get("Server-Timing")
+            response.headers["Server-Timing"] = f"{existing}, {value}" if existing else value
+        return response
+
+
+class NullPhaseTimer(object):
+    """
+    No-op timer of the requests which are not timed.
+    """
+
+    __slots__ = ()
+
+    enabled = False
+
+    def phase(self, name: str):
+        return _NULL_PHASE
+
+
+NULL_PHASE_TIMER = NullPhaseTimer()
+
+
+def should_time(policy, request):
+    """
+    Method to decide if a request is timed.
+    :param policy:      COGNITO_PHASE_TIMING: a bool, a sampling rate between
+                        0 and 1, or a callable taking the request.
+    :param request:     Flask request.
+    :return timed (bool)
+    """
+    if callable(policy):
+        return bool(policy(request))
+    if policy is None or isinstance(policy, bool):
+        return bool(policy)
+    return random.random() < policy
+
+
+def get_phase_timer():
+    """
+    Method to get the phase timer of the current request, decided once per
+    request. A timed request exposes its phases in `flask.g.cognito_timings`.
+    :return timer:  :class:`PhaseTimer`, or the no-op timer if the request is
+                    not timed.
+    """
+    timer = g.get('cognito_phase_timer')
+    if timer is not None:
+        return timer
+    timer = NULL_PHASE_TIMER
+    if has_request_context():
+        auth_manager = config.get_auth_manager
+        if auth_manager.phase_timing and should_time(auth_manager.phase_timing, request):
+            timer = PhaseTimer()
+            g.cognito_timings = timer.phases
+            if auth_manager.server_timing:
+                after_this_request(timer.add_header)
+    g.cognito_phase_timer = timer
+    return timer
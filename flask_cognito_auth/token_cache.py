@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+File to cache the claims of verified AWS Cognito bearer tokens.
+Repeated calls with the same token skip the RSA signature verification until
+the token expires.
+"""
+
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+DEFAULT_TOKEN_CACHE_SIZE = 1024
+
+
+def token_hash(token: str):
+    """
+    Method to get the cache key of a token, so raw tokens are never kept
+    as dictionary keys.
+    :param token (str):   A signed JWS.
+    :return digest (str): SHA-256 hex digest of the token.
+    """
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class VerifiedTokenCache(object):
+    """
+    Thread safe, bounded LRU cache of verified token claims keyed by token
+    hash. Entries are evicted once the token's `exp` claim has passed.
+    A `maxsize` of 0 disables the cache.
+    """
+
+    def __init__(self, maxsize=DEFAULT_TOKEN_CACHE_SIZE):
+        """
+        Create the verified token cache.
+        :param maxsize (int): Maximum number of tokens to keep.
+        """
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, token: str):
+        """
+        Method to get the cached claims of a token.
+        :param token (str):   A signed JWS.
+        :return claims (dict): The verified claims or None if not cached or
+                               expired.
+        """
+        if not self.maxsize:
+            return None
+        key = token_hash(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            claims, expires = entry
+            if expires <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return claims
+
+    def put(self, token: str, claims: dict):
+        """
+        Method to cache the claims of a verified token. Tokens without an
+        `exp` claim are not cached.
+        :param token (str):    A signed JWS which passed verification.
+        :param claims (dict):  The verified claims of the token.
+        """
+        expires = claims.get("exp")
+        if not self.maxsize or not expires or expires <= time.time():
+            return
+        key = token_hash(token)
+        with self._lock:
+            self._entries[key] = (claims, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Method to drop all cached tokens.
+        """
+        with self._lock:
+            self._entries.clear()
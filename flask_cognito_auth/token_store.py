@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+File to keep the session informations of logged in users on the server.
+With a token store set on the :class:`CognitoAuthManager`, the Flask session
+cookie only carries an opaque session id; the user informations and the
+refresh token stay on the server and can be revoked on logout.
+"""
+
+import json
+import time
+import secrets
+import threading
+from collections import OrderedDict
+
+DEFAULT_TOKEN_STORE_SIZE = 10000
+DEFAULT_REDIS_PREFIX = "flask-cognito-auth:session:"
+
+
+def new_session_id():
+    """
+    Method to generate an opaque, unguessable session id.
+    :return sid (str): URL safe session id.
+    """
+    return secrets.token_urlsafe(32)
+
+
+class TokenStore(object):
+    """
+    Interface of the server-side session stores.
+    """
+
+    def get(self, sid: str):
+        """
+        Method to get the informations of a session.
+        :param sid (str):   Session id.
+        :return data (dict): The session informations or None if not found.
+        """
+        raise NotImplementedError
+
+    def set(self, sid: str, data: dict, ttl: int):
+        """
+        Method to store the informations of a session.
+        :param sid (str):   Session id.
+        :param data (dict): JSON serializable session informations.
+        :param ttl (int):   Seconds to keep the session.
+        """
+        raise NotImplementedError
+
+    def delete(self, sid: str):
+        """
+        Method to revoke a session.
+        :param sid (str):   Session id.
+        """
+        raise NotImplementedError
+
+
+class MemoryTokenStore(TokenStore):
+    """
+    In process, thread safe token store. Sessions are kept in a bounded LRU
+    and expire after their ttl. Sessions are not shared between processes.
+    """
+
+    def __init__(self, maxsize=DEFAULT_TOKEN_STORE_SIZE):
+        """
+        Create the in memory token store.
+        :param maxsize (int): Maximum number of sessions to keep.
+        """
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, sid: str):
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            data, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[sid]
+                return None
+            self._entries.move_to_end(sid)
+            return data
+
+    def set(self, sid: str, data: dict, ttl: int):
+        with self._lock:
+            self._entries[sid] = (data, time.monotonic() + ttl)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid: str):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+
+class RedisTokenStore(TokenStore):
+    """
+    Token store on a Redis server, shared by all processes. Works with any
+    client exposing the redis-py `get`, `set(name, value, ex=...)` and
+    `delete` methods.
+    """
+
+    def __init__(self, client, prefix=DEFAULT_REDIS_PREFIX):
+        """
+        Create the Redis token store.
+        :param client:          Redis client, e.g. `redis.Redis(...)`.
+        :param prefix (str):    Prefix of the session keys.
+        """
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, sid: str):
+        value = self.client.get(self.prefix + sid)
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        return json.loads(value)
+
+    def set(self, sid: str, data: dict, ttl: int):
+        self.client.set(self.prefix + sid, json.dumps(data), ex=int(ttl))
+
+    def delete(self, sid: str):
+        self.client.delete(self.prefix + sid)
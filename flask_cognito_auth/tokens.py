@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+"""
+File to hold the tokens returned by the AWS Cognito token endpoint.
+"""
+
+
+class TokenSet(object):
+    """
+    Tokens of an AWS Cognito `/oauth2/token` response, parsed once.
+    After verification the claims of the access and id token are kept in
+    `access_claims` and `id_claims`.
+    """
+
+    __slots__ = ("access_token", "id_token", "refresh_token", "expires_in",
+                 "token_type", "access_claims", "id_claims")
+
+    def __init__(self, access_token: str, id_token: str,
+                 refresh_token: str = None, expires_in: int = None,
+                 token_type: str = None):
+        """
+        Create the token set.
+        :param access_token (str):  JWT access token.
+        :param id_token (str):      JWT id token.
+        :param refresh_token (str): Refresh token, if granted.
+        :param expires_in (int):    Seconds until the tokens expire.
+        :param token_type (str):    Token type, `Bearer` for AWS Cognito.
+        """
+        self.access_token = access_token
+        self.id_token = id_token
+        self.refresh_token = refresh_token
+        self.expires_in = expires_in
+        self.token_type = token_type
+        self.access_claims = None
+        self.id_claims = None
+
+    def __repr__(self):
+        # Never put the tokens in logs
+        return f"TokenSet(token_type={self.token_type!r}, expires_in={self.expires_in!r})"
+
+    @classmethod
+    def from_response(cls, payload: dict):
+        """
+        Method to create the token set from the parsed JSON of a token
+        endpoint response.
+        :param payload (dict):  Parsed JSON response.
+        :raises ValueError:     If the access or id token is missing.
+        """
+        if not isinstance(payload, dict):
+            raise ValueError("AWS Cognito token response is not a JSON object.")
+        access_token = payload.get("access_token")
+        id_token = payload.get("id_token")
+        if not access_token or not id_token:
+            raise ValueError("AWS Cognito token response is missing tokens.")
+        return cls(access_token=access_token,
+                   id_token=id_token,
+                   refresh_token=payload.get("refresh_token"),
+                   expires_in=payload.get("expires_in"),
+                   token_type=payload.get("token_type"))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+File to expose the AWS Cognito user of the current request as
+`current_cognito_user`. The user is built lazily on first access in a
+request, from the verified bearer token claims or from the session written
+by :func:`update_session`, and kept in `flask.g.cognito_user`.
+"""
+
+from flask import g
+from werkzeug.local import LocalProxy
+from .decorators import get_session_info
+from .decorators import get_cognito_groups
+
+
+class CognitoUser(object):
+    """
+    AWS Cognito user of a request. Anonymous requests get a user with all
+    values None and `is_authenticated` False.
+    """
+
+    __slots__ = ("username", "id", "groups", "email", "expires")
+
+    def __init__(self, username: str = None, id: str = None, groups=(),
+                 email: str = None, expires=None):
+        """
+        Create the user.
+        :param username (str):      AWS Cognito username.
+        :param id (str):            AWS Cognito user id, the "sub" claim.
+        :param groups (frozenset):  AWS Cognito groups of the user.
+        :param email (str):         Email of the user.
+        :param expires (int):       Expiry of the session or token.
+        """
+        self.username = username
+        self.id = id
+        self.groups = frozenset(groups or ())
+        self.email = email
+        self.expires = expires
+
+    @property
+    def is_authenticated(self):
+        return self.id is not None
+
+    def in_group(self, group: str):
+        return group in self.groups
+
+    def __repr__(self):
+        return f"CognitoUser(username={self.username!r}, id={self.id!r})"
+
+    @classmethod
+    def from_claims(cls, claims: dict, groups=None):
+        """
+        Method to build the user of verified token claims. Access tokens
+        carry the username in "username", id tokens in "cognito:username".
+        :param claims (dict):       Verified token claims.
+        :param groups (frozenset):  The groups, read from the claims if None.
+        :return user (CognitoUser)
+        """
+        if groups is None:
+            groups = claims.get('cognito:groups')
+        return cls(username=claims.get('cognito:username', claims.get('username')),
+                   id=claims.get('sub'),
+                   groups=groups,
+                   email=claims.get('email'),
+                   expires=claims.get('exp'))
+
+
+def get_current_cognito_user():
+    """
+    Method to get the AWS Cognito user of the current request, built once
+    per request from the bearer token claims set by :func:`token_required`
+    or from the session of the logged in user.
+    :return user (CognitoUser): The user, anonymous if not authenticated.
+    """
+    if 'cognito_user' in g:
+        return g.cognito_user
+
+    claims = g.get('cognito_claims')
+    if claims is not None:
+        user = CognitoUser.from_claims(claims, get_cognito_groups())
+    else:
+        info = get_session_info()
+        if info.get('username') is None:
+            user = CognitoUser()
+        else:
+            user = CognitoUser(username=info.get('username'),
+                               id=info.get('id'),
+                               groups=info.get('groups'),
+                               email=info.get('email'),
+                               expires=info.get('expires'))
+            # Share the group set with groups_required
+            g.setdefault('cognito_groups', user.groups)
+    g.cognito_user = user
+    return user
+
+
+current_cognito_user = LocalProxy(get_current_cognito_user)
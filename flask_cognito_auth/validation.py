@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+"""
+File to validate the AWS Cognito JWT claims with a profile precomputed once
+per application: the pinned signing algorithm, the expected issuer, the app
+client id and the clock skew leeway. Each verification then runs one fixed
+code path: the signature check of the crypto backend, then the claims.
+"""
+
+import time
+import base64
+import hashlib
+from jose.exceptions import JWTClaimsError
+from jose.exceptions import ExpiredSignatureError
+from .crypto import get_crypto_backend
+
+DEFAULT_JWT_ALGORITHMS = ("RS256",)
+DEFAULT_JWT_LEEWAY = 0
+TOKEN_USE_ACCESS = "access"
+TOKEN_USE_ID = "id"
+AT_HASH_FUNCTIONS = {"RS256": hashlib.sha256,
+                     "RS384": hashlib.sha384,
+                     "RS512": hashlib.sha512}
+
+
+def numeric_claim(claims: dict, name: str, label: str):
+    """
+    Method to read a NumericDate claim.
+    :param claims (dict):   The claims set.
+    :param name (str):      Name of the claim, e.g. `exp`.
+    :param label (str):     Label of the claim in the error message.
+    :return value (float):  The claim value.
+    :raises JWTClaimsError: If the claim is not a number.
+    """
+    value = claims[name]
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise JWTClaimsError(f"{label} claim ({name}) must be an integer.")
+    return value
+
+
+def calculate_at_hash(access_token: str, algorithm: str):
+    """
+    Method to compute the "at_hash" of an access token: the left half of its
+    hash, base64url encoded.
+    :param access_token (str):  The access token.
+    :param algorithm (str):     Signing algorithm of the id token.
+    :return at_hash (str):      The expected "at_hash" claim.
+    """
+    digest = AT_HASH_FUNCTIONS[algorithm](access_token.encode("utf-8")).digest()
+    return base64.urlsafe_b64encode(digest[:len(digest) // 2]).decode("ascii").rstrip("=")
+
+
+class ValidationProfile(object):
+    """
+    Immutable claims validation profile of the :class:`CognitoAuthManager`.
+    AWS Cognito id tokens carry the app client id in "aud", access tokens in
+    "client_id"; the "token_use" claim tells them apart.
+    """
+
+    __slots__ = ("algorithms", "issuer", "client_id", "leeway",
+                 "bearer_token_use", "crypto_backend")
+
+    def __init__(self, issuer, client_id, algorithms=DEFAULT_JWT_ALGORITHMS,
+                 leeway=DEFAULT_JWT_LEEWAY, bearer_token_use=None,
+                 crypto_backend=None):
+        """
+        Create the validation profile.
+        :param issuer (str):        Expected "iss" claim, the user pool URL.
+        :param client_id (str):     App client id the tokens are issued to.
+        :param algorithms (tuple):  Accepted signing algorithms.
+        :param leeway (int):        Seconds of clock skew accepted on "exp",
+                                    "nbf" and "iat".
+        :param bearer_token_use (str): "token_use" required on bearer
+                                    tokens, `access` or `id`, any if None.
+        :param crypto_backend:      :class:`CryptoBackend` verifying the
+                                    signatures, the default backend if None.
+        """
+        values = {"algorithms": list(algorithms),
+                  "issuer": issuer,
+                  "client_id": client_id,
+                  "leeway": leeway,
+                  "bearer_token_use": bearer_token_use,
+                  "crypto_backend": crypto_backend or get_crypto_backend()}
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ValidationProfile is immutable")
+
+    def __reduce__(self):
+        # Sent to the worker processes of verify_many
+        return (self.__class__, (self.issuer, self.client_id, self.algorithms,
+                                 self.leeway, self.bearer_token_use,
+                                 self.crypto_backend))
+
+    @classmethod
+    def from_settings(cls, settings, app_config, crypto_backend=None):
+        """
+        Method to build the profile of a flask application.
+        :param settings (CognitoSettings):  Resolved AWS Cognito settings.
+        :param app_config (dict):           Flask application config.
+        :param crypto_backend:              :class:`CryptoBackend` verifying
+                                            the signatures.
+        :return profile (ValidationProfile): The validation profile.
+        """
+        algorithms = app_config.get("COGNITO_JWT_ALGORITHMS", DEFAULT_JWT_ALGORITHMS)
+        if isinstance(algorithms, str):
+            algorithms = (algorithms,)
+        return cls(issuer=settings.issuer,
+                   client_id=settings.client_id,
+                   algorithms=algorithms,
+                   leeway=app_config.get("COGNITO_JWT_LEEWAY", DEFAULT_JWT_LEEWAY),
+                   bearer_token_use=app_config.get("COGNITO_BEARER_TOKEN_USE"),
+                   crypto_backend=crypto_backend)
+
+    def check_header(self, header: dict):
+        """
+        Method to reject a token signed with an algorithm which is not
+        pinned, before the key lookup.
+        :param header (dict):   The unverified header of the token.
+        :raises JWTError:       If the algorithm is not accepted.
+        """
+        if header.get("alg") not in self.algorithms:
+            raise JWTClaimsError(f"Token algorithm {header.get('alg')} is not allowed.")
+
+    def decode(self, token: str, header: dict, key, access_token: str = None,
+               token_use: str = None):
+        """
+        Method to verify the signature of a token and validate its claims.
+        :param token (str):         A signed JWS to be verified.
+        :param header (dict):       The unverified header of the token.
+        :param key:                 Public key for the "kid" of the token,
+                                    constructed by the crypto backend.
+        :param access_token (str):  An access token string to validate the
+                                    "at_hash" claim.
+        :param token_use (str):     Expected "token_use", `access` or `id`,
+                                    any if None.
+        :return claims (dict):      The dict representation of the claims set.
+        :raises JWTError:           If the token is not valid.
+        """
+        claims = self.crypto_backend.verify(token, key, self.algorithms)
+        self.check_claims(claims, header.get("alg"), access_token, token_use)
+        return claims
+
+    def check_claims(self, claims: dict, algorithm: str = None,
+                     access_token: str = None, token_use: str = None):
+        """
+        Method to validate the registered claims, the "token_use" claim and
+        the app client id of a verified token.
+        :param claims (dict):       The verified claims set.
+        :param algorithm (str):     Signing algorithm of the token.
+        :param access_token (str):  An access token string to validate the
+                                    "at_hash" claim.
+        :param token_use (str):     Expected "token_use", any if None.
+        :raises JWTClaimsError:     If a claim is not valid.
+        """
+        now = time.time()
+        if "iat" in claims:
+            numeric_claim(claims, "iat", "Issued At")
+        if "nbf" in claims and numeric_claim(claims, "nbf", "Not Before") > now + self.leeway:
+            raise JWTClaimsError("The token is not yet valid (nbf)")
+        if "exp" in claims and numeric_claim(claims, "exp", "Expiration Time") < now - self.leeway:
+            raise ExpiredSignatureError("Signature has expired.")
+        if claims.get("iss") != self.issuer:
+            raise JWTClaimsError("Invalid issuer")
+
+        if "at_hash" in claims:
+            if not access_token:
+                raise JWTClaimsError("No access_token provided to compare against at_hash claim.")
+            if algorithm not in AT_HASH_FUNCTIONS:
+                raise JWTClaimsError("Unable to calculate at_hash to verify against token claims.")
+            if claims["at_hash"] != calculate_at_hash(access_token, algorithm):
+                raise JWTClaimsError("at_hash claim does not match access_token.")
+
+        claims_token_use = claims.get("token_use")
+        if token_use is not None and claims_token_use != token_use:
+            raise JWTClaimsError(
+                f"Invalid token_use: expected {token_use}, got {claims_token_use}.")
+
+        if claims_token_use == TOKEN_USE_ACCESS:
+            if claims.get("client_id") != self.client_id:
+                raise JWTClaimsError("Invalid client_id")
+            return
+
+        audience = claims.get("aud")
+        if audience is None:
+            if claims_token_use == TOKEN_USE_ID:
+                raise JWTClaimsError("Invalid audience")
+            return
+        if isinstance(audience, str):
+            audience = (audience,)
+        if self.client_id not in audience:
+            raise JWTClaimsError("Invalid audience")
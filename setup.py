@@ -42,6 +42,16 @@ base = [
     "python_jose"                # JOSE implementation in Python
 ]
 
+extras = {
+    "async": [
+        "httpx",                 # Non-blocking HTTP client for asyncio handlers
+        "Flask[async]"           # Flask async views
+    ],
+    "cryptography": [
+        "cryptography"           # Native RSA signature verification
+    ]
+}
+
 setups = []
 
 ir = (base)
@@ -131,8 +141,9 @@ def do_setup():
         include_package_data=True,
         setup_requires=setups,
         install_requires=requires,
+        extras_require=extras,
         license="MIT",
-        python_requires='>=3.4',
+        python_requires='>=3.8',
         classifiers=[
             'Development Status :: 5 - Production/Stable',
             'Environment :: Web Environment',
@@ -141,11 +152,11 @@ def do_setup():
             'Natural Language :: English',
             'License :: OSI Approved :: MIT License',
             'Operating System :: OS Independent',
-            'Programming Language :: Python :: 3.4',
-            'Programming Language :: Python :: 3.5',
-            'Programming Language :: Python :: 3.6',
-            'Programming Language :: Python :: 3.7',
             'Programming Language :: Python :: 3.8',
+            'Programming Language :: Python :: 3.9',
+            'Programming Language :: Python :: 3.10',
+            'Programming Language :: Python :: 3.11',
+            'Programming Language :: Python :: 3.12',
             'Topic :: Software Development :: Libraries :: Python Modules',
             'Topic :: Software Development :: Version Control :: Git',
         ],
@@ -1,12 +1,78 @@
 from flask_cognito_auth.config import Config
+from flask_cognito_auth.config import CognitoSettings
+from flask_cognito_auth import CognitoAuthManager
 from flask_cognito_auth.decorators import update_session
+from flask_cognito_auth.decorators import verify
+from flask_cognito_auth import decorators
+from flask_cognito_auth import token_required
+from flask_cognito_auth import callback_handler
+from flask_cognito_auth.token_cache import VerifiedTokenCache
+from flask_cognito_auth.token_cache import token_hash
+from flask_cognito_auth.singleflight import SingleFlight
+from flask_cognito_auth import refresh_handler
+from flask_cognito_auth import logout_handler
+from flask_cognito_auth import get_session_info
+from flask_cognito_auth import verify_many
+from flask_cognito_auth import groups_required
+from flask_cognito_auth import current_cognito_user
+from flask_cognito_auth import CognitoUser
+from flask_cognito_auth import MemoryBlocklist
+from flask_cognito_auth import RedisBlocklist
+from flask_cognito_auth.exceptions import TokenRevokedError
+from flask_cognito_auth.exceptions import CircuitOpenError
+from flask_cognito_auth.circuit_breaker import CircuitBreaker
+from flask_cognito_auth import MemoryTokenStore
+from flask_cognito_auth import MemoryStateStore
+from flask_cognito_auth import RedisStateStore
+from flask_cognito_auth import login_handler
+from flask_cognito_auth.login_state import code_challenge
+from flask_cognito_auth.timing import should_time
+from flask_cognito_auth import RedisTokenStore
+from flask_cognito_auth.tokens import TokenSet
+from flask_cognito_auth.http_client import CognitoHttpClient
+from flask_cognito_auth.http_client import CognitoRetry
+from flask_cognito_auth.http_client import AsyncCognitoHttpClient
+from flask_cognito_auth.jwks import AsyncJwksCache
+from flask_cognito_auth.jwks import FileJwksBackend
+from flask_cognito_auth.jwks import JwksRefresher
+from flask_cognito_auth import async_login_handler
+from flask_cognito_auth import async_callback_handler
+from flask_cognito_auth import async_verify
+from flask_cognito_auth.jwks import JwksCache
+from flask_cognito_auth.jwks import parse_max_age
+from flask_cognito_auth.crypto import JoseBackend
+from flask_cognito_auth.crypto import CRYPTO_BACKENDS
+from flask_cognito_auth.crypto import get_crypto_backend
+from flask_cognito_auth import MetricsSink
+from flask_cognito_auth import StatsdMetrics
+from flask_cognito_auth import EventSink
+from flask_cognito_auth import LoggingEventSink
+from flask_cognito_auth import AuthEvent
 from .server import app
 from .server import app_exception
 from .server import app_lazy
+from .server import cognito_keys
+from .server import CognitoKeys
+from .server import COGNITO_CONFIG
+from benchmarks import bench_auth
 import pytest
+import requests
+from jose import jwk
+from jose import JWTError
+from jose import jwt
+from jose.exceptions import ExpiredSignatureError
 from flask import Flask
 from flask import session
+from flask import jsonify
+from flask import g
+from flask import request
 from datetime import datetime
+import time
+import asyncio
+import threading
+import json
+import logging
+import os
 
 
 def test_cognito_config(app):
@@ -108,3 +174,1548 @@ def test_cognito_session(app):
         assert session['email'] == "myemail@domain.com"
         assert session['expires'] == datetime_now
         assert session['refresh_token'] == "mysupersecretrefreshtoken"
+
+
+class FakeResponse(object):
+    def __init__(self, payload, status_code=200, headers=None):
+        self.payload = payload
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return self.payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error")
+
+
+class FakeHttpClient(object):
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def get(self, url, **kwargs):
+        self.calls.append(("GET", url, kwargs))
+        return self.responses.pop(0)
+
+    def post(self, url, **kwargs):
+        self.calls.append(("POST", url, kwargs))
+        return self.responses.pop(0)
+
+
+class DownHttpClient(FakeHttpClient):
+    def get(self, url, **kwargs):
+        self.calls.append(("GET", url, kwargs))
+        raise requests.ConnectionError("JWKS endpoint is down")
+
+
+def test_cognito_jwks_cache(cognito_keys):
+    key1 = cognito_keys.public_jwk
+    key2 = dict(cognito_keys.public_jwk, kid="key2")
+    http_client = FakeHttpClient([
+        FakeResponse({"keys": [key1]},
+                     headers={"Cache-Control": "public, max-age=0"}),
+        FakeResponse({"keys": [key1, key2]}),
+        FakeResponse({}, status_code=503)])
+    calls = http_client.calls
+    cache = JwksCache(ttl=3600, min_refresh_interval=0,
+                      http_client=http_client, crypto_backend=JoseBackend())
+
+    # max-age=0 expires the key set immediately, so it is fetched again
+    assert cache.get_keys("https://jwks") == [key1]
+    assert isinstance(cache.get_key("https://jwks", "key2"), jwk.Key)
+    assert len(calls) == 2
+
+    # Fresh key set is served from the pre-built index
+    key = cache.get_key("https://jwks", cognito_keys.kid)
+    assert cache.get_key("https://jwks", cognito_keys.kid) is key
+    assert len(calls) == 2
+
+    # Unknown kid refreshes once and the stale key set survives the outage
+    assert cache.get_key("https://jwks", "key3") is None
+    assert len(calls) == 3
+    assert cache.keys == [key1, key2]
+
+
+def test_cognito_jwks_cache_outage(cognito_keys):
+    http_client = FakeHttpClient([
+        FakeResponse(cognito_keys.jwks, headers={"Cache-Control": "max-age=0"})])
+    calls = http_client.calls
+    cache = JwksCache(min_refresh_interval=60, http_client=http_client)
+    key = cache.get_key("https://jwks", cognito_keys.kid)
+    assert len(calls) == 1
+
+    # Expired key set, endpoint down: one fetch attempt per interval
+    cache.http_client = DownHttpClient([])
+    for _ in range(10):
+        assert cache.get_key("https://jwks", cognito_keys.kid) is key
+    assert len(cache.http_client.calls) == 1
+    assert 0 < cache.expires_in <= 60
+
+
+def test_cognito_jwks_cache_kid_miss_rate_limit():
+    http_client = FakeHttpClient(
+        [FakeResponse({"keys": [{"kid": "key1", "kty": "unknown"}]})] * 10)
+    calls = http_client.calls
+    cache = JwksCache(ttl=3600, min_refresh_interval=60,
+                      http_client=http_client)
+    for _ in range(10):
+        assert cache.get_key("https://jwks", "unknown") is None
+    assert len(calls) == 1
+    assert parse_max_age("max-age=300, public") == 300
+    assert parse_max_age(None) is None
+
+
+def test_cognito_verify(app, cognito_keys):
+    with app.test_request_context():
+        Config().get_auth_manager.jwt_key = cognito_keys.jwks["keys"]
+
+        token = cognito_keys.sign({"sub": "myuserid",
+                                   "aud": "123drfthinvdr57opQWerv56"})
+        assert verify(token)["sub"] == "myuserid"
+
+        token = cognito_keys.sign({"sub": "myuserid"},
+                                  headers={"kid": "unknown-kid"})
+        with pytest.raises(JWTError, match="unknown-kid"):
+            verify(token)
+
+
+def test_cognito_validation_profile(app, cognito_keys):
+    with app.test_request_context():
+        Config().get_auth_manager.jwt_key = cognito_keys.jwks["keys"]
+        tokens = cognito_tokens(cognito_keys)
+
+        assert verify(tokens["access_token"], token_use="access")["sub"] == "myuserid"
+        assert verify(tokens["id_token"], token_use="id")["sub"] == "myuserid"
+        # An access token is not accepted where an id token is expected
+        with pytest.raises(JWTError, match="token_use"):
+            verify(tokens["access_token"], token_use="id")
+
+        other_pool = cognito_keys.sign({"sub": "myuserid",
+                                        "iss": "https://cognito-idp.us-east-1.amazonaws.com/other"})
+        with pytest.raises(JWTError, match="issuer"):
+            verify(other_pool)
+
+        other_client = cognito_keys.sign({"sub": "myuserid",
+                                          "token_use": "access",
+                                          "client_id": "otherclient"})
+        with pytest.raises(JWTError, match="client_id"):
+            verify(other_client)
+
+        other_audience = cognito_keys.sign({"sub": "myuserid",
+                                            "token_use": "id",
+                                            "aud": "otherclient"})
+        with pytest.raises(JWTError, match="audience"):
+            verify(other_audience)
+
+        hs256 = jwt.encode({"sub": "myuserid"}, "secret", algorithm="HS256",
+                           headers={"kid": cognito_keys.kid})
+        with pytest.raises(JWTError, match="HS256"):
+            verify(hs256)
+
+
+@pytest.mark.parametrize("backend", sorted(CRYPTO_BACKENDS))
+def test_cognito_crypto_backend(backend, cognito_keys):
+    app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
+    app.config["COGNITO_CRYPTO_BACKEND"] = backend
+    auth_mgr = CognitoAuthManager(app)
+    auth_mgr.jwt_key = cognito_keys.jwks["keys"]
+    assert auth_mgr.validation.crypto_backend.name == backend
+    with app.test_request_context():
+        tokens = cognito_tokens(cognito_keys)
+        id_claims = cognito_keys.sign({"sub": "myuserid",
+                                       "token_use": "id",
+                                       "aud": "123drfthinvdr57opQWerv56",
+                                       "at_hash": "wronghash"})
+        assert verify(tokens["access_token"], token_use="access")["sub"] == "myuserid"
+        with pytest.raises(JWTError, match="at_hash"):
+            verify(id_claims, tokens["access_token"])
+
+        header, payload, signature = tokens["access_token"].split(".")
+        tampered = ".".join([header, tokens["id_token"].split(".")[1], signature])
+        with pytest.raises(JWTError, match="Signature verification failed"):
+            verify(tampered)
+        with pytest.raises(JWTError):
+            verify(f"{header}.{payload}")
+
+        expired = cognito_keys.sign({"sub": "myuserid",
+                                     "exp": int(time.time()) - 10})
+        with pytest.raises(ExpiredSignatureError):
+            verify(expired)
+
+
+def test_cognito_crypto_backend_unknown():
+    with pytest.raises(RuntimeError, match="COGNITO_CRYPTO_BACKEND"):
+        get_crypto_backend("unknown")
+
+
+def test_cognito_validation_leeway(cognito_keys):
+    app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
+    app.config["COGNITO_JWT_LEEWAY"] = 60
+    auth_mgr = CognitoAuthManager(app)
+    auth_mgr.jwt_key = cognito_keys.jwks["keys"]
+    with app.test_request_context():
+        token = cognito_keys.sign({"sub": "myuserid",
+                                   "exp": int(time.time()) - 10})
+        assert verify(token)["sub"] == "myuserid"
+
+
+def test_cognito_token_required(app, cognito_keys, monkeypatch):
+    app.extensions['cognito-flask-auth'].jwt_key = cognito_keys.jwks["keys"]
+
+    verified = []
+
+    def counting_verify(token, access_token=None, token_use=None):
+        verified.append(token)
+        return verify(token, access_token, token_use)
+
+    monkeypatch.setattr(decorators, "verify", counting_verify)
+
+    @app.route('/api', methods=['GET', 'OPTIONS'])
+    @token_required
+    def api():
+        claims = g.get("cognito_claims", {})
+        return jsonify(sub=claims.get("sub"))
+
+    token = cognito_keys.sign({"sub": "myuserid",
+                               "exp": int(time.time()) + 300})
+    client = app.test_client()
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.get('/api', headers=headers).get_json() == {"sub": "myuserid"}
+    assert client.get('/api', headers=headers).get_json() == {"sub": "myuserid"}
+    assert len(verified) == 1
+
+    assert client.get('/api').status_code == 401
+    assert client.get('/api', headers={"Authorization": "Bearer abc"}).status_code == 401
+    assert client.options('/api').status_code == 200
+
+    expired = cognito_keys.sign({"sub": "myuserid",
+                                 "exp": int(time.time()) - 10})
+    assert client.get('/api', headers={"Authorization": f"Bearer {expired}"}).status_code == 401
+
+
+def test_cognito_verified_token_cache():
+    cache = VerifiedTokenCache(maxsize=2)
+    exp = time.time() + 300
+    cache.put("token1", {"exp": exp})
+    cache.put("token2", {"exp": exp})
+    assert cache.get("token1") == {"exp": exp}
+    cache.put("token3", {"exp": exp})
+    # token2 is least recently used
+    assert cache.get("token2") is None
+    assert len(cache) == 2
+
+    cache.put("expired", {"exp": time.time() - 1})
+    cache.put("no-exp", {})
+    assert cache.get("expired") is None
+    assert cache.get("no-exp") is None
+
+
+def test_cognito_http_client():
+    http_client = CognitoHttpClient.from_config({"COGNITO_HTTP_POOL_SIZE": 4,
+                                                 "COGNITO_HTTP_READ_TIMEOUT": 5})
+    adapter = http_client.session.get_adapter("https://cognito-idp.us-east-1.amazonaws.com")
+    assert http_client.timeout == (3.05, 5)
+    assert adapter._pool_maxsize == 4
+
+    retry = CognitoRetry(total=3, status_forcelist=(500, 503))
+    assert retry.is_retry("GET", 503)
+    assert retry.is_retry("POST", 429)
+    # The authorization code is single use, server errors are not retried
+    assert not retry.is_retry("POST", 503)
+
+
+def test_cognito_callback(app, cognito_keys):
+    auth_mgr = app.extensions['cognito-flask-auth']
+    auth_mgr.jwt_key = cognito_keys.jwks["keys"]
+
+    exp = int(time.time()) + 3600
+    access_token = cognito_keys.sign({"sub": "myuserid", "exp": exp,
+                                      "token_use": "access",
+                                      "client_id": "123drfthinvdr57opQWerv56"})
+    id_token = cognito_keys.sign({"sub": "myuserid", "exp": exp,
+                                  "token_use": "id",
+                                  "aud": "123drfthinvdr57opQWerv56",
+                                  "cognito:username": "myusername",
+                                  "cognito:groups": ["mygroup1"],
+                                  "email": "myemail@domain.com"})
+    auth_mgr.http_client = FakeHttpClient([
+        FakeResponse({"access_token": access_token,
+                      "id_token": id_token,
+                      "refresh_token": "myrefreshtoken"})])
+
+    @app.route('/cognito/callback')
+    @callback_handler
+    def callback():
+        return jsonify(username=session["username"],
+                       groups=session["groups"],
+                       client_id=g.cognito_claims["client_id"],
+                       email=g.cognito_id_claims["email"])
+
+    client = app.test_client()
+    response = client.get('/cognito/callback?code=mycode')
+    assert response.get_json() == {"username": "myusername",
+                                   "groups": ["mygroup1"],
+                                   "client_id": "123drfthinvdr57opQWerv56",
+                                   "email": "myemail@domain.com"}
+    method, url, kwargs = auth_mgr.http_client.calls[0]
+    assert (method, url) == ("POST", "https://mycognitodomain.com/oauth2/token")
+    assert kwargs["data"]["code"] == "mycode"
+
+    auth_mgr.http_client = FakeHttpClient([FakeResponse({}, status_code=400)])
+    assert client.get('/cognito/callback?code=badcode').status_code == 500
+
+    auth_mgr.http_client = FakeHttpClient([FakeResponse({"access_token": access_token})])
+    assert client.get('/cognito/callback?code=mycode').status_code == 500
+
+    # Tokens failing the verification are an authentication error
+    for tokens in (cognito_tokens(cognito_keys, exp=int(time.time()) - 10),
+                   cognito_tokens(CognitoKeys(kid="otherkid"))):
+        auth_mgr.http_client = FakeHttpClient([FakeResponse(tokens)])
+        response = client.get('/cognito/callback?code=othercode')
+        assert response.status_code == 500
+        assert "Error" in json.loads(response.data)
+
+    # So are the tokens which cannot be verified, the JWKS endpoint is down
+    auth_mgr.key_cache.clear()
+    auth_mgr.key_cache.http_client = DownHttpClient([])
+    auth_mgr.http_client = FakeHttpClient([FakeResponse(cognito_tokens(cognito_keys))])
+    response = client.get('/cognito/callback?code=jwksdowncode')
+    assert response.status_code == 500
+    assert "Error" in json.loads(response.data)
+
+
+def test_cognito_token_set():
+    tokens = TokenSet.from_response({"access_token": "myaccesstoken",
+                                     "id_token": "myidtoken",
+                                     "refresh_token": "myrefreshtoken",
+                                     "expires_in": 3600,
+                                     "token_type": "Bearer"})
+    assert tokens.refresh_token == "myrefreshtoken"
+    assert tokens.expires_in == 3600
+    assert "myaccesstoken" not in repr(tokens)
+    with pytest.raises(ValueError):
+        TokenSet.from_response({"id_token": "myidtoken"})
+
+
+def test_cognito_settings():
+    settings = CognitoSettings.from_config(dict(COGNITO_CONFIG,
+                                                COGNITO_DOMAIN="mycognitodomain.com",
+                                                COGNITO_STATE="mystate"))
+    assert settings.domain == "https://mycognitodomain.com"
+    assert settings.exempt_methods == frozenset(["OPTIONS"])
+    assert settings.jwt_code_exchange_uri == "https://mycognitodomain.com/oauth2/token"
+    assert settings.public_key_uri == ("https://cognito-idp.us-east-1.amazonaws.com/"
+                                       "us-east-1_myPoolId/.well-known/jwks.json")
+    assert settings.login_uri == ("https://mycognitodomain.com/authorize"
+                                  "?client_id=123drfthinvdr57opQWerv56"
+                                  "&response_type=code&state=mystate"
+                                  "&redirect_uri=http://localhost:5000/cognito/callback")
+    with pytest.raises(AttributeError):
+        settings.client_id = "other"
+
+    # Missing settings fail when the extension is registered
+    app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
+    del app.config['COGNITO_CLIENT_SECRET']
+    with pytest.raises(RuntimeError, match="COGNITO_CLIENT_SECRET"):
+        CognitoAuthManager(app)
+
+
+def cognito_tokens(cognito_keys, exp=None):
+    exp = exp or int(time.time()) + 3600
+    access_token = cognito_keys.sign({"sub": "myuserid", "exp": exp,
+                                      "token_use": "access",
+                                      "client_id": "123drfthinvdr57opQWerv56"})
+    id_token = cognito_keys.sign({"sub": "myuserid", "exp": exp,
+                                  "token_use": "id",
+                                  "aud": "123drfthinvdr57opQWerv56",
+                                  "cognito:username": "myusername",
+                                  "cognito:groups": ["mygroup1"],
+                                  "email": "myemail@domain.com"})
+    return {"access_token": access_token,
+            "id_token": id_token,
+            "refresh_token": "myrefreshtoken"}
+
+
+def test_cognito_async_callback(app, cognito_keys):
+    httpx = pytest.importorskip("httpx")
+    pytest.importorskip("asgiref")
+    requests_seen = []
+    jwks_down = False
+
+    def handler(request):
+        requests_seen.append(request)
+        if request.url.path.endswith("jwks.json"):
+            if jwks_down:
+                return httpx.Response(503)
+            return httpx.Response(200, json=cognito_keys.jwks)
+        if b"code=expiredcode" in request.content:
+            return httpx.Response(200, json=cognito_tokens(cognito_keys, exp=1))
+        return httpx.Response(200, json=cognito_tokens(cognito_keys))
+
+    auth_mgr = app.extensions['cognito-flask-auth']
+    auth_mgr.async_http_client = AsyncCognitoHttpClient(
+        transport=httpx.MockTransport(handler))
+    auth_mgr.async_key_cache = AsyncJwksCache(auth_mgr.key_cache,
+                                              auth_mgr.async_http_client)
+
+    @app.route('/cognito/login')
+    @async_login_handler
+    async def cognitologin():
+        pass
+
+    @app.route('/cognito/callback')
+    @async_callback_handler
+    async def callback():
+        return jsonify(username=session["username"],
+                       scope_client=g.cognito_claims["client_id"])
+
+    @app.route('/async/me')
+    async def me():
+        token = request.headers["Authorization"].split()[1]
+        claims = await async_verify(token, token_use="access")
+        return jsonify(sub=claims["sub"])
+
+    client = app.test_client()
+    response = client.get('/cognito/login')
+    assert response.status_code == 302
+    assert response.headers["Location"] == auth_mgr.settings.login_uri
+
+    response = client.get('/cognito/callback?code=mycode')
+    assert response.get_json() == {"username": "myusername",
+                                   "scope_client": "123drfthinvdr57opQWerv56"}
+    token_request = requests_seen[0]
+    assert str(token_request.url) == "https://mycognitodomain.com/oauth2/token"
+    assert b"code=mycode" in token_request.content
+    assert len(requests_seen) == 2
+
+    assert client.get('/cognito/callback?code=expiredcode').status_code == 500
+
+    access_token = cognito_tokens(cognito_keys)["access_token"]
+    response = client.get('/async/me',
+                          headers={"Authorization": "Bearer " + access_token})
+    assert response.get_json() == {"sub": "myuserid"}
+
+    jwks_down = True
+    auth_mgr.key_cache.clear()
+    response = client.get('/cognito/callback?code=mycode')
+    assert response.status_code == 500
+    assert "Error" in json.loads(response.data)
+
+
+def test_cognito_async_jwks_single_flight(cognito_keys):
+    httpx = pytest.importorskip("httpx")
+    fetches = []
+
+    async def handler(request):
+        fetches.append(request)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json=cognito_keys.jwks)
+
+    http_client = AsyncCognitoHttpClient(transport=httpx.MockTransport(handler))
+    cache = AsyncJwksCache(JwksCache(min_refresh_interval=60), http_client)
+
+    async def lookups():
+        keys = await asyncio.gather(*[cache.get_key("https://jwks", cognito_keys.kid)
+                                      for _ in range(20)])
+        await http_client.aclose()
+        return keys
+
+    keys = asyncio.run(lookups())
+    assert len(fetches) == 1
+    assert all(key is keys[0] for key in keys)
+
+    # Event loops of concurrent requests share the fetch and the connections
+    release = threading.Event()
+
+    async def slow_handler(request):
+        fetches.append(request)
+        await asyncio.get_running_loop().run_in_executor(None, release.wait, 5)
+        return httpx.Response(200, json=cognito_keys.jwks)
+
+    http_client = AsyncCognitoHttpClient(transport=httpx.MockTransport(slow_handler))
+    cache = AsyncJwksCache(JwksCache(min_refresh_interval=60), http_client)
+    clients = []
+
+    async def request_lookup():
+        key = await cache.get_key("https://jwks", cognito_keys.kid)
+        clients.append(http_client.client)
+        return key
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(asyncio.run(request_lookup())))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(fetches) == 2
+    assert len(results) == 3 and all(key is results[0] for key in results)
+    assert all(client is clients[0] for client in clients)
+    client_loop = http_client.loop
+    http_client.close()
+    assert client_loop.is_closed()
+    http_client.close()
+
+
+def test_cognito_refresh_handler(app, cognito_keys):
+    auth_mgr = app.extensions['cognito-flask-auth']
+    auth_mgr.jwt_key = cognito_keys.jwks["keys"]
+    new_tokens = cognito_tokens(cognito_keys)
+    del new_tokens["refresh_token"]
+    auth_mgr.http_client = FakeHttpClient([FakeResponse(new_tokens)])
+
+    @app.route('/home')
+    @refresh_handler
+    def home():
+        return jsonify(username=session.get("username"),
+                       expires=session.get("expires"),
+                       refresh_token=session.get("refresh_token"))
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["expires"] = int(time.time()) + 3600
+        sess["refresh_token"] = "myrefreshtoken"
+
+    # Session is not near expiry, nothing to refresh
+    assert client.get('/home').get_json()["username"] is None
+    assert auth_mgr.http_client.calls == []
+
+    with client.session_transaction() as sess:
+        sess["expires"] = int(time.time()) + 10
+    response = client.get('/home').get_json()
+    assert response["username"] == "myusername"
+    assert response["expires"] > time.time() + 3000
+    assert response["refresh_token"] == "myrefreshtoken"
+    method, url, kwargs = auth_mgr.http_client.calls[0]
+    assert kwargs["data"]["grant_type"] == "refresh_token"
+
+    # Transient failures keep the session until it expires
+    auth_mgr.refresh_flight.forget(token_hash("myrefreshtoken"))
+    auth_mgr.http_client = FakeHttpClient([FakeResponse({}, status_code=503),
+                                           FakeResponse({}, status_code=503)])
+    with client.session_transaction() as sess:
+        sess["expires"] = int(time.time()) + 10
+    response = client.get('/home').get_json()
+    assert response["refresh_token"] == "myrefreshtoken"
+    assert len(auth_mgr.http_client.calls) == 1
+    with client.session_transaction() as sess:
+        sess["expires"] = int(time.time()) - 10
+    response = client.get('/home').get_json()
+    assert response["refresh_token"] is None
+
+    # A revoked refresh token clears the session
+    auth_mgr.http_client = FakeHttpClient([FakeResponse({"error": "invalid_grant"},
+                                                        status_code=400)])
+    with client.session_transaction() as sess:
+        sess["expires"] = int(time.time()) + 10
+        sess["refresh_token"] = "myrefreshtoken"
+    response = client.get('/home').get_json()
+    assert response["refresh_token"] is None
+
+
+def test_cognito_refresh_on_request(cognito_keys):
+    app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
+    app.config["COGNITO_JWKS"] = cognito_keys.jwks
+    app.config["COGNITO_REFRESH_ON_REQUEST"] = True
+    app.secret_key = "my super secret key"
+    auth_mgr = CognitoAuthManager(app)
+    auth_mgr.init(app)
+    assert app.before_request_funcs[None].count(decorators.refresh_before_request) == 1
+    auth_mgr.http_client = FakeHttpClient([FakeResponse(cognito_tokens(cognito_keys))])
+
+    @app.route('/home')
+    def home():
+        return jsonify(username=session.get("username"))
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["expires"] = int(time.time()) + 10
+        sess["refresh_token"] = "myrefreshtoken"
+    assert client.get('/home').get_json() == {"username": "myusername"}
+    assert len(auth_mgr.http_client.calls) == 1
+
+
+def test_cognito_single_flight():
+    flight = SingleFlight(result_ttl=30)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_call():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "mytokens"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.run("key", slow_call)))
+               for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ["mytokens"] * 5
+    assert len(calls) == 1
+    # Kept result is reused by late callers
+    assert flight.run("key", slow_call) == "mytokens"
+    assert len(calls) == 1
+
+    def failing_call():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        flight.run("other", failing_call)
+
+
+def test_cognito_jwks_single_flight(cognito_keys):
+    started = threading.Event()
+    release = threading.Event()
+
+    class SlowHttpClient(FakeHttpClient):
+        def get(self, url, **kwargs):
+            started.set()
+            release.wait(5)
+            return super().get(url, **kwargs)
+
+    http_client = SlowHttpClient([FakeResponse(cognito_keys.jwks)])
+    cache = JwksCache(http_client=http_client)
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(cache.get_key("https://jwks", cognito_keys.kid)))
+        for _ in range(8)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(results) == 8 and None not in results
+    assert len(http_client.calls) == 1
+
+
+def test_cognito_circuit_breaker():
+    class FakeSession(object):
+        def __init__(self):
+            self.calls = 0
+            self.status_code = None
+
+        def get(self, url, **kwargs):
+            self.calls += 1
+            if self.status_code is None:
+                raise requests.ConnectionError("unreachable")
+            return FakeResponse({}, status_code=self.status_code)
+
+        def close(self):
+            pass
+
+    app_config = dict(COGNITO_CONFIG, COGNITO_HTTP_BREAKER_THRESHOLD=2,
+                      COGNITO_HTTP_BREAKER_COOLDOWN=0.05)
+    http_client = CognitoHttpClient.from_config(app_config)
+    session = http_client.session = FakeSession()
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            http_client.get("https://jwks")
+    # Open: fails fast without calling AWS Cognito
+    with pytest.raises(CircuitOpenError):
+        http_client.get("https://jwks")
+    assert session.calls == 2
+
+    # After the cooldown a failed trial opens the circuit again
+    time.sleep(0.06)
+    session.status_code = 503
+    assert http_client.get("https://jwks").status_code == 503
+    with pytest.raises(CircuitOpenError):
+        http_client.get("https://jwks")
+
+    time.sleep(0.06)
+    session.status_code = 200
+    assert http_client.get("https://jwks").status_code == 200
+    assert not http_client.breaker.is_open
+    assert http_client.get("https://jwks").status_code == 200
+    assert session.calls == 5
+
+    # Callers handle an open circuit as a failed HTTP call
+    assert isinstance(CircuitOpenError("open"), requests.RequestException)
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.values = {}
+
+    def get(self, name):
+        value = self.values.get(name)
+        return value[0] if value else None
+
+    def set(self, name, value, ex=None):
+        self.values[name] = (value.encode("utf-8"), ex)
+
+    def delete(self, name):
+        self.values.pop(name, None)
+
+    def getdel(self, name):
+        value = self.values.pop(name, None)
+        return value[0] if value else None
+
+
+def test_cognito_token_store(cognito_keys):
+    token_store = MemoryTokenStore()
+    app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
+    app.secret_key = "my super secret key"
+    auth_mgr = CognitoAuthManager(app, token_store=token_store)
+    auth_mgr.jwt_key = cognito_keys.jwks["keys"]
+    auth_mgr.http_client = FakeHttpClient([FakeResponse(cognito_tokens(cognito_keys))])
+
+    @app.route('/cognito/callback')
+    @callback_handler
+    def callback():
+        return jsonify(session=dict(session))
+
+    @app.route('/home')
+    def home():
+        return jsonify(get_session_info())
+
+    @app.route('/cognito/logout')
+    @logout_handler
+    def cognitologout():
+        pass
+
+    client = app.test_client()
+    cookie_session = client.get('/cognito/callback?code=mycode').get_json()["session"]
+    assert list(cookie_session) == ["cognito_sid"]
+    assert len(token_store) == 1
+
+    info = client.get('/home').get_json()
+    assert info["username"] == "myusername"
+    assert info["refresh_token"] == "myrefreshtoken"
+
+    client.get('/cognito/logout')
+    assert len(token_store) == 0
+    assert client.get('/home').get_json()["username"] is None
+
+
+def test_cognito_redis_token_store():
+    redis = FakeRedis()
+    token_store = RedisTokenStore(redis, prefix="sessions:")
+    token_store.set("mysid", {"username": "myusername"}, ttl=60)
+    assert redis.values["sessions:mysid"][1] == 60
+    assert token_store.get("mysid") == {"username": "myusername"}
+    token_store.delete("mysid")
+    assert token_store.get("mysid") is None
+
+    memory_store = MemoryTokenStore(maxsize=1)
+    memory_store.set("sid1", {}, ttl=60)
+    memory_store.set("sid2", {}, ttl=60)
+    memory_store.set("expired", {}, ttl=-1)
+    assert memory_store.get("sid1") is None
+    assert memory_store.get("expired") is None
+
+
+def test_cognito_shared_jwks_cache(tmp_path, cognito_keys):
+    backend = FileJwksBackend(str(tmp_path / "jwks.json"))
+    rotated_key = dict(cognito_keys.public_jwk, kid="rotated")
+    worker1_http = FakeHttpClient([FakeResponse(cognito_keys.jwks),
+                                   FakeResponse({"keys": [rotated_key]})])
+    worker2_http = FakeHttpClient([])
+    worker1 = JwksCache(min_refresh_interval=0, http_client=worker1_http,
+                        shared_backend=backend)
+    worker2 = JwksCache(min_refresh_interval=0, http_client=worker2_http,
+                        shared_backend=backend)
+
+    # Worker 2 reads the key set fetched by worker 1
+    assert worker1.get_key("https://jwks", cognito_keys.kid) is not None
+    assert worker2.get_key("https://jwks", cognito_keys.kid) is not None
+    assert len(worker1_http.calls) == 1
+    assert worker2_http.calls == []
+
+    # Key rotation is fetched once and picked up from the shared file
+    assert worker1.get_key("https://jwks", "rotated") is not None
+    assert worker2.get_key("https://jwks", "rotated") is not None
+    assert len(worker1_http.calls) == 2
+    assert worker2_http.calls == []
+    assert backend.read()[0] == [rotated_key]
+
+    # Only a private file of this user is trusted
+    assert os.stat(backend.path).st_mode & 0o777 == 0o600
+    os.chmod(backend.path, 0o666)
+    assert backend.read() is None
+    for data in ({"keys": [rotated_key]}, {"keys": {}, "fetched_at": 0, "expires_at": 0}, []):
+        with open(backend.path, "w") as file:
+            json.dump(data, file)
+        os.chmod(backend.path, 0o600)
+        assert backend.read() is None
+
+
+def test_cognito_jwks_warm_up(app, cognito_keys):
+    auth_mgr = app.extensions['cognito-flask-auth']
+    assert not auth_mgr.keys_loaded
+
+    auth_mgr.key_cache.http_client = FakeHttpClient([FakeResponse({}, status_code=503)])
+    assert not auth_mgr.warm_up()
+
+    auth_mgr.key_cache.http_client = FakeHttpClient([FakeResponse(cognito_keys.jwks)])
+    assert auth_mgr.warm_up()
+    assert auth_mgr.key_cache.lookup(cognito_keys.kid) is not None
+
+
+def test_cognito_jwks_refresher(cognito_keys):
+    http_client = FakeHttpClient([FakeResponse(cognito_keys.jwks)] * 50)
+    cache = JwksCache(ttl=0.2, http_client=http_client)
+    refresher = JwksRefresher(cache, "https://jwks", refresh_ahead=0.1,
+                              retry_interval=0.05)
+    refresher.start()
+    try:
+        deadline = time.time() + 5
+        while len(http_client.calls) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        refresher.stop(timeout=5)
+    assert len(http_client.calls) >= 3
+    assert cache.is_fresh
+    assert not refresher.is_alive
+
+
+def test_cognito_benchmark_smoke():
+    report = bench_auth.run(iterations=2, key_bits=1024)
+    results = {result["name"]: result for result in report["results"]}
+    assert set(results) == set(bench_auth.SCENARIOS)
+    assert results["verify_warm_cache"]["jwks_fetches"] == 0
+    assert results["callback_concurrent"]["errors"] == 0
+    json.dumps(report)
+
+
+class RecordingMetrics(MetricsSink):
+    def __init__(self):
+        self.timings = []
+        self.counters = []
+
+    def timing(self, name, seconds, tags=None):
+        self.timings.append(name)
+
+    def increment(self, name, value=1, tags=None):
+        self.counters.append((name, tags))
+
+
+def test_cognito_metrics(cognito_keys):
+    sink = RecordingMetrics()
+    app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
+    app.secret_key = "my super secret key"
+    auth_mgr = CognitoAuthManager(app, metrics=sink)
+    auth_mgr.http_client = FakeHttpClient([FakeResponse(cognito_tokens(cognito_keys))])
+    auth_mgr.key_cache.http_client = FakeHttpClient([FakeResponse(cognito_keys.jwks)])
+
+    @app.route('/cognito/callback')
+    @callback_handler
+    def callback():
+        return jsonify(username=session["username"])
+
+    client = app.test_client()
+    assert client.get('/cognito/callback?code=mycode').status_code == 200
+    assert sink.timings.count("code_exchange.latency") == 1
+    assert sink.timings.count("jwks.fetch.latency") == 1
+    assert sink.timings.count("verify.duration") == 2
+    assert ("jwks.cache", {"result": "miss"}) in sink.counters
+    assert ("jwks.cache", {"result": "hit"}) in sink.counters
+
+    with app.test_request_context():
+        expired = cognito_keys.sign({"sub": "myuserid",
+                                     "exp": int(time.time()) - 10})
+        with pytest.raises(JWTError):
+            verify(expired)
+    assert sink.counters[-1] == ("verify.failure", {"reason": "expired"})
+
+
+def test_cognito_prometheus_metrics(cognito_keys):
+    prometheus_client = pytest.importorskip("prometheus_client")
+    from flask_cognito_auth import PrometheusMetrics
+    registry = prometheus_client.CollectorRegistry()
+    app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
+    app.config["COGNITO_JWKS"] = cognito_keys.jwks
+    app.secret_key = "my super secret key"
+    auth_mgr = CognitoAuthManager(app, metrics=PrometheusMetrics(registry=registry))
+    auth_mgr.http_client = FakeHttpClient([FakeResponse(cognito_tokens(cognito_keys)),
+                                           FakeResponse(cognito_tokens(cognito_keys))])
+
+    @app.route('/cognito/callback')
+    @callback_handler
+    def callback():
+        return ""
+
+    @app.route('/home')
+    @refresh_handler
+    def home():
+        return jsonify(refreshed=session["expires"] > time.time() + 60)
+
+    client = app.test_client()
+    assert client.get('/cognito/callback?code=mycode').status_code == 200
+    with client.session_transaction() as sess:
+        sess["expires"] = int(time.time()) + 10
+    assert client.get('/home').get_json() == {"refreshed": True}
+    for grant_type in ("authorization_code", "refresh_token"):
+        assert registry.get_sample_value(
+            "flask_cognito_auth_code_exchange_latency_seconds_count",
+            {"grant_type": grant_type}) == 1
+
+    # A failing sink does not fail the authentication
+    class BrokenSink(MetricsSink):
+        def timing(self, name, seconds, tags=None):
+            raise ValueError("incompatible labels")
+
+        def increment(self, name, value=1, tags=None):
+            raise ValueError("incompatible labels")
+
+    auth_mgr.metrics.sinks.append(BrokenSink())
+    auth_mgr.http_client = FakeHttpClient([FakeResponse(cognito_tokens(cognito_keys))])
+    auth_mgr.refresh_flight.forget(token_hash("myrefreshtoken"))
+    with client.session_transaction() as sess:
+        sess["expires"] = int(time.time()) + 10
+    assert client.get('/home').get_json() == {"refreshed": True}
+
+
+def test_cognito_statsd_metrics():
+    import socket
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(5)
+    try:
+        sink = StatsdMetrics(port=receiver.getsockname()[1], host="127.0.0.1")
+        sink.increment("verify.failure", tags={"reason": "expired"})
+        assert receiver.recv(1024) == b"flask_cognito_auth.verify.failure:1|c|#reason:expired"
+        sink.timing("verify.duration", 0.002)
+        assert receiver.recv(1024) == b"flask_cognito_auth.verify.duration:2.000|ms"
+    finally:
+        receiver.close()
+
+
+def test_cognito_verify_many(app, cognito_keys):
+    from concurrent.futures import ThreadPoolExecutor
+    from concurrent.futures import ProcessPoolExecutor
+    auth_mgr = app.extensions['cognito-flask-auth']
+    auth_mgr.key_cache.http_client = FakeHttpClient([FakeResponse(cognito_keys.jwks)])
+    tokens = cognito_tokens(cognito_keys)
+    unknown_kid = cognito_keys.sign({"sub": "myuserid"}, headers={"kid": "unknown-kid"})
+    expired = cognito_keys.sign({"sub": "myuserid", "exp": int(time.time()) - 10})
+    batch = [tokens["access_token"], "abc", unknown_kid, expired,
+             tokens["access_token"], tokens["id_token"]]
+
+    with app.test_request_context():
+        for executor in (None, ThreadPoolExecutor(2), ProcessPoolExecutor(2)):
+            results = verify_many(batch, executor=executor, chunk_size=1)
+            assert [result.ok for result in results] == [True, False, False, False, True, True]
+            assert results[0] is results[4]
+            assert results[0].claims["token_use"] == "access"
+            assert "unknown-kid" in str(results[2].error)
+            assert isinstance(results[3].error, ExpiredSignatureError)
+            if executor is not None:
+                executor.shutdown()
+
+        results = verify_many(batch[:1] + batch[-1:], token_use="access")
+        assert [result.ok for result in results] == [True, False]
+    # One JWKS fetch for the whole batch
+    assert len(auth_mgr.key_cache.http_client.calls) == 1
+
+
+def test_cognito_token_required_jwks_down(app, cognito_keys):
+    auth_mgr = app.extensions['cognito-flask-auth']
+
+    @app.route('/api')
+    @token_required
+    def api():
+        return ""
+
+    client = app.test_client()
+    headers = {"Authorization": f"Bearer {cognito_tokens(cognito_keys)['access_token']}"}
+    for http_client in (DownHttpClient([]), FakeHttpClient([FakeResponse({"nokeys": []})])):
+        auth_mgr.key_cache.http_client = http_client
+        response = client.get('/api', headers=headers)
+        assert response.status_code == 503
+        assert "Error" in json.loads(response.data)
+    # Failing fast while the circuit breaker is open
+    auth_mgr.key_cache.http_client = CognitoHttpClient(breaker=CircuitBreaker(threshold=1))
+    auth_mgr.key_cache.http_client.breaker.record_failure()
+    assert client.get('/api', headers=headers).status_code == 503
+
+
+def test_cognito_verify_many_failures(app, cognito_keys, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    auth_mgr = app.extensions['cognito-flask-auth']
+    tokens = cognito_tokens(cognito_keys)
+    batch = [tokens["access_token"], "abc", tokens["id_token"]]
+
+    # Cold cache with the JWKS endpoint down: every token gets an error
+    auth_mgr.key_cache.http_client = DownHttpClient([])
+    with app.test_request_context():
+        results = verify_many(batch)
+    assert [result.ok for result in results] == [False, False, False]
+    assert isinstance(results[0].error, requests.ConnectionError)
+    assert isinstance(results[1].error, JWTError)
+
+    # A failed executor task only fails the tokens of its chunk
+    auth_mgr.key_cache.http_client = FakeHttpClient([FakeResponse(cognito_keys.jwks)])
+    original = decorators.verify_chunk
+
+    def flaky_chunk(validation, key, items, token_use=None):
+        if items[0][0] == tokens["id_token"]:
+            raise RuntimeError("worker died")
+        return original(validation, key, items, token_use)
+
+    monkeypatch.setattr(decorators, "verify_chunk", flaky_chunk)
+    with app.test_request_context(), ThreadPoolExecutor(2) as executor:
+        results = verify_many(batch, executor=executor, chunk_size=1)
+    assert [result.ok for result in results] == [True, False, False]
+    assert isinstance(results[2].error, RuntimeError)
+
+
+def test_cognito_groups_required(app, cognito_keys):
+    app.extensions['cognito-flask-auth'].jwt_key = cognito_keys.jwks["keys"]
+
+    @app.route('/admin')
+    @groups_required(any_of=["admin", "owner"])
+    def admin():
+        return jsonify(groups=sorted(g.cognito_groups))
+
+    @app.route('/api/report')
+    @token_required
+    @groups_required(all_of=["reports", "finance"])
+    def report():
+        return jsonify(sub=g.cognito_claims["sub"])
+
+    @app.route('/login/<groups>')
+    def login(groups):
+        update_session(username="myusername", id="myuserid",
+                       groups=groups.split(","), email=None,
+                       expires=None, refresh_token=None)
+        return ""
+
+    client = app.test_client()
+    assert client.get('/admin').status_code == 401
+    client.get('/login/mygroup1')
+    assert client.get('/admin').status_code == 403
+    client.get('/login/mygroup1,owner')
+    assert client.get('/admin').get_json() == {"groups": ["mygroup1", "owner"]}
+
+    def bearer(groups):
+        token = cognito_keys.sign({"sub": "myuserid", "cognito:groups": groups,
+                                   "exp": int(time.time()) + 300})
+        return {"Authorization": f"Bearer {token}"}
+
+    assert client.get('/api/report', headers=bearer(["reports"])).status_code == 403
+    assert client.get('/api/report',
+                      headers=bearer(["finance", "reports"])).get_json() == {"sub": "myuserid"}
+
+    with pytest.raises(RuntimeError):
+        groups_required()
+
+
+def test_cognito_current_user(app, cognito_keys, monkeypatch):
+    app.extensions['cognito-flask-auth'].jwt_key = cognito_keys.jwks["keys"]
+
+    @app.route('/me')
+    def me():
+        return jsonify(authenticated=current_cognito_user.is_authenticated,
+                       username=current_cognito_user.username,
+                       admin=current_cognito_user.in_group("admin"))
+
+    @app.route('/api/me')
+    @token_required
+    def api_me():
+        return jsonify(username=current_cognito_user.username,
+                       groups=sorted(current_cognito_user.groups))
+
+    @app.route('/login')
+    def login():
+        update_session(username="myusername", id="myuserid",
+                       groups=["admin"], email=None,
+                       expires=None, refresh_token=None)
+        return ""
+
+    client = app.test_client()
+    assert client.get('/me').get_json() == {"authenticated": False,
+                                            "username": None,
+                                            "admin": False}
+    client.get('/login')
+    assert client.get('/me').get_json() == {"authenticated": True,
+                                            "username": "myusername",
+                                            "admin": True}
+
+    token = cognito_keys.sign({"sub": "myuserid", "username": "apiuser",
+                               "token_use": "access",
+                               "client_id": "123drfthinvdr57opQWerv56",
+                               "cognito:groups": ["reports"],
+                               "exp": int(time.time()) + 300})
+    assert client.get('/api/me', headers={"Authorization": f"Bearer {token}"}).get_json() == {
+        "username": "apiuser", "groups": ["reports"]}
+
+    # Built once per request
+    with app.test_request_context():
+        built = []
+        original = CognitoUser.__init__
+
+        def counting_init(self, *args, **kwargs):
+            built.append(1)
+            original(self, *args, **kwargs)
+
+        monkeypatch.setattr(CognitoUser, "__init__", counting_init)
+        assert current_cognito_user.username is None
+        assert not current_cognito_user.is_authenticated
+        assert len(built) == 1
+
+
+def test_cognito_blocklist(caplog):
+    blocklist = MemoryBlocklist(maxsize=2)
+    now = time.time()
+    blocklist.add("jti1", now + 300)
+    blocklist.add("jti2", now + 100)
+    blocklist.add("expired", now - 1)
+    assert blocklist.contains("jti1") and blocklist.contains("jti2")
+    assert not blocklist.contains("expired")
+    assert not blocklist.overflowed
+    # When full, the id closest to expiry is dropped first and it is logged
+    with caplog.at_level(logging.WARNING, logger="flask_cognito_auth.revocation"):
+        blocklist.add("jti3", now + 200)
+    assert "Blocklist is full" in caplog.text
+    assert len(blocklist) == 2
+    assert not blocklist.contains("jti2")
+    assert blocklist.overflowed
+    assert not blocklist.is_revoked({"jti": "jti2", "iat": now - 10})
+    assert blocklist.is_revoked({"origin_jti": "jti3"})
+    assert not blocklist.revoke({"sub": "myuserid", "exp": now + 300})
+
+    # Failing closed, the tokens issued before the overflow are rejected
+    blocklist = MemoryBlocklist(maxsize=1, fail_closed=True)
+    blocklist.add("jti1", now + 300)
+    blocklist.add("jti2", now + 200)
+    assert blocklist.is_revoked({"jti": "jti1", "iat": now - 10})
+    assert blocklist.is_revoked({"jti": "otherjti"})
+    assert not blocklist.is_revoked({"jti": "otherjti", "iat": time.time() + 1})
+
+    blocklist = MemoryBlocklist()
+    blocklist.add("jti1", now + 0.05)
+    time.sleep(0.1)
+    assert not blocklist.contains("jti1")
+    assert len(blocklist) == 0
+
+    redis_blocklist = RedisBlocklist(FakeRedis())
+    assert redis_blocklist.revoke({"jti": "jti1", "exp": now + 300})
+    assert redis_blocklist.is_revoked({"jti": "jti1"})
+    assert not redis_blocklist.is_revoked({"jti": "jti2"})
+
+
+def test_cognito_logout_revokes_tokens(app, cognito_keys):
+    app.config["COGNITO_REVOKE_ON_LOGOUT"] = True
+    auth_mgr = CognitoAuthManager(app)
+    auth_mgr.jwt_key = cognito_keys.jwks["keys"]
+    exp = int(time.time()) + 3600
+    claims = {"sub": "myuserid", "exp": exp, "origin_jti": "myoriginjti"}
+    access_token = cognito_keys.sign(dict(claims, token_use="access", jti="jti1",
+                                          client_id="123drfthinvdr57opQWerv56"))
+    id_token = cognito_keys.sign(dict(claims, token_use="id", jti="jti2",
+                                      aud="123drfthinvdr57opQWerv56",
+                                      email="myemail@domain.com",
+                                      **{"cognito:username": "myusername"}))
+    auth_mgr.http_client = FakeHttpClient([
+        FakeResponse({"access_token": access_token, "id_token": id_token,
+                      "refresh_token": "myrefreshtoken"}),
+        FakeResponse({})])
+
+    @app.route('/cognito/callback')
+    @callback_handler
+    def callback():
+        return ""
+
+    @app.route('/cognito/logout')
+    @logout_handler
+    def logout():
+        pass
+
+    @app.route('/api')
+    @token_required
+    def api():
+        return ""
+
+    client = app.test_client()
+    headers = {"Authorization": f"Bearer {access_token}"}
+    assert client.get('/cognito/callback?code=mycode').status_code == 200
+    assert client.get('/api', headers=headers).status_code == 200
+
+    client.get('/cognito/logout')
+    method, url, kwargs = auth_mgr.http_client.calls[1]
+    assert (method, url) == ("POST", "https://mycognitodomain.com/oauth2/revoke")
+    assert kwargs["data"]["token"] == "myrefreshtoken"
+    # Cached and new verifications of the tokens of the login are rejected
+    assert client.get('/api', headers=headers).status_code == 401
+    with app.test_request_context():
+        with pytest.raises(TokenRevokedError):
+            verify(id_token)
+
+
+def test_cognito_local_jwks(tmp_path, cognito_keys):
+    rotated = CognitoKeys(kid="rotated-kid")
+    jwks_file = tmp_path / "jwks.json"
+    jwks_file.write_text(json.dumps(cognito_keys.jwks))
+
+    app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
+    app.config["COGNITO_JWKS"] = str(jwks_file)
+    app.config["COGNITO_JWKS_RELOAD_INTERVAL"] = 0
+    auth_mgr = CognitoAuthManager(app)
+    auth_mgr.key_cache.http_client = FakeHttpClient([])
+    with app.test_request_context():
+        assert verify(cognito_keys.sign({"sub": "myuserid"}))["sub"] == "myuserid"
+        key = auth_mgr.key_cache.lookup(cognito_keys.kid)
+        assert verify(cognito_keys.sign({"sub": "myuserid"}))["sub"] == "myuserid"
+        # Unchanged file keeps the constructed keys
+        assert auth_mgr.key_cache.lookup(cognito_keys.kid) is key
+
+        jwks_file.write_text(json.dumps({"keys": [cognito_keys.public_jwk,
+                                                  rotated.public_jwk]}))
+        os.utime(jwks_file, ns=(time.time_ns() + 10 ** 9,) * 2)
+        assert verify(rotated.sign({"sub": "rotateduser"}))["sub"] == "rotateduser"
+    assert auth_mgr.key_cache.http_client.calls == []
+
+    calls = []
+
+    def load_jwks():
+        calls.append(1)
+        return cognito_keys.jwks
+
+    for jwks in (cognito_keys.jwks, load_jwks):
+        app.config["COGNITO_JWKS"] = jwks
+        auth_mgr = CognitoAuthManager(app)
+        with app.test_request_context():
+            assert verify(cognito_keys.sign({"sub": "myuserid"}))["sub"] == "myuserid"
+            with pytest.raises(JWTError):
+                verify(rotated.sign({"sub": "rotateduser"}))
+    # The unknown kid reload is rate limited by COGNITO_JWKS_MIN_REFRESH_INTERVAL
+    assert len(calls) == 1
+
+
+def test_cognito_tenants(cognito_keys):
+    acme_keys = CognitoKeys(kid="acme-kid")
+    acme_issuer = "https://cognito-idp.us-east-1.amazonaws.com/us-east-1_acmePool"
+    app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
+    app.config["COGNITO_JWKS"] = cognito_keys.jwks
+    app.config["COGNITO_TENANTS"] = {
+        "acme": {"COGNITO_USER_POOL_ID": "us-east-1_acmePool",
+                 "COGNITO_CLIENT_ID": "acmeclientid",
+                 "COGNITO_JWKS": acme_keys.jwks,
+                 "COGNITO_TENANT_HOSTS": ["acme.example.com"],
+                 "COGNITO_TENANT_PATH_PREFIX": "/acme"}}
+    auth_mgr = CognitoAuthManager(app)
+    acme = auth_mgr.tenants.get("acme")
+    assert acme.key_cache is not auth_mgr.key_cache
+    assert acme.token_cache is not auth_mgr.token_cache
+    assert acme.settings.domain == auth_mgr.settings.domain
+
+    @app.route("/api")
+    @app.route("/acme/api")
+    @token_required
+    def api():
+        return jsonify(sub=g.cognito_claims["sub"], client_id=config.settings.client_id)
+
+    config = Config()
+    default_token = cognito_keys.sign({"sub": "defaultuser"})
+    acme_token = acme_keys.sign({"sub": "acmeuser", "iss": acme_issuer,
+                                 "token_use": "access", "client_id": "acmeclientid"})
+    client = app.test_client()
+    for path, base_url in (("/acme/api", "http://localhost"),
+                           ("/api", "http://acme.example.com:8080")):
+        response = client.get(path, base_url=base_url,
+                              headers={"Authorization": f"Bearer {acme_token}"})
+        assert response.json == {"sub": "acmeuser", "client_id": "acmeclientid"}
+        # A request resolved to a tenant only accepts its tokens
+        response = client.get(path, base_url=base_url,
+                              headers={"Authorization": f"Bearer {default_token}"})
+        assert response.status_code == 401
+
+    # Shared hosts resolve the tenant by the token issuer
+    with app.test_request_context("/api"):
+        assert auth_mgr.current_tenant() is auth_mgr
+        assert verify(default_token)["sub"] == "defaultuser"
+        assert verify(acme_token)["sub"] == "acmeuser"
+        results = verify_many([acme_token, default_token])
+        assert [result.claims["sub"] for result in results] == ["acmeuser", "defaultuser"]
+
+    app.config["COGNITO_TENANTS"]["other"] = {"COGNITO_USER_POOL_ID": "us-east-1_otherPool",
+                                              "COGNITO_TENANT_HOSTS": ["ACME.example.com"]}
+    with pytest.raises(RuntimeError):
+        CognitoAuthManager(app)
+
+
+@pytest.mark.parametrize("token_store", [None, MemoryTokenStore()])
+def test_cognito_tenant_sessions(cognito_keys, token_store):
+    app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
+    app.config["COGNITO_JWKS"] = cognito_keys.jwks
+    app.config["COGNITO_TENANTS"] = {
+        "acme": {"COGNITO_USER_POOL_ID": "us-east-1_acmePool",
+                 "COGNITO_CLIENT_ID": "acmeclientid",
+                 "COGNITO_JWKS": CognitoKeys(kid="acme-kid").jwks,
+                 "COGNITO_TENANT_PATH_PREFIX": "/acme"}}
+    app.secret_key = "my super secret key"
+    auth_mgr = CognitoAuthManager(app, token_store=token_store)
+    acme = auth_mgr.tenants.get("acme")
+    acme.http_client = FakeHttpClient([FakeResponse(cognito_tokens(cognito_keys))])
+
+    @app.route('/login')
+    def login():
+        update_session(username="myusername", id="myuserid",
+                       groups=["admin"], email=None,
+                       expires=int(time.time()) + 10, refresh_token="myrefreshtoken")
+        return ""
+
+    @app.route('/admin')
+    @app.route('/acme/admin')
+    @groups_required(any_of=["admin"])
+    def admin():
+        return ""
+
+    @app.route('/me')
+    @app.route('/acme/me')
+    @refresh_handler
+    def me():
+        return jsonify(username=current_cognito_user.username)
+
+    client = app.test_client()
+    client.get('/login')
+    assert client.get('/admin').status_code == 200
+    # A login to the default user pool is anonymous under the acme tenant
+    assert client.get('/acme/admin').status_code == 401
+    assert client.get('/acme/me').get_json() == {"username": None}
+    assert acme.http_client.calls == []
+    # and is left as is for the default tenant
+    assert client.get('/admin').status_code == 200
+
+
+def test_cognito_login_state(cognito_keys):
+    app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
+    app.config["COGNITO_STATE"] = "mystaticstate"
+    app.config["COGNITO_LOGIN_STATE"] = True
+    app.secret_key = "my super secret key"
+    auth_mgr = CognitoAuthManager(app)
+    auth_mgr.jwt_key = cognito_keys.jwks["keys"]
+
+    @app.route('/login')
+    @login_handler
+    def login():
+        pass
+
+    @app.route('/cognito/callback')
+    @callback_handler
+    def callback():
+        return jsonify(username=session["username"])
+
+    def login_parameters():
+        location = client.get('/login').headers["Location"]
+        assert "mystaticstate" not in location
+        return dict(parameter.split("=", 1) for parameter in location.split("?", 1)[1].split("&"))
+
+    def token_response(nonce):
+        tokens = cognito_tokens(cognito_keys)
+        claims = jwt.get_unverified_claims(tokens["id_token"])
+        tokens["id_token"] = cognito_keys.sign(dict(claims, nonce=nonce))
+        return FakeResponse(tokens)
+
+    client = app.test_client()
+    first, second = login_parameters(), login_parameters()
+    assert first["state"] != second["state"]
+    assert first["code_challenge_method"] == "S256"
+    assert len(auth_mgr.state_store) == 2
+
+    # Forged and missing states are rejected before the code exchange
+    auth_mgr.http_client = FakeHttpClient([])
+    assert client.get('/cognito/callback?code=mycode&state=forged').status_code == 500
+    assert client.get('/cognito/callback?code=mycode').status_code == 500
+    assert auth_mgr.http_client.calls == []
+
+    auth_mgr.http_client = FakeHttpClient([token_response(first["nonce"])])
+    response = client.get(f'/cognito/callback?code=mycode&state={first["state"]}')
+    assert response.get_json() == {"username": "myusername"}
+    code_verifier = auth_mgr.http_client.calls[0][2]["data"]["code_verifier"]
+    assert code_challenge(code_verifier) == first["code_challenge"]
+    # A state is accepted once
+    assert client.get(f'/cognito/callback?code=mycode&state={first["state"]}').status_code == 500
+
+    auth_mgr.http_client = FakeHttpClient([token_response(first["nonce"])])
+    assert client.get(f'/cognito/callback?code=mycode&state={second["state"]}').status_code == 500
+    assert len(auth_mgr.state_store) == 0
+
+
+def test_cognito_state_store():
+    store = MemoryStateStore(maxsize=2)
+    for state in ("one", "two", "three"):
+        store.put(state, {"nonce": state}, 600)
+    assert len(store) == 2
+    assert store.consume("one") is None
+    assert store.consume("two") == {"nonce": "two"}
+    assert store.consume("two") is None
+    store.put("expired", {"nonce": "expired"}, -1)
+    assert store.consume("expired") is None
+    store.put("four", {"nonce": "four"}, 600)
+    store.put("expired", {"nonce": "expired"}, -1)
+    assert len(store) == 2
+
+    store = RedisStateStore(FakeRedis())
+    store.put("one", {"nonce": "one"}, 600)
+    assert store.client.values["flask-cognito-auth:state:one"][1] == 600
+    assert store.consume("one") == {"nonce": "one"}
+    assert store.consume("one") is None
+
+
+class RecordingEventSink(EventSink):
+    def __init__(self):
+        self.batches = []
+
+    def emit(self, events):
+        self.batches.append(events)
+
+
+def test_cognito_auth_events_exit_flush(cognito_keys, monkeypatch):
+    from flask_cognito_auth import events as events_module
+    handlers = []
+    monkeypatch.setattr(events_module.atexit, "register", handlers.append)
+    monkeypatch.setattr(events_module.atexit, "unregister", handlers.remove)
+    app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
+    app.config["COGNITO_JWKS"] = cognito_keys.jwks
+    app.config["COGNITO_EVENTS_FLUSH_INTERVAL"] = 60
+    auth_mgr = CognitoAuthManager(app, events=RecordingEventSink())
+    for _ in range(3):
+        auth_mgr.events.emit("logout")
+        auth_mgr.init(app)
+    # Only the events of the last init flush at exit
+    auth_mgr.events.emit("logout")
+    assert handlers == [auth_mgr.events.flush]
+    auth_mgr.events.close()
+    assert handlers == []
+
+
+def test_cognito_auth_events(cognito_keys):
+    sink = RecordingEventSink()
+    app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
+    app.config["COGNITO_EVENTS_BATCH_SIZE"] = 5
+    app.config["COGNITO_EVENTS_FLUSH_INTERVAL"] = 0
+    app.secret_key = "my super secret key"
+    auth_mgr = CognitoAuthManager(app, events=sink)
+    auth_mgr.jwt_key = cognito_keys.jwks["keys"]
+    auth_mgr.http_client = FakeHttpClient([FakeResponse(cognito_tokens(cognito_keys)),
+                                           FakeResponse({}, status_code=400),
+                                           FakeResponse(cognito_tokens(cognito_keys, exp=1))])
+
+    @app.route('/login')
+    @login_handler
+    def login():
+        pass
+
+    @app.route('/cognito/callback')
+    @callback_handler
+    def callback():
+        return ""
+
+    @app.route('/cognito/logout')
+    @logout_handler
+    def logout():
+        pass
+
+    @app.route('/api')
+    @token_required
+    def api():
+        return ""
+
+    client = app.test_client()
+    client.get('/login')
+    assert client.get('/cognito/callback?code=mycode').status_code == 200
+    # Batched: nothing is handed to the sink before the batch is full
+    assert sink.batches == []
+    client.get('/api', headers={"Authorization": "Bearer notatoken"})
+    client.get('/api', headers={"Authorization": f"Bearer {cognito_keys.sign({'sub': 'myuserid', 'exp': 1})}"})
+    client.get('/cognito/logout')
+    assert client.get('/cognito/callback?code=badcode').status_code == 500
+    assert client.get('/cognito/callback?code=expiredcode').status_code == 500
+    auth_mgr.events.flush()
+
+    events = [event.to_dict() for batch in sink.batches for event in batch]
+    assert len(sink.batches) == 2 and len(sink.batches[0]) == 5
+    assert [event["type"] for event in events] == [
+        "login_redirect", "code_exchanged", "token_verified", "token_verified",
+        "verify_failed", "verify_failed", "logout", "code_exchanged",
+        "code_exchanged", "verify_failed"]
+    assert events[2]["sub"] == "myuserid" and events[2]["latency"] > 0
+    assert events[4]["reason"] == "invalid"
+    assert events[5]["reason"] == "expired"
+    assert events[6]["sub"] == "myuserid"
+    assert events[7]["reason"] == "http_400"
+    assert events[9]["reason"] == "expired"
+    assert all(event["tenant"] == "default" for event in events)
+
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    audit_logger = logging.getLogger("flask_cognito_auth.audit")
+    audit_logger.addHandler(handler)
+    audit_logger.setLevel(logging.INFO)
+    try:
+        LoggingEventSink().emit([AuthEvent("logout", sub="myuserid")])
+    finally:
+        audit_logger.removeHandler(handler)
+    assert json.loads(records[0].getMessage())["sub"] == "myuserid"
+
+
+def test_cognito_phase_timing(cognito_keys):
+    app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
+    app.config["COGNITO_PHASE_TIMING"] = lambda request: "X-Timing" in request.headers
+    app.config["COGNITO_SERVER_TIMING"] = True
+    app.secret_key = "my super secret key"
+    auth_mgr = CognitoAuthManager(app)
+    auth_mgr.jwt_key = cognito_keys.jwks["keys"]
+    auth_mgr.http_client = FakeHttpClient([FakeResponse(cognito_tokens(cognito_keys))
+                                           for _ in range(2)])
+
+    @app.route('/cognito/callback')
+    @callback_handler
+    def callback():
+        return jsonify(phases=sorted(g.get("cognito_timings", {})))
+
+    @app.route('/api')
+    @token_required
+    def api():
+        return jsonify(phases=sorted(g.cognito_timings))
+
+    client = app.test_client()
+    response = client.get('/cognito/callback?code=mycode', headers={"X-Timing": "1"})
+    assert response.get_json()["phases"] == ["config", "header_parse", "json_parse",
+                                             "key_lookup", "session_write",
+                                             "signature", "token_post"]
+    server_timing = response.headers["Server-Timing"]
+    assert "cognito-token_post;dur=" in server_timing
+    assert "cognito-signature;dur=" in server_timing
+
+    # Requests which are not sampled are not timed
+    response = client.get('/cognito/callback?code=othercode')
+    assert response.get_json()["phases"] == []
+    assert "Server-Timing" not in response.headers
+
+    token = cognito_keys.sign({"sub": "myuserid"})
+    response = client.get('/api', headers={"X-Timing": "1",
+                                           "Authorization": f"Bearer {token}"})
+    assert response.get_json()["phases"] == ["header_parse", "key_lookup", "signature"]
+    assert should_time(1.0, None) and not should_time(0.0, None)
+    assert not should_time(None, None) and should_time(True, None)
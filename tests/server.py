@@ -2,10 +2,22 @@ import pytest
 from flask import Flask
 from flask_cognito_auth import CognitoAuthManager
 
+COGNITO_CONFIG = {
+    'COGNITO_REGION': "us-east-1",
+    'COGNITO_USER_POOL_ID': "us-east-1_myPoolId",
+    'COGNITO_CLIENT_ID': "123drfthinvdr57opQWerv56",
+    'COGNITO_CLIENT_SECRET': "mysupersecretclientid",
+    'COGNITO_DOMAIN': "https://mycognitodomain.com",
+    'COGNITO_REDIRECT_URI': "http://localhost:5000/cognito/callback",
+    'COGNITO_SIGNOUT_URI': "http://localhost:5000/login",
+}
+COGNITO_ISSUER = "https://cognito-idp.us-east-1.amazonaws.com/us-east-1_myPoolId"
+
 
 @pytest.fixture(scope='function')
 def app():
     app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
     _ = CognitoAuthManager(app)
     app.secret_key = "my super secret key"
     return app
@@ -21,6 +33,41 @@ def app_exception():
 @pytest.fixture(scope='function')
 def app_lazy():
     app = Flask(__name__)
+    app.config.update(COGNITO_CONFIG)
     cognito_auth_manager = CognitoAuthManager()
     cognito_auth_manager.init(app)
     return app
+
+
+class CognitoKeys(object):
+    """
+    RSA key pair standing in for an AWS Cognito user pool signing key.
+    """
+
+    def __init__(self, kid="test-kid", bits=1024):
+        import rsa
+        from jose import jwk
+        _, private_key = rsa.newkeys(bits)
+        self.kid = kid
+        self.private_pem = private_key.save_pkcs1().decode()
+        self.public_jwk = jwk.construct(
+            self.private_pem, "RS256").public_key().to_dict()
+        self.public_jwk["kid"] = kid
+
+    @property
+    def jwks(self):
+        return {"keys": [self.public_jwk]}
+
+    def sign(self, claims, headers=None):
+        from jose import jwt
+        claims = dict(claims)
+        claims.setdefault("iss", COGNITO_ISSUER)
+        token_headers = {"kid": self.kid}
+        token_headers.update(headers or {})
+        return jwt.encode(claims, self.private_pem,
+                          algorithm="RS256", headers=token_headers)
+
+
+@pytest.fixture(scope='session')
+def cognito_keys():
+    return CognitoKeys()